@@ -2,10 +2,15 @@
 Purpose: Basic interface for the OpenAI api completions api
 instantiated with a prompt that can be templated on the fly.
 """
-from typing import Optional
+import time
+from typing import Callable, Iterator, Optional
 
 import openai
 
+from agent.responsecache import ResponseCache, ResponseCacheMiss
+from token_budget.tokenbudget import TokenUsage, count_tokens
+from tracing.tracer import get_tracer
+
 
 class Agent:
     """
@@ -20,16 +25,22 @@ class Agent:
         few_shot_prompt: Optional[list] = None,
         temperature: int = 0,
         retain_history: bool = False,
+        response_cache: Optional[ResponseCache] = None,
     ):
         self.openai_client = openai.Client()
+        self.async_openai_client = openai.AsyncOpenAI()
         self.query_prompt = query_prompt
         self.system_prompt = system_prompt
         self.few_shot_prompt = few_shot_prompt if few_shot_prompt is not None else []
         self.model = model
         self.temperature = temperature
         self.retain_history = retain_history
-        if self.retain_history:
-            self.history: list = []
+        self.history: list = []
+        self.response_cache = response_cache
+        self.token_usage = TokenUsage()
+
+        from helpers import get_logger
+        self.logger = get_logger()
 
     def generate_query(self, **kwargs):
         """
@@ -38,10 +49,9 @@ class Agent:
         formatted_query = self.query_prompt.format(**kwargs)
         return formatted_query
 
-    def ask_llm(self, prompt: str, json_out: bool = False):
+    def build_request(self, prompt: str, json_out: bool = False) -> dict:
         """
-        Sends a query to the LLM for response
-        If history or system promps are available, use that as well
+        Builds the chat completions request, system prompt, few shot, history and the prompt
         """
         messages = (
             [{"role": "system", "content": self.system_prompt}]
@@ -52,28 +62,19 @@ class Agent:
         if self.history:
             messages.extend(self.history)
         messages.append({"role": "user", "content": prompt})
+        request = {
+            "messages": messages,
+            "model": self.model,
+            "temperature": self.temperature,
+        }
         if json_out:
-            llm_output = (
-                self.openai_client.chat.completions.create(
-                    messages=messages,
-                    response_format={"type": "json_object"},
-                    model=self.model,
-                    temperature=self.temperature,
-                )
-                .choices[0]
-                .message.content
-            )
-        else:
-            llm_output = (
-                self.openai_client.chat.completions.create(
-                    messages=messages,
-                    model=self.model,
-                    temperature=self.temperature,
-                )
-                .choices[0]
-                .message.content
-            )
+            request["response_format"] = {"type": "json_object"}
+        return request
 
+    def record_history(self, prompt: str, llm_output: str) -> None:
+        """
+        Keeps the exchange in history if the agent retains it
+        """
         if self.retain_history:
             self.history.extend(
                 [
@@ -82,4 +83,125 @@ class Agent:
                 ]
             )
 
+    def ask_llm(self, prompt: str, json_out: bool = False, on_token: Optional[Callable[[str], None]] = None):
+        """
+        Sends a query to the LLM for response
+        If history or system promps are available, use that as well
+        With on_token the response is streamed and on_token is called with each token as it arrives
+        """
+        with get_tracer().span("ask_llm", kind="llm", model=self.model, streamed=on_token is not None):
+            if on_token is not None:
+                tokens = []
+                for token in self.stream_llm(prompt, json_out):
+                    on_token(token)
+                    tokens.append(token)
+                return "".join(tokens)
+            llm_output = self.cached_completion(self.build_request(prompt, json_out))
+            self.record_history(prompt, llm_output)
+            return llm_output
+
+    def stream_llm(self, prompt: str, json_out: bool = False) -> Iterator[str]:
+        """
+        ask_llm as a generator of tokens. A cached response is yielded in one piece
+        """
+        request = self.build_request(prompt, json_out)
+        key = self.cache_key(request)
+        llm_output = self.cached_output(key, request)
+        if llm_output is not None:
+            self.record_call(request, llm_output, cached=True)
+            yield llm_output
+        else:
+            start = time.perf_counter()
+            tokens = []
+            for chunk in self.openai_client.chat.completions.create(**request, stream=True):
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                tokens.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            llm_output = "".join(tokens)
+            # Streamed responses don't report usage, both sides are counted locally
+            self.record_call(request, llm_output, seconds=time.perf_counter() - start)
+            if key is not None:
+                self.response_cache.put(key, request, llm_output)
+        self.record_history(prompt, llm_output)
+
+    async def aask_llm(self, prompt: str, json_out: bool = False):
+        """
+        Same as ask_llm but awaits the async client, so several agents can be asked at once
+        """
+        with get_tracer().span("ask_llm", kind="llm", model=self.model, streamed=False):
+            llm_output = await self.acached_completion(self.build_request(prompt, json_out))
+            self.record_history(prompt, llm_output)
+            return llm_output
+
+    def cache_key(self, request: dict) -> Optional[str]:
+        """
+        Key for the response cache, None if the request shouldn't be cached.
+        Only temperature 0 requests are cached, anything else isn't deterministic
+        """
+        if self.response_cache is None or self.temperature != 0:
+            return None
+        return self.response_cache.make_key(request)
+
+    def cached_output(self, key: Optional[str], request: dict) -> Optional[str]:
+        """
+        Returns the cached response for key, raises ResponseCacheMiss when replaying and there is none
+        """
+        if key is None:
+            return None
+        cached_output = self.response_cache.get(key)
+        if cached_output is None and self.response_cache.replay:
+            raise ResponseCacheMiss(f"No recorded response for a {self.model} request", prompt=request["messages"][-1]["content"])
+        return cached_output
+
+    def cached_completion(self, request: dict) -> str:
+        """
+        Sends the request to the api unless an identical request was answered before
+        """
+        key = self.cache_key(request)
+        cached_output = self.cached_output(key, request)
+        if cached_output is not None:
+            self.record_call(request, cached_output, cached=True)
+            return cached_output
+        start = time.perf_counter()
+        completion = self.openai_client.chat.completions.create(**request)
+        llm_output = completion.choices[0].message.content
+        self.record_call(request, llm_output, usage=completion.usage, seconds=time.perf_counter() - start)
+        if key is not None:
+            self.response_cache.put(key, request, llm_output)
         return llm_output
+
+    async def acached_completion(self, request: dict) -> str:
+        """
+        Async cached_completion
+        """
+        key = self.cache_key(request)
+        cached_output = self.cached_output(key, request)
+        if cached_output is not None:
+            self.record_call(request, cached_output, cached=True)
+            return cached_output
+        start = time.perf_counter()
+        completion = await self.async_openai_client.chat.completions.create(**request)
+        llm_output = completion.choices[0].message.content
+        self.record_call(request, llm_output, usage=completion.usage, seconds=time.perf_counter() - start)
+        if key is not None:
+            self.response_cache.put(key, request, llm_output)
+        return llm_output
+
+    def record_call(self, request: dict, llm_output: str, usage=None, cached: bool = False, seconds: float = 0.0) -> None:
+        """
+        Logs the tokens a call used, from the api's usage when it's reported, otherwise counted locally
+        """
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = sum(count_tokens(message["content"]) for message in request["messages"])
+            completion_tokens = count_tokens(llm_output)
+        self.token_usage.add(prompt_tokens, completion_tokens, cached=cached)
+        if not cached:
+            get_tracer().annotate(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        get_tracer().annotate(cached=cached)
+        self.logger.debug(
+            f"LLM call model={self.model} prompt_tokens={prompt_tokens} completion_tokens={completion_tokens} "
+            f"cached={cached} seconds={seconds:.2f}"
+        )
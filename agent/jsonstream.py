@@ -0,0 +1,134 @@
+"""
+Incremental parsing of a streamed json object, so callers can act on a field as
+soon as its value is complete instead of waiting for the whole response.
+"""
+import json
+from typing import Callable, Optional
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonFieldStream:
+    """
+    Fed the tokens of a json object as they arrive. on_field(key, value) is called once per top
+    level field when its value is complete. The decoded text of the string field text_field is
+    passed to on_text as it arrives, for rendering an answer while it's being written
+    """
+
+    def __init__(
+        self,
+        on_field: Optional[Callable[[str, object], None]] = None,
+        text_field: Optional[str] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+    ):
+        self.on_field = on_field
+        self.text_field = text_field
+        self.on_text = on_text
+        self.fields: dict = {}
+        self.raw: list[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.unicode_digits: Optional[str] = None
+        self.expect_key = False
+        self.key_start: Optional[int] = None
+        self.current_key: Optional[str] = None
+        self.value_start: Optional[int] = None
+        self.streaming_text = False
+        self.pending_text: list[str] = []
+
+    def feed(self, text: str) -> None:
+        """
+        Consumes the next chunk of the response
+        """
+        for char in text:
+            self.feed_char(char)
+        if self.pending_text and self.on_text is not None:
+            self.on_text("".join(self.pending_text))
+        self.pending_text = []
+
+    def feed_char(self, char: str) -> None:
+        position = len(self.raw)
+        self.raw.append(char)
+        if self.in_string:
+            self.string_char(char, position)
+            return
+        if char == '"':
+            self.in_string = True
+            if self.depth == 1 and self.expect_key:
+                self.key_start = position
+            elif (
+                self.depth == 1
+                and self.value_start is not None
+                and self.current_key == self.text_field
+                and not "".join(self.raw[self.value_start:position]).strip()
+            ):
+                self.streaming_text = True
+        elif char in "{[":
+            self.depth += 1
+            if self.depth == 1:
+                self.expect_key = True
+        elif char in "}]":
+            if self.depth == 1:
+                self.complete_value(position)
+            self.depth -= 1
+        elif self.depth == 1:
+            if char == ",":
+                self.complete_value(position)
+                self.expect_key = True
+            elif char == ":":
+                self.value_start = position + 1
+
+    def string_char(self, char: str, position: int) -> None:
+        """
+        Handles a character inside a string, decoding escapes for the streamed text field
+        """
+        if self.unicode_digits is not None:
+            self.unicode_digits += char
+            if len(self.unicode_digits) == 4:
+                try:
+                    self.emit(chr(int(self.unicode_digits, 16)))
+                except ValueError:
+                    pass
+                self.unicode_digits = None
+            return
+        if self.escape:
+            self.escape = False
+            if char == "u":
+                self.unicode_digits = ""
+            else:
+                self.emit(ESCAPES.get(char, char))
+            return
+        if char == "\\":
+            self.escape = True
+            return
+        if char == '"':
+            self.in_string = False
+            self.streaming_text = False
+            if self.key_start is not None:
+                self.current_key = json.loads("".join(self.raw[self.key_start:position + 1]))
+                self.key_start = None
+                self.expect_key = False
+            return
+        self.emit(char)
+
+    def emit(self, text: str) -> None:
+        if self.streaming_text:
+            self.pending_text.append(text)
+
+    def complete_value(self, position: int) -> None:
+        """
+        Called on the ',' or '}' ending a top level value
+        """
+        if self.current_key is not None and self.value_start is not None:
+            value_text = "".join(self.raw[self.value_start:position]).strip()
+            try:
+                value = json.loads(value_text)
+            except ValueError:
+                value = None
+            else:
+                self.fields[self.current_key] = value
+                if self.on_field is not None:
+                    self.on_field(self.current_key, value)
+        self.current_key = None
+        self.value_start = None
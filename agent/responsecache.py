@@ -0,0 +1,129 @@
+"""
+Response cache for Agent.ask_llm. Requests are keyed by a hash of everything sent
+to the api, so an identical temperature 0 request is answered without a call.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+class ResponseCacheMiss(Exception):
+    """
+    Raised in replay mode when a request was never recorded, prompt is the request's last user message
+    """
+
+    def __init__(self, message: str, prompt: str = ""):
+        super().__init__(message)
+        self.prompt = prompt
+
+
+@dataclass
+class ResponseCacheStats:
+    """
+    Counters for the response cache
+    """
+    hits: int = 0
+    misses: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"llm cache hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2f}"
+
+
+class ResponseCache:
+    """
+    In memory LRU of completions, optionally backed by SQLite at persist_path so responses
+    survive restarts. With replay, requests that aren't cached raise ResponseCacheMiss
+    instead of going to the api, for running offline against recorded answers.
+    """
+
+    def __init__(self, max_entries: int = 1024, persist_path: Optional[str] = None, replay: bool = False):
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.replay = replay
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.stats = ResponseCacheStats()
+        self._lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        if persist_path:
+            self.conn = sqlite3.connect(persist_path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, request TEXT, response TEXT, created_at REAL)"
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        """
+        Hash of the full request, messages, model, temperature and response format
+        """
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, response: str) -> None:
+        """
+        Adds to the in memory LRU, caller must hold the lock
+        """
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response, checking memory first and then SQLite
+        """
+        with self._lock:
+            response = self.entries.get(key)
+            if response is None and self.conn is not None:
+                row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    response = row[0]
+            if response is None:
+                self.stats.misses += 1
+                return None
+            self._remember(key, response)
+            self.stats.hits += 1
+            return response
+
+    def put(self, key: str, request: dict, response: str) -> None:
+        """
+        Stores a response in memory and, if persistent, in SQLite
+        """
+        with self._lock:
+            self._remember(key, response)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, request, response, created_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(request), response, time.time()),
+                )
+                self.conn.commit()
+
+    def close(self) -> None:
+        """
+        Closes the SQLite connection if persistent
+        """
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def __enter__(self):
+        """
+        Enter context manager, return self.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Exit context manager, close the SQLite connection.
+        """
+        self.close()
@@ -1,16 +1,31 @@
 import os
 import json
 import sys
+import time
+import asyncio
+import contextvars
+import math
 
-from collections import deque, defaultdict
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from colorama import Fore
 from colorama import init as initialize_colorama
 from enum import Enum
-from netmiko import ConnectHandler
-from tenacity import retry, stop_after_attempt
 from typing import Optional
 from agent.agent import Agent
+from agent.responsecache import ResponseCacheMiss
+from agent.jsonstream import JsonFieldStream
+from command_cache.commandcache import CommandCache
+from connection_pool.connectionpool import ConnectionPool
 from vector_store.vectorstoreinterface import VectorStoreInterface
+from vector_store.commandindex import CommandIndex
+from vector_store.reranker import Reranker
+from agentic_flow.semanticcache import QuestionPlan, SemanticCache
+from token_budget.tokenbudget import TokenBudget, count_tokens
+from tracing.tracer import get_tracer
+
+tracer = get_tracer()
 
 
 class BotChoice(Enum):
@@ -24,6 +39,7 @@ class BotChoice(Enum):
     multipart_q_agent = ("🖖", Fore.CYAN, "Question Parser Agent")
     device_answer_agent = ("🤓", Fore.LIGHTRED_EX, "Device Answer Agent")
     combined_answer_agent = ("🧐", Fore.LIGHTGREEN_EX, "Combined Answer Agent")
+    semantic_cache = ("⚡", Fore.LIGHTYELLOW_EX, "Answer Cache")
 
 class AgenticFlow:
     def __init__(
@@ -37,6 +53,17 @@ class AgenticFlow:
         device_answer_agent: Agent,
         combined_answer_agent: Agent,
         show_cmd_store: VectorStoreInterface,
+        max_concurrency: int = 1,
+        device_timeout: int = 20,
+        connection_pool: Optional[ConnectionPool] = None,
+        command_cache: Optional[CommandCache] = None,
+        command_index: Optional[CommandIndex] = None,
+        reranker: Optional[Reranker] = None,
+        rerank_threshold: float = 0.9,
+        semantic_cache: Optional[SemanticCache] = None,
+        concurrent_steps: bool = False,
+        stream_output: bool = False,
+        token_budget: Optional[TokenBudget] = None,
     ):
         self.show_cmd_store_agent = show_cmd_store_agent
         self.selected_command_validator_agent = selected_command_validator_agent
@@ -47,7 +74,21 @@ class AgenticFlow:
         self.device_answer_agent = device_answer_agent
         self.combined_answer_agent = combined_answer_agent
         self.show_cmd_store = show_cmd_store
-        self.command_cache = defaultdict(dict)
+        self.command_index = command_index if command_index is not None else CommandIndex.from_vector_store(show_cmd_store)
+        self.reranker = reranker
+        self.rerank_threshold = rerank_threshold
+        self.semantic_cache = semantic_cache
+        if semantic_cache is not None:
+            semantic_cache.device_names.update(name.lower() for name, _ in self.load_topology() if name)
+        self.command_cache = command_cache if command_cache is not None else CommandCache()
+        self.max_concurrency = max(1, max_concurrency)
+        self.device_timeout = device_timeout
+        self.connection_pool = connection_pool if connection_pool is not None else ConnectionPool(connect_timeout=device_timeout)
+        self.concurrent_steps = concurrent_steps
+        self.stream_output = stream_output
+        self.token_budget = token_budget if token_budget is not None else TokenBudget()
+        # One loop for the life of the flow, the async openai clients are bound to the loop they first ran on
+        self.event_loop = asyncio.new_event_loop() if concurrent_steps else None
 
         self.qa_combined = {"q_and_a": []}
         self.question_queue: deque = deque()
@@ -64,12 +105,34 @@ class AgenticFlow:
         print(bot.value[1], f"{bot.value[0]} ({bot.value[2]}): {output}")
         print("-"*20)
 
+    @staticmethod
+    @contextmanager
+    def chatbot_stream(bot: BotChoice):
+        """
+        Same as chatbot_experience, but yields a function that prints text as it arrives
+        """
+        print(bot.value[1], f"{bot.value[0]} ({bot.value[2]}): ", end="", flush=True)
+
+        def write(text: str):
+            print(text, end="", flush=True)
+
+        try:
+            yield write
+        finally:
+            print()
+            print("-"*20)
+
     def accept_user_input(self) -> str:
         """
         Depending on the provided UserInputOption, call a function to get input
         """
-        print(Fore.LIGHTYELLOW_EX, "What can I tell you about your network today?")
+        print(Fore.LIGHTYELLOW_EX, "What can I tell you about your network today? (/invalidate [device] clears cached command output)")
         user_input = input(">> ")
+        if user_input.startswith("/invalidate"):
+            device_name = user_input[len("/invalidate"):].strip() or None
+            removed = self.command_cache.invalidate(device_name)
+            print(Fore.LIGHTYELLOW_EX, f"Cleared {removed} cached command outputs for {device_name or 'all devices'}")
+            return self.accept_user_input()
         if user_input:
             return user_input
         
@@ -92,6 +155,7 @@ class AgenticFlow:
         self.logger.debug(f"llm response - {llm_output_json}")
         return (llm_output_json.get("question_and_summary"), llm_output_json.get("more_questions"))
 
+    @tracer.traced("question_to_command")
     def question_to_command(self, target_question: str, command_count: int) -> str:
         """
         Asks the show_cmd_store_agent what command best matches the input provided
@@ -105,6 +169,14 @@ class AgenticFlow:
             self.chatbot_experience(bot, f"I'm going to try to pick a command to best answer this question - {target_question}")
         sim_search_results = self.show_cmd_store.invoke(target_question, k_document_count=command_count)
         self.logger.debug(f"Results found for question {target_question} -- {sim_search_results}")
+        if self.reranker is not None and sim_search_results:
+            ranked = self.reranker.rerank(target_question, sim_search_results)
+            self.logger.debug(f"Reranked - {[(r.command, round(r.score, 3), round(r.confidence, 3)) for r in ranked]}")
+            # Only trust the reranker on the first attempt, a rejected command would just be picked again
+            if not self.show_cmd_store_agent.history and ranked[0].confidence >= self.rerank_threshold:
+                self.chatbot_experience(bot, f"I'm confident this is the right command, skipping straight to peer review - {ranked[0].command}")
+                return ranked[0].command
+            sim_search_results = [ranked_command.document for ranked_command in ranked]
         commands = [doc.metadata["command"] for doc in sim_search_results]
         self.chatbot_experience(bot, f"Choosing the best command from the following list - {commands}")
         if command_count == 110:
@@ -113,18 +185,35 @@ class AgenticFlow:
             query=target_question, commands=str(commands)
         )
         self.logger.debug(f"Agent query - {llm_query}")
-        llm_output = self.show_cmd_store_agent.ask_llm(
-            llm_query, json_out=True)
+
+        def announce_field(key: str, value):
+            if key == "selected_command":
+                self.chatbot_experience(bot, f"I'll pass this command and all it's documentation for a peer review - {value}")
+
+        if self.stream_output:
+            # Announce the command as soon as its field is complete, not when the whole response is
+            json_stream = JsonFieldStream(on_field=announce_field)
+            llm_output = self.show_cmd_store_agent.ask_llm(llm_query, json_out=True, on_token=json_stream.feed)
+        else:
+            llm_output = self.show_cmd_store_agent.ask_llm(
+                llm_query, json_out=True)
 
         llm_output_json: dict = json.loads(llm_output)
-        self.chatbot_experience(bot, f"I'll pass this command and all it's documentation for a peer review - {llm_output_json.get('selected_command')}")
+        if not self.stream_output:
+            announce_field("selected_command", llm_output_json.get("selected_command"))
         self.logger.debug(f"llm response - {llm_output_json}")
         return llm_output_json.get("selected_command")
 
+    @tracer.traced("command_to_docs")
     def command_to_docs(self, command: str) -> str:
         """
         Finds the documentation that matches the selected command
+        Uses the command index, only falls back to the vector store if nothing is close
         """
+        command_document = self.command_index.lookup(command)
+        if command_document is not None:
+            self.logger.debug(f"Command - {command} \n Docs - {command_document.page_content}")
+            return command_document.page_content
 
         db_query_filter = {
             "command": {
@@ -136,25 +225,52 @@ class AgenticFlow:
         self.logger.debug(f"Command - {command} \n Docs - {command_documentation[0].page_content}")
         return command_documentation[0].page_content
 
-    def question_to_device_list(self, target_question: str) -> list[tuple]:
+    def load_topology(self) -> list[tuple]:
         """
-        Asks the topology agent to determine which devices in our topology are being requested
+        (device_name, ip_address) of every device in the topology file
+        """
+        with open(self.topology_file_path, "r") as topo_file:
+            topology_json = json.loads(topo_file.read())
+        return [(values.get("device_name"), values.get("ip_address")) for values in topology_json.get("topology")]
+
+    def topology_query(self, target_question: str) -> str:
+        """
+        Builds the topology agent's query from the question and the devices in the topology file
         """
         self.logger.debug("topology agent called")
         self.logger.debug(f"Target question - {target_question}")
         bot = BotChoice.topology_agent
         self.chatbot_experience(bot, "Hi! I'm going to take the query and extract the exact network devices that are referenced.")
-        with open(self.topology_file_path, "r") as topo_file:
-            topology_json = json.loads(topo_file.read())
-            topology = [(values.get("device_name"), values.get("ip_address")) for values in topology_json.get("topology")]
-        topology_agent_query = self.topology_agent.generate_query(question=target_question, topology=topology)
+        topology_agent_query = self.topology_agent.generate_query(question=target_question, topology=self.load_topology())
         self.logger.debug(f"Agent query - {topology_agent_query}")
-        llm_out = self.topology_agent.ask_llm(topology_agent_query, json_out=True)
+        return topology_agent_query
+
+    def parse_device_list(self, llm_out: str) -> list[tuple]:
+        """
+        Pulls the devices out of the topology agent's response
+        """
         llm_output_json: dict = json.loads(llm_out)
-        self.chatbot_experience(bot, f"We'll be running the commands on these devices - {llm_output_json.get('devices')}")
+        self.chatbot_experience(BotChoice.topology_agent, f"We'll be running the commands on these devices - {llm_output_json.get('devices')}")
         self.logger.debug(f"llm response - {llm_output_json}")
         return llm_output_json.get("devices")
 
+    @tracer.traced("question_to_device_list")
+    def question_to_device_list(self, target_question: str) -> list[tuple]:
+        """
+        Asks the topology agent to determine which devices in our topology are being requested
+        """
+        llm_out = self.topology_agent.ask_llm(self.topology_query(target_question), json_out=True)
+        return self.parse_device_list(llm_out)
+
+    @tracer.traced("question_to_device_list")
+    async def aquestion_to_device_list(self, target_question: str) -> list[tuple]:
+        """
+        Async question_to_device_list
+        """
+        llm_out = await self.topology_agent.aask_llm(self.topology_query(target_question), json_out=True)
+        return self.parse_device_list(llm_out)
+
+    @tracer.traced("get_precise_command")
     def get_precise_command(self, target_question: str, documentation: str) -> str:
         """
         Asks the command creator agent to determine the precise syntax that should be used
@@ -162,7 +278,7 @@ class AgenticFlow:
         """
         bot = BotChoice.cmd_creator_agent
         self.chatbot_experience(bot, "I'm going to take the command documentation, and build the exact command structure for the device")
-        cmd_creator_agent_query = self.cmd_creator_agent.generate_query(question=target_question, documentation=documentation)
+        cmd_creator_agent_query = self.cmd_creator_agent.generate_query(question=target_question, documentation=self.budget_documentation(documentation))
         self.logger.debug(f"Agent query - {cmd_creator_agent_query}")
         llm_out = self.cmd_creator_agent.ask_llm(cmd_creator_agent_query, json_out=True)
         llm_output_json: dict = json.loads(llm_out)
@@ -170,46 +286,84 @@ class AgenticFlow:
         self.logger.debug(f"llm response - {llm_output_json}")
         return llm_output_json.get("precise_command")
 
-    @retry(stop=stop_after_attempt(2))
+    @tracer.traced("execute_command_on_device", kind="device")
     def execute_command_on_device(self, command: str, device: str) -> str:
         """
-        Connects to the required device, sends the command requested
+        Sends the command requested to the device over a pooled session,
+        the pool retries once if the session drops
         """
-        cached_command = self.command_cache.get(device[0], {}).get(command)
-        if cached_command:
+        cached_command = self.command_cache.get(device[0], command)
+        tracer.annotate(device=device[0], command=command, cache_hit=cached_command is not None)
+        if cached_command is not None:
             self.logger.debug(f"Found command output in command cache")
             print(Fore.YELLOW, f"Found the cached command output for - '{command}' on device {device[0]}")
             return cached_command
         print(Fore.YELLOW, f"Running the command '{command}' on device {device[0]}, This may take some time")
-        connect_data = {
-            "device_type": "cisco_ios",
-            "host": device[1],
-            "username": os.getenv("DEVICE_USERNAME"),
-            "password": os.getenv("DEVICE_PASSWORD"),
-            'timeout': 20,
-        }
-        with ConnectHandler(**connect_data) as conn:
-            output = conn.send_command(command, read_timeout=20)
+        output = self.connection_pool.send_command(device, command, read_timeout=self.device_timeout)
         self.logger.debug(f"Device output {output}")
-        self.command_cache[device[0]][command] = output
+        self.command_cache.set(device[0], command, output)
         return output
 
-    def answer_subquestion(self, target_question: str, documentation: str, command_output: str) -> tuple[str]:
+    def budget_documentation(self, documentation: str) -> str:
         """
-        Uses the question answerer agent to use command output + documentation + original query
-        to come up with a real solution to the problem
+        Cuts documentation down to the token budget, keeping the syntax, modes and examples first
+        """
+        compacted = self.token_budget.compact_documentation(documentation)
+        if compacted is not documentation:
+            self.logger.info(f"Documentation compacted from {count_tokens(documentation)} to {count_tokens(compacted)} tokens")
+        return compacted
+
+    def budget_command_output(self, command_output: str, target_question: str) -> str:
+        """
+        Cuts device output down to the token budget, keeping the parts relevant to the question
+        """
+        compacted = self.token_budget.compact_command_output(command_output, target_question)
+        if compacted is not command_output:
+            self.logger.info(f"Command output compacted from {count_tokens(command_output)} to {count_tokens(compacted)} tokens")
+        return compacted
+
+    def answer_query(self, target_question: str, documentation: str, command_output: str) -> str:
+        """
+        Builds the device answer agent's query from the question, documentation and command output
         """
         self.logger.debug("question answerer agent called")
         self.logger.debug(f"target_question - {target_question}\n documentation - {documentation}\n command_output - {command_output}")
         bot = BotChoice.device_answer_agent
         self.chatbot_experience(bot, "Okay, I'm going to take the output from the network devices, documentation, and your question. My goal is to answer this subquestion to help a future agent formulate a complete answer.")
-        question_answerer_query = self.device_answer_agent.generate_query(question=target_question, documentation=documentation, command_output=command_output)
+        question_answerer_query = self.device_answer_agent.generate_query(
+            question=target_question,
+            documentation=self.budget_documentation(documentation),
+            command_output=self.budget_command_output(command_output, target_question),
+        )
         self.logger.debug(f"Agent query - {question_answerer_query}")
-        llm_out = self.device_answer_agent.ask_llm(question_answerer_query, json_out=True)
+        return question_answerer_query
+
+    def parse_answer(self, llm_out: str) -> tuple[str]:
+        """
+        Pulls the answer and whether more questions are needed out of the device answer agent's response
+        """
         llm_output_json: dict = json.loads(llm_out)
         self.logger.debug(f"llm response - {llm_output_json}")
         return (llm_output_json.get("answer"), llm_output_json.get("more_questions"))
 
+    @tracer.traced("answer_subquestion")
+    def answer_subquestion(self, target_question: str, documentation: str, command_output: str) -> tuple[str]:
+        """
+        Uses the question answerer agent to use command output + documentation + original query
+        to come up with a real solution to the problem
+        """
+        llm_out = self.device_answer_agent.ask_llm(self.answer_query(target_question, documentation, command_output), json_out=True)
+        return self.parse_answer(llm_out)
+
+    @tracer.traced("answer_subquestion")
+    async def aanswer_subquestion(self, target_question: str, documentation: str, command_output: str) -> tuple[str]:
+        """
+        Async answer_subquestion
+        """
+        llm_out = await self.device_answer_agent.aask_llm(self.answer_query(target_question, documentation, command_output), json_out=True)
+        return self.parse_answer(llm_out)
+
+    @tracer.traced("validate_command")
     def validate_command(self, target_question: str, documentation: str) -> bool:
         """
         Takes the question along with documentation, determines if the selected command can give
@@ -220,7 +374,7 @@ class AgenticFlow:
         bot = BotChoice.selected_command_validator_agent
         self.chatbot_experience(bot, f"I'm going to look at the documentation and command, and I'll let you know if this command if good enough")
         self.logger.debug("Validation question %s", target_question)
-        selected_command_validator_agent_query = self.selected_command_validator_agent.generate_query(question=target_question, documentation=documentation)
+        selected_command_validator_agent_query = self.selected_command_validator_agent.generate_query(question=target_question, documentation=self.budget_documentation(documentation))
         llm_out = self.selected_command_validator_agent.ask_llm(selected_command_validator_agent_query, json_out=True)
         llm_output_json: dict = json.loads(llm_out)
         self.logger.debug(f"llm response - {llm_output_json}")
@@ -228,9 +382,11 @@ class AgenticFlow:
             self.chatbot_experience(bot, "Hmmm... Looks like the command wasn't quite up to par... going to have our team try again")
         return llm_output_json.get("valid_command")
 
-    def per_question_flow(self, target_question: str):
+    @tracer.traced("select_command")
+    def select_command(self, target_question: str) -> tuple[str, str]:
         """
-        Once initial questions are found, begin flow per question
+        Picks and validates a command then builds the precise command.
+        Returns (precise_command, documentation)
         """
         valid_command = False
         command_count = 10
@@ -258,20 +414,244 @@ class AgenticFlow:
         self.show_cmd_store_agent.history = []
         precise_command = self.get_precise_command(target_question, documentation)
         self.logger.debug(f"Precise command selected -> {precise_command}")
+        return precise_command, documentation
+
+    def plan_question(self, target_question: str) -> tuple[str, str, list]:
+        """
+        Selects the command then picks the devices.
+        Returns (precise_command, documentation, device_list)
+        """
+        precise_command, documentation = self.select_command(target_question)
         device_list = self.question_to_device_list(target_question)
-        for device in device_list:
-            command_output = self.execute_command_on_device(precise_command, device)
-        
-            answer = self.answer_subquestion(target_question, documentation, command_output)
-            self.qa_combined["q_and_a"].append({
-                "device_in_question": device[0],
-                "question": target_question,
-                "answer": answer
-            })
-
-            self.logger.debug(f"Chosen command - {precise_command}")
-            self.logger.debug(f"Device in question: {device[0]}, Question: {target_question}, Answer: {answer}")
-        
+        return precise_command, documentation, device_list
+
+    async def aplan_question(self, target_question: str, step_seconds: dict) -> tuple[str, str, list]:
+        """
+        plan_question with the topology agent running while the command is selected, the devices
+        don't depend on the command. Command selection stays sync in a worker thread
+        """
+        (precise_command, documentation), device_list = await asyncio.gather(
+            self.timed_step("command selection", asyncio.to_thread(self.select_command, target_question), step_seconds),
+            self.timed_step("device selection", self.aquestion_to_device_list(target_question), step_seconds),
+        )
+        return precise_command, documentation, device_list
+
+    @staticmethod
+    async def timed_step(step: str, awaitable, step_seconds: dict):
+        """
+        Awaits a step and records how long it took
+        """
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            step_seconds[step] = time.perf_counter() - start
+
+    @tracer.traced("lookup_cached_plan")
+    def lookup_cached_plan(self, target_question: str) -> Optional[QuestionPlan]:
+        """
+        Returns a similar earlier question's plan from the semantic cache, if any.
+        Only its command is reused, the devices are always picked for the new question
+        """
+        cached_plan = None
+        if self.semantic_cache is not None:
+            cached_plan, similarity = self.semantic_cache.lookup(target_question)
+            self.logger.debug(f"Semantic cache lookup similarity {similarity:.3f} - {self.semantic_cache.stats.summary()}")
+        if cached_plan is not None:
+            self.chatbot_experience(
+                BotChoice.semantic_cache,
+                f"This looks like an earlier question ({similarity:.2f} similar) - '{cached_plan.question}'. "
+                f"Reusing the command '{cached_plan.precise_command}'"
+            )
+        return cached_plan
+
+    def per_question_flow(self, target_question: str):
+        """
+        Once initial questions are found, begin flow per question
+        A similar earlier question's command is reused from the semantic cache when possible
+        """
+        cached_plan = self.lookup_cached_plan(target_question)
+        if self.concurrent_steps:
+            results = self.event_loop.run_until_complete(self.aper_question_flow(target_question, cached_plan))
+        else:
+            if cached_plan is not None:
+                precise_command, documentation = cached_plan.precise_command, cached_plan.documentation
+                device_list = self.question_to_device_list(target_question)
+            else:
+                precise_command, documentation, device_list = self.plan_question(target_question)
+                if self.semantic_cache is not None:
+                    self.semantic_cache.add(target_question, precise_command, documentation)
+            results = self.run_on_devices(target_question, documentation, precise_command, device_list)
+        self.qa_combined["q_and_a"].extend(results)
+
+    async def aper_question_flow(self, target_question: str, cached_plan: Optional[QuestionPlan]) -> list[dict]:
+        """
+        per_question_flow with independent steps overlapped. Reports how long the question took
+        against the sum of its steps' timings, an estimate of running them one after another
+        """
+        step_seconds: dict[str, float] = {}
+        start = time.perf_counter()
+        if cached_plan is not None:
+            precise_command, documentation = cached_plan.precise_command, cached_plan.documentation
+            device_list = await self.timed_step("device selection", self.aquestion_to_device_list(target_question), step_seconds)
+        else:
+            precise_command, documentation, device_list = await self.aplan_question(target_question, step_seconds)
+            if self.semantic_cache is not None:
+                await asyncio.to_thread(self.semantic_cache.add, target_question, precise_command, documentation)
+        results = await self.arun_on_devices(target_question, documentation, precise_command, device_list, step_seconds)
+        wall_seconds = time.perf_counter() - start
+        # Not a measured comparison, the steps' own durations would change if they ran one after another
+        sequential_seconds = sum(step_seconds.values())
+        self.logger.info(f"Step timings - {', '.join(f'{step}={seconds:.2f}s' for step, seconds in step_seconds.items())}")
+        self.logger.info(f"Question took {wall_seconds:.2f}s, sum of step timings {sequential_seconds:.2f}s")
+        print(
+            Fore.LIGHTYELLOW_EX,
+            f"Answered in {wall_seconds:.1f}s, the steps took {sequential_seconds:.1f}s added up "
+            f"(an estimated {max(0.0, sequential_seconds - wall_seconds):.1f}s saved by overlapping them)"
+        )
+        return results
+
+    @tracer.traced("per_device_flow")
+    def per_device_flow(self, target_question: str, documentation: str, precise_command: str, device: tuple) -> dict:
+        """
+        Runs the precise command on a single device and answers the subquestion from its output
+        """
+        command_output = self.execute_command_on_device(precise_command, device)
+        answer = self.answer_subquestion(target_question, documentation, command_output)
+        return self.device_result(target_question, precise_command, device, answer)
+
+    def device_result(self, target_question: str, precise_command: str, device: tuple, answer: tuple) -> dict:
+        """
+        Result for a device that was answered for
+        """
+        self.logger.debug(f"Chosen command - {precise_command}")
+        self.logger.debug(f"Device in question: {device[0]}, Question: {target_question}, Answer: {answer}")
+        return {
+            "device_in_question": device[0],
+            "question": target_question,
+            "answer": answer
+        }
+
+    @tracer.traced("run_on_devices")
+    def run_on_devices(self, target_question: str, documentation: str, precise_command: str, device_list: list) -> list[dict]:
+        """
+        Fans the per device flow out to every selected device, at most max_concurrency at a time.
+        Results are returned in the same order as device_list. A device that fails or isn't done
+        by the run's deadline is reported in its result instead of aborting the rest of the flow.
+        """
+        run_timeout = self.device_run_timeout(len(device_list))
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        futures = [
+            # Each worker gets a copy of the context so its spans nest under this step
+            executor.submit(contextvars.copy_context().run, self.per_device_flow, target_question, documentation, precise_command, device)
+            for device in device_list
+        ]
+        done, _ = wait(futures, timeout=run_timeout)
+        outcomes = [(future.exception() or future.result()) if future in done else None for future in futures]
+        # Queued devices are cancelled, running ones can't be, the executor isn't reused so they don't hold up later questions
+        executor.shutdown(wait=False, cancel_futures=True)
+        return self.collect_device_results(target_question, precise_command, device_list, outcomes, run_timeout)
+
+    def device_run_timeout(self, device_count: int) -> float:
+        """
+        Seconds a whole device run may take. Each device gets connect and read on its session, again
+        if the pool retries a dropped session, plus the answer call. Devices past max_concurrency
+        wait for the ones ahead of them
+        """
+        waves = math.ceil(device_count / self.max_concurrency)
+        return waves * self.device_timeout * 5
+
+    def collect_device_results(self, target_question: str, precise_command: str, device_list: list, outcomes: list, run_timeout: float) -> list[dict]:
+        """
+        Turns each device's outcome, its result, the exception it raised or None if it didn't finish
+        in time, into the device's result and reports the devices that failed
+        """
+        results = []
+        failed_devices = []
+        for device, outcome in zip(device_list, outcomes):
+            if outcome is None:
+                self.logger.error(f"Timed out waiting on device {device[0]}")
+                failed_devices.append(device[0])
+                results.append(self.failed_result(target_question, device, f"device run timed out after {run_timeout:g} seconds"))
+            elif isinstance(outcome, BaseException):
+                self.logger.error(f"Failed to run '{precise_command}' on device {device[0]} - {outcome}")
+                failed_devices.append(device[0])
+                results.append(self.failed_result(target_question, device, f"error - {outcome}"))
+            else:
+                results.append(outcome)
+        self.log_device_run(device_list, failed_devices)
+        return results
+
+    @tracer.traced("per_device_flow")
+    async def aper_device_flow(self, target_question: str, documentation: str, precise_command: str, device: tuple, executor: ThreadPoolExecutor) -> dict:
+        """
+        Async per_device_flow, the device session stays sync in one of executor's threads
+        """
+        command_output = await asyncio.get_running_loop().run_in_executor(
+            executor, contextvars.copy_context().run, self.execute_command_on_device, precise_command, device)
+        answer = await self.aanswer_subquestion(target_question, documentation, command_output)
+        return self.device_result(target_question, precise_command, device, answer)
+
+    @tracer.traced("run_on_devices")
+    async def arun_on_devices(self, target_question: str, documentation: str, precise_command: str, device_list: list, step_seconds: dict) -> list[dict]:
+        """
+        Async run_on_devices, every device's command and answer call overlap, at most max_concurrency at a time.
+        Device sessions run on an executor of max_concurrency threads made for this run, so a device never
+        waits on a thread still busy with a device that timed out earlier
+        """
+        run_timeout = self.device_run_timeout(len(device_list))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        async def run_device(device: tuple) -> dict:
+            async with semaphore:
+                return await self.timed_step(
+                    f"device {device[0]}",
+                    self.aper_device_flow(target_question, documentation, precise_command, device, executor),
+                    step_seconds,
+                )
+
+        tasks = [asyncio.ensure_future(run_device(device)) for device in device_list]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=run_timeout) if tasks else (set(), set())
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            outcomes = [(task.exception() or task.result()) if task in done else None for task in tasks]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self.collect_device_results(target_question, precise_command, device_list, outcomes, run_timeout)
+
+    @staticmethod
+    def failed_result(target_question: str, device: tuple, reason: str) -> dict:
+        """
+        Result for a device that couldn't be answered for
+        """
+        return {
+            "device_in_question": device[0],
+            "question": target_question,
+            "answer": (f"Failed to get an answer, {reason}", False)
+        }
+
+    def log_device_run(self, device_list: list, failed_devices: list) -> None:
+        """
+        Reports failed devices and the session and command cache stats after a device run
+        """
+        if failed_devices:
+            print(Fore.YELLOW, f"Could not collect output from {len(failed_devices)}/{len(device_list)} devices - {failed_devices}")
+        self.logger.info(f"Connection pool stats - {self.connection_pool.stats.summary()}")
+        self.logger.info(f"Command cache stats - {self.command_cache.stats.summary()}")
+
+    def log_token_usage(self) -> None:
+        """
+        Logs the running token totals of every agent
+        """
+        for bot in BotChoice:
+            agent = getattr(self, bot.name, None)
+            if isinstance(agent, Agent):
+                self.logger.info(f"Token usage {bot.value[2]} - {agent.token_usage.summary()}")
+
+    @tracer.traced("get_final_answer")
     def get_final_answer(self, initial_query: str) -> str:
         """
         Uses the combination of all previous questions and answers to final provide a clear answer in the end
@@ -279,11 +659,37 @@ class AgenticFlow:
         bot = BotChoice.combined_answer_agent
         self.chatbot_experience(bot, f"I'm going to look at all the previous answers given, and give you a final answer to your question - {initial_query}!")
         combined_answer_agent_query = self.combined_answer_agent.generate_query(query=initial_query, subquestions_and_answers=json.dumps(self.qa_combined))
-        llm_out = self.combined_answer_agent.ask_llm(combined_answer_agent_query, json_out=True)
-        llm_out_json: dict = json.loads(llm_out)
-        self.chatbot_experience(bot, llm_out_json.get("answer"))
+        if self.stream_output:
+            with self.chatbot_stream(bot) as write:
+                json_stream = JsonFieldStream(text_field="answer", on_text=write)
+                llm_out = self.combined_answer_agent.ask_llm(combined_answer_agent_query, json_out=True, on_token=json_stream.feed)
+            llm_out_json: dict = json.loads(llm_out)
+        else:
+            llm_out = self.combined_answer_agent.ask_llm(combined_answer_agent_query, json_out=True)
+            llm_out_json: dict = json.loads(llm_out)
+            self.chatbot_experience(bot, llm_out_json.get("answer"))
         return llm_out_json.get("answer")
 
+    def close(self) -> None:
+        """
+        Closes the flow's event loop, if it has one. Safe to call more than once
+        """
+        if self.event_loop is not None and not self.event_loop.is_closed():
+            self.event_loop.run_until_complete(self.event_loop.shutdown_default_executor())
+            self.event_loop.close()
+
+    def __enter__(self):
+        """
+        Enter context manager, return self.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Exit context manager, closes the event loop.
+        """
+        self.close()
+
     def initiate_flow(
         self, initial_query: str = None, qa_pairs: Optional[dict]=None
     ) -> str:
@@ -300,10 +706,25 @@ class AgenticFlow:
         while self.question_queue:
             self.logger.debug(f"current question queue - {self.question_queue}")
             target_question = self.question_queue.popleft()
-            self.per_question_flow(target_question)
-
-            final_answer = self.get_final_answer(target_question)
+            tracer.start_trace(target_question)
+            try:
+                with tracer.span("question"):
+                    self.per_question_flow(target_question)
+                    final_answer = self.get_final_answer(target_question)
+            except ResponseCacheMiss as exc:
+                tracer.finish_trace()
+                prompt = exc.prompt if len(exc.prompt) <= 500 else f"{exc.prompt[:500]}..."
+                print(Fore.RED, f"Can't answer '{target_question}' from the replayed responses. {exc}, prompt:\n{prompt}")
+                self.logger.error(f"{exc} while answering '{target_question}', prompt - {exc.prompt}")
+                continue
             qa_pairs[target_question] = final_answer
+            trace_summary = tracer.finish_trace()
+            if trace_summary:
+                print(Fore.LIGHTBLACK_EX, f"\n{trace_summary}")
+                self.logger.debug(f"Trace summary\n{trace_summary}")
+            self.log_token_usage()
+            if self.combined_answer_agent.response_cache is not None:
+                self.logger.info(f"LLM response cache stats - {self.combined_answer_agent.response_cache.stats.summary()}")
             # next_question, more_questions = self.breakdown_question(initial_query, qa_pairs)
             # if not more_questions:
             #     sys.exit(0)
@@ -0,0 +1,146 @@
+"""
+Semantic cache for command selection. Similar questions reuse the command an
+earlier question was answered with, device selection, the device commands and
+the answer agents still run for every question.
+"""
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from chromadb.api.types import EmbeddingFunction
+
+# Questions that differ in any of these can't share a command however similar they read
+PROTOCOLS = {
+    "bgp", "ospf", "ospfv3", "eigrp", "isis", "rip", "ripng", "mpls", "ldp", "rsvp", "bfd", "pim", "igmp", "msdp",
+    "hsrp", "vrrp", "glbp", "stp", "rstp", "mst", "vtp", "lacp", "pagp", "lldp", "cdp", "ntp", "snmp", "ssh", "aaa",
+    "tacacs", "radius", "dhcp", "dns", "nat", "acl", "ipsec", "ike", "crypto", "gre", "vxlan", "evpn", "lisp",
+    "qos", "policy-map", "class-map", "vrf", "ipv4", "ipv6", "arp", "nd", "cef", "ip", "mac", "vlan", "sla",
+}
+TERM_PATTERN = re.compile(r"[a-z0-9][a-z0-9./:_-]*")
+
+
+@dataclass
+class QuestionPlan:
+    """
+    Everything the flow decided for a question before touching any device
+    """
+    question: str
+    precise_command: str
+    documentation: str
+    key_terms: frozenset[str]
+    vector: list[float]
+    created_at: float
+
+
+@dataclass
+class SemanticCacheStats:
+    """
+    Counters for the semantic cache
+    """
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    rejections: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return (
+            f"semantic cache hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2f} "
+            f"expirations={self.expirations} rejections={self.rejections}"
+        )
+
+
+def normalize(vector: list[float]) -> list[float]:
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else list(vector)
+
+
+class SemanticCache:
+    """
+    Keeps up to max_entries question plans for ttl seconds. A new question whose embedding has
+    cosine similarity of at least threshold with a cached question reuses that question's plan,
+    as long as both name the same devices, protocols and other identifiers (see key_terms).
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        threshold: float = 0.92,
+        ttl: int = 3600,
+        max_entries: int = 256,
+        device_names: Iterable[str] = (),
+    ):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.plans: OrderedDict[str, QuestionPlan] = OrderedDict()
+        self.stats = SemanticCacheStats()
+        self.device_names = {name.lower() for name in device_names}
+        self._lock = threading.Lock()
+
+    def embed(self, question: str) -> list[float]:
+        return normalize(list(self.embedding_function([question])[0]))
+
+    def key_terms(self, question: str) -> frozenset[str]:
+        """
+        The words of a question that pin down what it asks about, known device names, protocols
+        and anything with a digit in it (R1, Gi0/1, 10.1.1.1, vlan ids)
+        """
+        return frozenset(
+            term for term in TERM_PATTERN.findall(question.lower())
+            if term in self.device_names or term in PROTOCOLS or any(char.isdigit() for char in term)
+        )
+
+    def lookup(self, question: str) -> tuple[Optional[QuestionPlan], float]:
+        """
+        Returns the most similar unexpired plan and its similarity, or (None, best similarity).
+        Plans whose key terms differ from the question's are never returned
+        """
+        vector = self.embed(question)
+        key_terms = self.key_terms(question)
+        now = time.time()
+        best_plan, best_similarity = None, 0.0
+        with self._lock:
+            for key, plan in list(self.plans.items()):
+                if now - plan.created_at > self.ttl:
+                    del self.plans[key]
+                    self.stats.expirations += 1
+                    continue
+                similarity = sum(a * b for a, b in zip(vector, plan.vector))
+                if similarity > best_similarity:
+                    best_plan, best_similarity = plan, similarity
+            if best_plan is not None and best_similarity >= self.threshold:
+                if best_plan.key_terms == key_terms:
+                    self.plans.move_to_end(best_plan.question)
+                    self.stats.hits += 1
+                    return best_plan, best_similarity
+                self.stats.rejections += 1
+            self.stats.misses += 1
+        return None, best_similarity
+
+    def add(self, question: str, precise_command: str, documentation: str) -> None:
+        """
+        Caches a question's plan, evicting the least recently used plan if full
+        """
+        plan = QuestionPlan(
+            question=question,
+            precise_command=precise_command,
+            documentation=documentation,
+            key_terms=self.key_terms(question),
+            vector=self.embed(question),
+            created_at=time.time(),
+        )
+        with self._lock:
+            self.plans[question] = plan
+            self.plans.move_to_end(question)
+            while len(self.plans) > self.max_entries:
+                self.plans.popitem(last=False)
@@ -0,0 +1,118 @@
+"""
+Compares similarity search through Chroma with the in process dense index, query latency
+percentiles and how often the two agree on the top k, unfiltered and filtered to the
+expected command's parent_topic.
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from benchmarks.flow_benchmark import percentile
+from vector_store.denseindex import DenseIndex
+from vector_store.vectorstoreinterface import VectorStoreInterface
+
+
+@dataclass
+class DenseIndexBenchmarkResult:
+    """
+    Both search paths at one k, with or without a metadata filter
+    """
+    k: int
+    filtered: bool
+    chroma_seconds: list[float] = field(default_factory=list)
+    dense_seconds: list[float] = field(default_factory=list)
+    overlaps: list[float] = field(default_factory=list)
+
+    @property
+    def speedup(self) -> float:
+        dense = percentile(self.dense_seconds, 50)
+        return percentile(self.chroma_seconds, 50) / dense if dense else 0.0
+
+    @property
+    def overlap(self) -> float:
+        return sum(self.overlaps) / len(self.overlaps) if self.overlaps else 0.0
+
+
+def timed_search(vector_store: VectorStoreInterface, dense: bool, question: str, k: int, metadata_filter: Optional[dict]) -> tuple[float, list[str]]:
+    """
+    Seconds one similarity search took and the ids it returned
+    """
+    vector_store.use_dense_index = dense
+    start = time.perf_counter()
+    documents = vector_store.similarity_invoke(question, metadata_filter, k)
+    return time.perf_counter() - start, [vector_store.document_id(doc) for doc in documents]
+
+
+def run_dense_index_benchmark(
+    vector_store: VectorStoreInterface,
+    labelled_questions: list[dict],
+    k_values: list[int],
+    iterations: int = 3,
+) -> tuple[list[DenseIndexBenchmarkResult], dict]:
+    """
+    Searches every question iterations times at every k through both paths. The question
+    embeddings are computed first so both paths time the search, not the embedding call.
+    Also returns the seconds it took to build the index and to load it back
+    """
+    use_dense_index = vector_store.use_dense_index
+    vector_store.embedding_function([labelled["question"] for labelled in labelled_questions])
+
+    vector_store.invalidate_dense_index()
+    start = time.perf_counter()
+    index = vector_store.get_dense_index()
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    DenseIndex.load(vector_store.dense_index_path)
+    load_seconds = time.perf_counter() - start
+    setup = {"documents": len(index) if index is not None else 0, "build_seconds": build_seconds, "load_seconds": load_seconds}
+    if index is None:
+        return [], setup
+
+    parent_topics = {doc.metadata.get("command"): doc.metadata.get("parent_topic") for doc in index.documents}
+    results = []
+    try:
+        for filtered in (False, True):
+            for k in sorted(k_values):
+                result = DenseIndexBenchmarkResult(k=k, filtered=filtered)
+                for labelled in labelled_questions:
+                    metadata_filter = None
+                    if filtered:
+                        parent_topic = parent_topics.get(labelled["expected_command"])
+                        if parent_topic is None:
+                            continue
+                        metadata_filter = {"parent_topic": {"$eq": parent_topic}}
+                    for _ in range(iterations):
+                        chroma_seconds, chroma_ids = timed_search(vector_store, False, labelled["question"], k, metadata_filter)
+                        dense_seconds, dense_ids = timed_search(vector_store, True, labelled["question"], k, metadata_filter)
+                        result.chroma_seconds.append(chroma_seconds)
+                        result.dense_seconds.append(dense_seconds)
+                    if chroma_ids:
+                        result.overlaps.append(len(set(chroma_ids) & set(dense_ids)) / len(chroma_ids))
+                results.append(result)
+    finally:
+        vector_store.use_dense_index = use_dense_index
+    return results, setup
+
+
+def format_results(results: list[DenseIndexBenchmarkResult], setup: dict) -> str:
+    """
+    Fixed width table, one row per k and filter
+    """
+    header = (
+        f"{'k':>4} {'filter':<12} {'chroma p50':>10} {'chroma p95':>10} "
+        f"{'dense p50':>10} {'dense p95':>10} {'speedup':>8} {'overlap@k':>10}"
+    )
+    lines = [
+        f"Dense index over {setup['documents']} documents, built in {setup['build_seconds']:.2f}s, "
+        f"loaded in {1000 * setup['load_seconds']:.1f}ms. Latencies in ms",
+        header,
+        "-" * len(header),
+    ]
+    for result in results:
+        lines.append(
+            f"{result.k:>4} {'parent_topic' if result.filtered else 'none':<12} "
+            f"{1000 * percentile(result.chroma_seconds, 50):>10.2f} {1000 * percentile(result.chroma_seconds, 95):>10.2f} "
+            f"{1000 * percentile(result.dense_seconds, 50):>10.2f} {1000 * percentile(result.dense_seconds, 95):>10.2f} "
+            f"{result.speedup:>7.1f}x {result.overlap:>10.3f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,217 @@
+"""
+Offline stand-ins for the OpenAI agents, the Chroma store and the network devices,
+so the agent flow can be benchmarked without network access.
+"""
+import asyncio
+import json
+import math
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from chromadb.api.types import EmbeddingFunction
+
+from agent.agent import Agent
+from connection_pool.connectionpool import ConnectionPool
+from token_budget.tokenbudget import TokenUsage
+from vector_store.embeddingbackends import HashingEmbeddingFunction
+from vector_store.vectorstoreinterface import Document, VectorStoreInterface
+
+INVALID_INPUT = "% Invalid input detected at '^' marker."
+
+
+def load_documents(scenarios: dict) -> list[Document]:
+    """
+    Command documents from a scenarios file
+    """
+    return [
+        Document(
+            page_content=doc["documentation"],
+            metadata={"command": doc["command"], "parent_topic": doc["parent_topic"], "child_topic": doc["child_topic"]},
+        )
+        for doc in scenarios["documents"]
+    ]
+
+
+class FakeVectorStore(VectorStoreInterface):
+    """
+    In memory store, similarity search is a dot product over HashingEmbeddingFunction vectors.
+    Supports the {"field": {"$eq": value}} filters the flow uses. Hybrid search goes through
+    the real hybrid_invoke
+    """
+
+    def __init__(self, documents: list[Document], search_type: str = "similarity", latency: float = 0.0, embedding_function: Optional[EmbeddingFunction] = None):
+        self.embedding_function = embedding_function if embedding_function is not None else HashingEmbeddingFunction()
+        self.documents = documents
+        self.vectors = self.embedding_function([doc.page_content for doc in documents])
+        self.search_type = search_type
+        self.latency = latency
+        self.lexical_index = None
+        self.closed = False
+        self.queries = 0
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    def iter_documents(self, page_size: int = 1000):
+        yield from self.documents
+
+    @staticmethod
+    def matches(metadata: dict, metadata_filter: Optional[dict]) -> bool:
+        for key, condition in (metadata_filter or {}).items():
+            expected = condition.get("$eq") if isinstance(condition, dict) else condition
+            if metadata.get(key) != expected:
+                return False
+        return True
+
+    def similarity_invoke(self, query: str, metadata_filter: Optional[dict] = None, k_document_count: int = 2) -> list[Document]:
+        if self.latency:
+            time.sleep(self.latency)
+        self.queries += 1
+        query_vector = self.embedding_function([query])[0]
+        scored = [
+            (sum(a * b for a, b in zip(query_vector, vector)), idx)
+            for idx, (doc, vector) in enumerate(zip(self.documents, self.vectors))
+            if self.matches(doc.metadata, metadata_filter)
+        ]
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [self.documents[idx] for _, idx in scored[:k_document_count]]
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def scripted_response(role: str, scenario: dict, prompt: str) -> dict:
+    """
+    The json an agent in role would answer for scenario
+    """
+    if role == "show_cmd_store_agent":
+        return {"selected_command": scenario["command"]}
+    if role == "selected_command_validator_agent":
+        return {"valid_command": True}
+    if role == "cmd_creator_agent":
+        return {"precise_command": scenario["precise_command"]}
+    if role == "topology_agent":
+        return {"devices": [[device["device_name"], device["ip_address"]] for device in scenario["device_details"]]}
+    if role == "device_answer_agent":
+        return {"answer": f"Answered '{scenario['question']}' from {len(prompt)} characters of prompt", "more_questions": False}
+    if role == "combined_answer_agent":
+        return {"answer": f"Combined answer to '{scenario['question']}'"}
+    return {}
+
+
+class FakeAgent(Agent):
+    """
+    Agent that answers from the scenarios instead of the api, after latency seconds.
+    The scenario is the one whose question is quoted in the prompt, the longest if several are.
+    Uses the real prompt templates, history, response cache and token accounting
+    """
+
+    def __init__(
+        self,
+        role: str,
+        scenarios: list[dict],
+        latency: float = 0.0,
+        query_prompt: str = "",
+        retain_history: bool = False,
+        responder: Callable[[str, dict, str], dict] = scripted_response,
+        stream_chunks: int = 8,
+    ):
+        self.openai_client = None
+        self.async_openai_client = None
+        self.query_prompt = query_prompt
+        self.system_prompt = ""
+        self.few_shot_prompt = []
+        self.model = f"fake-{role}"
+        self.temperature = 0
+        self.retain_history = retain_history
+        self.history: list = []
+        self.response_cache = None
+        self.token_usage = TokenUsage()
+        self.role = role
+        self.scenarios = sorted(scenarios, key=lambda scenario: len(scenario["question"]), reverse=True)
+        self.latency = latency
+        self.responder = responder
+        self.stream_chunks = stream_chunks
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    def respond(self, request: dict) -> str:
+        prompt = request["messages"][-1]["content"]
+        # Prompts quote the question as ```question```, earlier questions in the combined answer's json aren't
+        scenario = next((scenario for scenario in self.scenarios if f"```{scenario['question']}```" in prompt), None)
+        if scenario is None:
+            raise ValueError(f"{self.role} got a prompt that matches no scenario")
+        return json.dumps(self.responder(self.role, scenario, prompt))
+
+    def cached_completion(self, request: dict) -> str:
+        time.sleep(self.latency)
+        llm_output = self.respond(request)
+        self.record_call(request, llm_output, seconds=self.latency)
+        return llm_output
+
+    async def acached_completion(self, request: dict) -> str:
+        await asyncio.sleep(self.latency)
+        llm_output = self.respond(request)
+        self.record_call(request, llm_output, seconds=self.latency)
+        return llm_output
+
+    def stream_llm(self, prompt: str, json_out: bool = False) -> Iterator[str]:
+        request = self.build_request(prompt, json_out)
+        llm_output = self.respond(request)
+        chunk_size = max(1, math.ceil(len(llm_output) / self.stream_chunks))
+        for start in range(0, len(llm_output), chunk_size):
+            time.sleep(self.latency / self.stream_chunks)
+            yield llm_output[start:start + chunk_size]
+        self.record_call(request, llm_output, seconds=self.latency)
+        self.record_history(prompt, llm_output)
+
+
+class FakeConnection:
+    """
+    Simulated netmiko session, returns recorded output after delay seconds
+    """
+
+    def __init__(self, device_name: str, outputs: dict, delay: float, pool: "FakeConnectionPool"):
+        self.device_name = device_name
+        self.outputs = outputs
+        self.delay = delay
+        self.pool = pool
+
+    def send_command(self, command: str, read_timeout: int = 20) -> str:
+        time.sleep(self.delay)
+        self.pool.count_round_trip()
+        return self.outputs.get(self.device_name, {}).get(command.strip(), INVALID_INPUT)
+
+    def is_alive(self) -> bool:
+        return True
+
+    def disconnect(self) -> None:
+        pass
+
+
+class FakeConnectionPool(ConnectionPool):
+    """
+    ConnectionPool whose sessions are FakeConnections, connecting takes connect_delay seconds
+    """
+
+    def __init__(self, outputs: dict, device_delay: float = 0.0, connect_delay: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.outputs = outputs
+        self.device_delay = device_delay
+        self.connect_delay = connect_delay
+        self.round_trips = 0
+        self._round_trip_lock = threading.Lock()
+
+    def connect(self, device: tuple) -> FakeConnection:
+        start = time.perf_counter()
+        time.sleep(self.connect_delay)
+        with self._lock:
+            self.stats.connects += 1
+            self.stats.connect_seconds += time.perf_counter() - start
+        return FakeConnection(device[0], self.outputs, self.device_delay, self)
+
+    def count_round_trip(self) -> None:
+        with self._round_trip_lock:
+            self.round_trips += 1
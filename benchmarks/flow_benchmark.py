@@ -0,0 +1,166 @@
+"""
+Drives AgenticFlow end to end against the offline fakes and reports per question
+latency percentiles, LLM calls and device round trips.
+"""
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from agentic_flow import prompts
+from agentic_flow.agenticflow import AgenticFlow
+from agentic_flow.semanticcache import SemanticCache
+from benchmarks.fakes import FakeAgent, FakeConnectionPool, FakeVectorStore, load_documents
+from command_cache.commandcache import CommandCache
+from vector_store.embeddingbackends import HashingEmbeddingFunction
+
+AGENT_PROMPTS = {
+    "show_cmd_store_agent": prompts.cmd_store_agent_prompt,
+    "selected_command_validator_agent": prompts.selected_command_validator_agent_prompt,
+    "cmd_creator_agent": prompts.cmd_creator_agent_prompt,
+    "multipart_q_agent": prompts.multipart_q_agent_prompt,
+    "topology_agent": prompts.topology_agent_prompt,
+    "device_answer_agent": prompts.device_answer_agent_prompt,
+    "combined_answer_agent": prompts.combined_answer_agent_prompt,
+}
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+@dataclass
+class FlowBenchmarkResult:
+    """
+    Per question measurements for one flow configuration. The first cold_questions entries are
+    the first iteration, asked with empty caches and no open sessions, the rest are warm
+    """
+    label: str
+    question_seconds: list[float] = field(default_factory=list)
+    llm_calls: list[int] = field(default_factory=list)
+    device_round_trips: list[int] = field(default_factory=list)
+    cold_questions: int = 0
+    connects: int = 0
+
+    def phase_summary(self, name: str, start: int, end: Optional[int] = None) -> list[str]:
+        """
+        Report lines for the questions in [start, end)
+        """
+        seconds = self.question_seconds[start:end]
+        if not seconds:
+            return []
+        llm_calls, round_trips = self.llm_calls[start:end], self.device_round_trips[start:end]
+        return [
+            f"  {name}: {len(seconds)} questions",
+            f"    latency mean={sum(seconds) / len(seconds):.3f}s p50={percentile(seconds, 50):.3f}s "
+            f"p95={percentile(seconds, 95):.3f}s p99={percentile(seconds, 99):.3f}s max={max(seconds):.3f}s",
+            f"    llm calls: total={sum(llm_calls)} per question={sum(llm_calls) / len(seconds):.2f}",
+            f"    device round trips: total={sum(round_trips)} per question={sum(round_trips) / len(seconds):.2f}",
+        ]
+
+    def summary(self) -> str:
+        """
+        Human readable report, cold and warm questions are summarised separately
+        """
+        if not self.question_seconds:
+            return f"{self.label}: no questions run"
+        return "\n".join([
+            f"{self.label}",
+            *self.phase_summary("cold (first iteration)", 0, self.cold_questions),
+            *self.phase_summary("warm (later iterations)", self.cold_questions),
+            f"  ssh connects: {self.connects}",
+        ])
+
+
+def load_flow_scenarios(path: str) -> dict:
+    """
+    Reads {"topology": [...], "documents": [...], "outputs": {device: {command: output}}, "questions": [...]}
+    and attaches each question's device details from the topology
+    """
+    with open(path, "r", encoding="UTF-8") as scenarios_file:
+        scenarios = json.load(scenarios_file)
+    devices = {device["device_name"]: device for device in scenarios["topology"]}
+    for question in scenarios["questions"]:
+        question["device_details"] = [devices[name] for name in question["devices"]]
+    return scenarios
+
+
+def run_flow_benchmark(
+    scenarios: dict,
+    iterations: int = 3,
+    llm_latency: float = 0.2,
+    device_delay: float = 0.5,
+    connect_delay: float = 1.0,
+    retrieval_latency: float = 0.05,
+    max_concurrency: int = 10,
+    concurrent_steps: bool = True,
+    command_cache: bool = True,
+    semantic_cache: bool = True,
+    search_type: str = "hybrid",
+) -> FlowBenchmarkResult:
+    """
+    Asks every scenario question iterations times through one fresh flow, so the first
+    iteration runs cold and later ones reuse its caches and sessions. Chat output and info
+    logging are suppressed while the flow runs
+    """
+    label = (
+        f"{'concurrent' if concurrent_steps else 'sequential'} steps, "
+        f"command cache {'on' if command_cache else 'off'}, semantic cache {'on' if semantic_cache else 'off'}, "
+        f"llm {llm_latency}s, device {device_delay}s, connect {connect_delay}s"
+    )
+    questions = scenarios["questions"]
+    result = FlowBenchmarkResult(label=label, cold_questions=len(questions))
+    agents = {
+        role: FakeAgent(role, questions, latency=llm_latency, query_prompt=prompt, retain_history=role == "show_cmd_store_agent")
+        for role, prompt in AGENT_PROMPTS.items()
+    }
+    embedding_function = HashingEmbeddingFunction()
+    store = FakeVectorStore(load_documents(scenarios), search_type=search_type, latency=retrieval_latency, embedding_function=embedding_function)
+    pool = FakeConnectionPool(scenarios["outputs"], device_delay=device_delay, connect_delay=connect_delay)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        topology_file_path = os.path.join(temp_dir, "topology.json")
+        with open(topology_file_path, "w", encoding="UTF-8") as topology_file:
+            json.dump({"topology": scenarios["topology"]}, topology_file)
+
+        flow = AgenticFlow(
+            **agents,
+            topology_file_path=topology_file_path,
+            show_cmd_store=store,
+            max_concurrency=max_concurrency,
+            device_timeout=max(20, int(device_delay * 10)),
+            connection_pool=pool,
+            command_cache=CommandCache() if command_cache else CommandCache(max_bytes=0),
+            semantic_cache=SemanticCache(embedding_function) if semantic_cache else None,
+            concurrent_steps=concurrent_steps,
+        )
+        logging.disable(logging.INFO)
+        try:
+            for _ in range(iterations):
+                for question in questions:
+                    llm_calls_before = sum(agent.token_usage.calls for agent in agents.values())
+                    round_trips_before = pool.round_trips
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        flow.initiate_flow(initial_query=question["question"])
+                    result.question_seconds.append(time.perf_counter() - start)
+                    result.llm_calls.append(sum(agent.token_usage.calls for agent in agents.values()) - llm_calls_before)
+                    result.device_round_trips.append(pool.round_trips - round_trips_before)
+        finally:
+            logging.disable(logging.NOTSET)
+            flow.close()
+            pool.close_all()
+    result.connects = pool.stats.connects
+    return result
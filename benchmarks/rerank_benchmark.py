@@ -0,0 +1,88 @@
+"""
+Measures how often a reranker puts the expected command first, and how often it is
+confident enough to skip the command finder agent, over a labelled question set.
+"""
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from vector_store.reranker import Reranker
+from vector_store.vectorstoreinterface import VectorStoreInterface
+
+
+@dataclass
+class RerankBenchmarkResult:
+    """
+    Totals for one reranker over the question set
+    """
+    reranker: str
+    questions: int = 0
+    retrieved: int = 0
+    retrieval_top1: int = 0
+    reranked_top1: int = 0
+    short_circuits: int = 0
+    correct_short_circuits: int = 0
+    rerank_seconds: list[float] = field(default_factory=list)
+
+    def summary(self) -> str:
+        """
+        Human readable report
+        """
+        def pct(count: int, total: int) -> str:
+            return f"{100 * count / total:.1f}%" if total else "n/a"
+
+        avg_ms = 1000 * sum(self.rerank_seconds) / len(self.rerank_seconds) if self.rerank_seconds else 0.0
+        return "\n".join([
+            f"reranker: {self.reranker}",
+            f"  questions: {self.questions}, expected command retrieved: {pct(self.retrieved, self.questions)}",
+            f"  top-1 retrieval order: {pct(self.retrieval_top1, self.questions)}",
+            f"  top-1 reranked: {pct(self.reranked_top1, self.questions)}",
+            f"  short circuits (LLM calls skipped): {pct(self.short_circuits, self.questions)}",
+            f"  short circuit precision: {pct(self.correct_short_circuits, self.short_circuits)}",
+            f"  avg rerank latency: {avg_ms:.2f}ms",
+        ])
+
+
+def load_labelled_questions(path: str) -> list[dict]:
+    """
+    Reads {"questions": [{"question": ..., "expected_command": ...}]}
+    """
+    with open(path, "r", encoding="UTF-8") as questions_file:
+        return json.load(questions_file)["questions"]
+
+
+def run_rerank_benchmark(
+    vector_store: VectorStoreInterface,
+    reranker: Reranker,
+    labelled_questions: list[dict],
+    k_document_count: int = 10,
+    threshold: float = 0.9,
+    retrieval_cache: Optional[dict] = None,
+) -> RerankBenchmarkResult:
+    """
+    Retrieves k candidates per question and scores the reranker against the expected command.
+    retrieval_cache lets several rerankers share one round of retrieval
+    """
+    result = RerankBenchmarkResult(reranker=reranker.name)
+    retrieval_cache = retrieval_cache if retrieval_cache is not None else {}
+    for labelled in labelled_questions:
+        question, expected = labelled["question"], labelled["expected_command"]
+        if question not in retrieval_cache:
+            retrieval_cache[question] = vector_store.invoke(question, k_document_count=k_document_count)
+        documents = retrieval_cache[question]
+        commands = [doc.metadata["command"] for doc in documents]
+        result.questions += 1
+        result.retrieved += expected in commands
+        result.retrieval_top1 += bool(commands) and commands[0] == expected
+
+        start = time.perf_counter()
+        ranked = reranker.rerank(question, documents)
+        result.rerank_seconds.append(time.perf_counter() - start)
+        if not ranked:
+            continue
+        result.reranked_top1 += ranked[0].command == expected
+        if ranked[0].confidence >= threshold:
+            result.short_circuits += 1
+            result.correct_short_circuits += ranked[0].command == expected
+    return result
@@ -0,0 +1,121 @@
+"""
+Measures retrieval quality and latency over a labelled question set, recall@k, MRR and
+query latency percentiles for each search strategy and k. Used to tune how many commands
+the flow retrieves and how it escalates when no command fits. Offline, the documents are
+re-embedded with a hashing function and searched in memory, so only relative comparisons
+between strategies and k carry over to the real store.
+"""
+import time
+from dataclasses import dataclass, field
+
+from benchmarks.fakes import FakeVectorStore
+from benchmarks.flow_benchmark import percentile
+from vector_store.embeddingbackends import get_embedding_function
+from vector_store.vectorstoreinterface import Document, VectorStoreInterface
+
+STRATEGIES = ["similarity", "keyword", "hybrid"]
+OFFLINE_EMBEDDING_MODEL = "hashing:512"
+
+
+@dataclass
+class RetrievalBenchmarkResult:
+    """
+    Totals for one search strategy at one k
+    """
+    strategy: str
+    k: int
+    questions: int = 0
+    hits: int = 0
+    reciprocal_ranks: list[float] = field(default_factory=list)
+    seconds: list[float] = field(default_factory=list)
+
+    @property
+    def recall(self) -> float:
+        return self.hits / self.questions if self.questions else 0.0
+
+    @property
+    def mrr(self) -> float:
+        return sum(self.reciprocal_ranks) / self.questions if self.questions else 0.0
+
+
+def offline_vector_store(vector_store: VectorStoreInterface, search_type: str = "hybrid") -> FakeVectorStore:
+    """
+    Copies the store's documents into memory and embeds them with OFFLINE_EMBEDDING_MODEL,
+    so retrieval can be benchmarked without the embedding api
+    """
+    return FakeVectorStore(list(vector_store.iter_documents()), search_type=search_type, embedding_function=get_embedding_function(OFFLINE_EMBEDDING_MODEL))
+
+
+def describe_store(vector_store: VectorStoreInterface) -> str:
+    """
+    Which embeddings and store the numbers were measured with
+    """
+    if isinstance(vector_store, FakeVectorStore):
+        return (
+            f"Embeddings {OFFLINE_EMBEDDING_MODEL}, store in memory {type(vector_store).__name__}. "
+            "Offline stand-ins, compare strategies and k with each other, not with the live store"
+        )
+    return f"Embeddings {vector_store.embedding_model}, store Chroma"
+
+
+def retrieve(vector_store: VectorStoreInterface, strategy: str, question: str, k: int) -> list[Document]:
+    """
+    Top k documents for question with one search strategy
+    """
+    if strategy == "keyword":
+        return [doc for doc, _ in vector_store.get_lexical_index().search(question, k)]
+    if strategy == "hybrid":
+        return vector_store.hybrid_invoke(question, k)
+    return vector_store.similarity_invoke(question, k_document_count=k)
+
+
+def run_retrieval_benchmark(
+    vector_store: VectorStoreInterface,
+    labelled_questions: list[dict],
+    k_values: list[int],
+    strategies: list[str],
+) -> list[RetrievalBenchmarkResult]:
+    """
+    Retrieves every question at every k with every strategy. The keyword index is built
+    before timing so its one off build cost isn't counted against the first query
+    """
+    if "keyword" in strategies or "hybrid" in strategies:
+        vector_store.get_lexical_index()
+    results = []
+    for strategy in strategies:
+        for k in sorted(k_values):
+            result = RetrievalBenchmarkResult(strategy=strategy, k=k)
+            for labelled in labelled_questions:
+                start = time.perf_counter()
+                documents = retrieve(vector_store, strategy, labelled["question"], k)
+                result.seconds.append(time.perf_counter() - start)
+                commands = [doc.metadata["command"] for doc in documents]
+                result.questions += 1
+                if labelled["expected_command"] in commands:
+                    result.hits += 1
+                    result.reciprocal_ranks.append(1 / (commands.index(labelled["expected_command"]) + 1))
+            results.append(result)
+    return results
+
+
+def missing_commands(vector_store: VectorStoreInterface, labelled_questions: list[dict]) -> list[str]:
+    """
+    Expected commands that aren't in the store at all, these can never be retrieved
+    """
+    commands = {metadata.get("command") for metadata in (doc.metadata for doc in vector_store.iter_documents())}
+    return sorted({labelled["expected_command"] for labelled in labelled_questions} - commands)
+
+
+def format_results(results: list[RetrievalBenchmarkResult], description: str = "") -> str:
+    """
+    Fixed width table, one row per strategy and k, under description if given
+    """
+    header = f"{'strategy':<11} {'k':>4} {'recall@k':>9} {'mrr':>6} {'p50 ms':>8} {'p95 ms':>8}"
+    lines = [description] if description else []
+    lines += [header, "-" * len(header)]
+    for result in results:
+        lines.append(
+            f"{result.strategy:<11} {result.k:>4} {result.recall:>9.3f} {result.mrr:>6.3f} "
+            f"{1000 * percentile(result.seconds, 50):>8.2f} {1000 * percentile(result.seconds, 95):>8.2f}"
+        )
+    return "\n".join(lines)
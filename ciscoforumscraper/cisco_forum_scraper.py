@@ -20,6 +20,8 @@ import httpx
 from httpx import RemoteProtocolError
 from bs4 import BeautifulSoup
 
+from http_cache.httpcache import HttpCache
+
 
 def error_handler(func):
     @wraps(func)
@@ -92,8 +94,9 @@ class ForumScraper:
     Parses through Cisco forums, finding solved q&a's
     """
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, http_cache: Optional[HttpCache] = None):
         self.base_url = base_url
+        self.http_cache = http_cache
         self.question_answer_list: set[QuestionAnswer] = set()
         self.headers = {
             "randomkey": "MTM0NjA3NjYyLWNpc2NvU3VwcG9ydA==",
@@ -113,7 +116,8 @@ class ForumScraper:
             "locale": "en",
         }
 
-        response = httpx.post(url=self.base_url, params=params, headers=self.headers)  # type: ignore
+        post = self.http_cache.post if self.http_cache is not None else httpx.post
+        response = post(url=self.base_url, params=params, headers=self.headers)  # type: ignore
         json_data = response.json()
         parsed_hits = json_data.get("data", {}).get("hits", {}).get("hits", {})
         if not parsed_hits:
@@ -183,6 +187,8 @@ class ForumScraper:
         """
         Simple method to wrap response in the error handler
         """
+        if self.http_cache is not None:
+            return self.http_cache.get(qa.question_url, headers=self.headers)
         return httpx.get(qa.question_url, headers=self.headers)
 
     def save_state(self, file_path: str) -> None:
@@ -0,0 +1,140 @@
+"""
+Concurrent page downloader for the scrapers, one shared httpx.AsyncClient
+with per host concurrency, rate limiting and retry with backoff.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from http_cache.httpcache import HttpCache, HttpCacheMiss
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class AsyncCrawler:
+    """
+    Fetches pages concurrently. Each host gets at most max_concurrency_per_host requests in flight
+    and, if requests_per_second is set, requests to a host are spaced out to stay under that rate.
+    Requests go through http_cache when one is given.
+    Use as an async context manager so the connection pool is opened and closed once.
+    """
+
+    def __init__(
+        self,
+        max_concurrency_per_host: int = 8,
+        requests_per_second: Optional[float] = None,
+        max_retries: int = 3,
+        backoff_factor: float = 1.0,
+        timeout: float = 30.0,
+        http_cache: Optional[HttpCache] = None,
+    ):
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.http_cache = http_cache
+        self.client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._host_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._host_next_request: dict[str, float] = defaultdict(float)
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    async def __aenter__(self) -> AsyncCrawler:
+        """
+        Opens the shared client
+        """
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency_per_host * 4,
+                max_keepalive_connections=self.max_concurrency_per_host * 4,
+            ),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, traceback) -> None:
+        """
+        Closes the shared client
+        """
+        await self.client.aclose()
+        self.client = None
+
+    def _semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_concurrency_per_host)
+        return self._host_semaphores[host]
+
+    async def _wait_for_rate_limit(self, host: str) -> None:
+        """
+        Sleeps until the host's next request slot if a rate limit is set
+        """
+        if not self.requests_per_second:
+            return
+        async with self._host_locks[host]:
+            now = time.monotonic()
+            wait = self._host_next_request[host] - now
+            self._host_next_request[host] = max(now, self._host_next_request[host]) + 1 / self.requests_per_second
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def get(self, url: str) -> Optional[httpx.Response]:
+        """
+        GETs a url with retry and backoff on connection errors and retryable status codes.
+        Responses replayed from the http cache skip the concurrency and rate limits, nothing is sent.
+        Returns None if the page couldn't be downloaded
+        """
+        host = urlsplit(url).netloc
+        lookup = None
+        if self.http_cache is not None:
+            try:
+                lookup = await self.http_cache.alookup("GET", url)
+            except HttpCacheMiss as exc:
+                self.logger.error(str(exc))
+                return None
+            if lookup[2] is not None:
+                return lookup[2]
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore(host):
+                await self._wait_for_rate_limit(host)
+                try:
+                    if lookup is not None:
+                        response = await self.http_cache.asend(self.client, url, lookup)
+                    else:
+                        response = await self.client.get(url)
+                except httpx.TransportError as exc:
+                    self.logger.warning(f"Request to {url} failed - {exc}, attempt {attempt + 1}")
+                    response = None
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                if response.is_error:
+                    self.logger.error(f"{response.status_code} for {url}")
+                    return None
+                return response
+            if response is not None:
+                self.logger.warning(f"{response.status_code} for {url}, attempt {attempt + 1}")
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+        self.logger.error(f"Max retries exceeded for {url}, giving up")
+        return None
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """
+        Returns the page's text, or None if it couldn't be downloaded
+        """
+        response = await self.get(url)
+        return response.text if response is not None else None
+
+    async def fetch_all(self, urls: list[str]) -> list[Optional[str]]:
+        """
+        Fetches every url concurrently, results are in the same order as urls
+        """
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
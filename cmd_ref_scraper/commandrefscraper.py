@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import re
+import time
+from contextlib import nullcontext
 from logging import Logger
 from dataclasses import dataclass, field
 from typing import Optional
@@ -9,6 +12,10 @@ from tenacity import retry, stop_after_attempt
 import httpx
 from bs4 import BeautifulSoup
 from bs4.element import Tag
+from cmd_ref_scraper.asynccrawler import AsyncCrawler
+from cmd_ref_scraper.parsestage import ParseStage, PipelineStats
+from cmd_ref_scraper.streamingloader import StreamingLoader
+from http_cache.httpcache import HttpCache, HttpCacheMiss
 from vector_store.vectorstoreinterface import VectorStoreInterface
 
 
@@ -44,6 +51,16 @@ class CommandRefTOC:
     topic_toc_url: str
     urls: list[str]
     documents: Optional[list[Document]] = field(default_factory=list)
+    failed_urls: list[str] = field(default_factory=list)
+
+
+def parse_command_ref_html_timed(html: str, command_filter: Optional[str], child_topic: str, parent_topic: str) -> tuple[list[Document], float]:
+    """
+    Process pool entry point, parses a command page and reports how long the parse took
+    """
+    start = time.perf_counter()
+    documents = CommandRefScraper.parse_command_ref_html(html, command_filter, child_topic, parent_topic)
+    return documents, time.perf_counter() - start
 
 
 class CommandRefScraper:
@@ -52,14 +69,26 @@ class CommandRefScraper:
     Saves into a VectorDB
     """
 
-    def __init__(self, base_url: str, vectorstore_name: str, command_filter: Optional[str]):
+    def __init__(
+        self,
+        base_url: str,
+        vectorstore_name: str,
+        command_filter: Optional[str],
+        http_cache: Optional[HttpCache] = None,
+        embedding_model: Optional[str] = None,
+    ):
         """
         Base url should be the command reference main page
         ex. https://www.cisco.com/c/en/us/td/docs/ios-xml/ios/17_xe/command/command-references.html
         MUST match the same format, only tested with the link above ^^
         """
         self.base_url: str = base_url
+        self.base_page_html: Optional[str] = None
+        self.http_cache = http_cache
+        self.pipeline_stats = PipelineStats()
+        self.vector_store: Optional[VectorStoreInterface] = None
         self.vectorstore_name = vectorstore_name
+        self.embedding_model = embedding_model
         self.topics: list[str] = []
         self.topic_tocs: list[TopicTOC] = []
         if command_filter:
@@ -70,18 +99,68 @@ class CommandRefScraper:
         from helpers import get_logger
         self.logger: Logger = get_logger()
 
+    def get_vector_store(self) -> VectorStoreInterface:
+        """
+        Opens the vector store on first use, every load after that reuses the same handle
+        """
+        if self.vector_store is None or self.vector_store.closed:
+            self.vector_store = VectorStoreInterface(self.vectorstore_name, embedding_model=self.embedding_model)
+        return self.vector_store
+
+    def close(self) -> None:
+        """
+        Closes the shared vector store handle if it was opened
+        """
+        if self.vector_store is not None:
+            self.vector_store.close()
+            self.vector_store = None
+
+    def __enter__(self):
+        """
+        Enter context manager, return self.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Exit context manager, close the vector store.
+        """
+        self.close()
+
+    def http_get(self, url: str) -> httpx.Response:
+        """
+        GETs a page, through the http cache if one is configured
+        """
+        if self.http_cache is not None:
+            return self.http_cache.get(url, follow_redirects=True)
+        return httpx.get(url, follow_redirects=True)
+
+    def get_base_page(self) -> str:
+        """
+        Downloads the base url once, every topic is parsed out of the same page
+        """
+        if self.base_page_html is None:
+            self.base_page_html = self.http_get(self.base_url).text
+        return self.base_page_html
+
     def get_all_topic_names(self) -> None:
         """
         Goes to the base url and finds all topics within the config reference
         """
-        response = httpx.get(self.base_url).text
-        soup = BeautifulSoup(response, "lxml")
-        self.topics = [
+        self.topics = self.parse_topic_names(self.get_base_page())
+        self.logger.debug(f"Set Topics to - {self.topics}")
+        return
+
+    @staticmethod
+    def parse_topic_names(html: str) -> list[str]:
+        """
+        Finds all topic headings on the base page
+        """
+        soup = BeautifulSoup(html, "lxml")
+        return [
             topic.get_text().strip()
             for topic in soup.find_all("div", attrs={"class": "heading"})
         ]
-        self.logger.debug(f"Set Topics to - {self.topics}")
-        return
 
     @retry(stop=stop_after_attempt(2))
     def create_topic_toc(self, topic_name: str) -> None:
@@ -90,8 +169,14 @@ class CommandRefScraper:
         example: topic = ip routing
         first result: https://www.cisco.com/c/en/us/td/docs/ios-xml/ios/iproute_bgp/command/irg-cr-book.html
         """
-        response = httpx.get(self.base_url)
-        soup = BeautifulSoup(response.text, "lxml")
+        self.add_topic_toc(self.get_base_page(), topic_name)
+        return
+
+    def add_topic_toc(self, html: str, topic_name: str) -> None:
+        """
+        Parses a topic's table of content out of the base page html
+        """
+        soup = BeautifulSoup(html, "lxml")
         try:
             topic: BeautifulSoup = next(
                 topic
@@ -110,7 +195,6 @@ class CommandRefScraper:
         )
         self.topic_tocs.append(topic_toc)
         self.logger.debug(f"Set Topic TOCs to - {self.topic_tocs}")
-        return
 
     @retry(stop=stop_after_attempt(2))
     def create_command_ref_toc(self, topic_toc: TopicTOC) -> None:
@@ -122,27 +206,34 @@ class CommandRefScraper:
         for current_url in topic_toc.urls:
             self.logger.info(current_url)
             try:
-                response = httpx.get(current_url, follow_redirects=True)
-            except httpx.ConnectError:
+                response = self.http_get(current_url)
+            except (httpx.ConnectError, HttpCacheMiss):
                 self.logger.error(f"Dead link - {current_url}")
-            soup = BeautifulSoup(response.text, "lxml")
-            title = soup.title.get_text()
-            books: Tag = soup.find("ul", attrs={"id": "bookToc"})
-
-            book_urls = [
-                f"https://cisco.com{url.get('href')}"
-                for url in books.find_all("a", href=True)
-                if url.get_text().lower() != "index"
-            ]
-
-            command_ref_toc = CommandRefTOC(
-                parent_topic=topic_toc.topic,
-                child_topic=title.strip(),
-                topic_toc_url=current_url,
-                urls=book_urls,
-            )
+                continue
+            self.add_command_ref_toc(topic_toc, current_url, response.text)
+
+    def add_command_ref_toc(self, topic_toc: TopicTOC, current_url: str, html: str) -> None:
+        """
+        Parses a book's table of content page into a CommandRefTOC on the topic_toc
+        """
+        soup = BeautifulSoup(html, "lxml")
+        title = soup.title.get_text()
+        books: Tag = soup.find("ul", attrs={"id": "bookToc"})
+
+        book_urls = [
+            f"https://cisco.com{url.get('href')}"
+            for url in books.find_all("a", href=True)
+            if url.get_text().lower() != "index"
+        ]
+
+        command_ref_toc = CommandRefTOC(
+            parent_topic=topic_toc.topic,
+            child_topic=title.strip(),
+            topic_toc_url=current_url,
+            urls=book_urls,
+        )
 
-            topic_toc.command_ref_tocs.append(command_ref_toc)
+        topic_toc.command_ref_tocs.append(command_ref_toc)
 
     def scrape_command_ref_page(self, command_ref_toc: CommandRefTOC) -> None:
         """
@@ -152,37 +243,196 @@ class CommandRefScraper:
         self.logger.info("starting scrape on %s", command_ref_toc.child_topic)
         for url in command_ref_toc.urls:
             self.logger.info("scraping sub-url - %s", url)
-            response = httpx.get(url, follow_redirects=True)
-            soup = BeautifulSoup(response.text, "lxml")
+            response = self.http_get(url)
+            command_ref_toc.documents.extend(self.parse_command_ref_page(response.text, command_ref_toc))
+
+    def parse_command_ref_page(self, html: str, command_ref_toc: CommandRefTOC) -> list[Document]:
+        """
+        Parses every command article on a command reference page into a Document
+        """
+        documents = self.parse_command_ref_html(
+            html, self.command_filter, command_ref_toc.child_topic, command_ref_toc.parent_topic)
+        self.logger.debug(
+            "Scraped command documentation for %s", [doc.metadata["command"] for doc in documents])
+        return documents
+
+    @staticmethod
+    def parse_command_ref_html(html: str, command_filter: Optional[str], child_topic: str, parent_topic: str) -> list[Document]:
+        """
+        Parsing without any scraper state, so it can run in a worker process
+        """
+        documents = []
+        soup = BeautifulSoup(html, "lxml")
+        articles = soup.find_all(
+            "article", attrs={"class": "topic reference nested1"}
+        )
+        if len(articles) == 0:
             articles = soup.find_all(
-                "article", attrs={"class": "topic reference nested1"}
+                "section", attrs={"class": "nested1"}
             )
-            if len(articles) == 0:
-                articles = soup.find_all(
-                    "section", attrs={"class": "nested1"}
-                )
 
-            for article in articles:
-                command = article.find("h2").get_text()
-
-                if self.command_filter and not self.command_filter in command:
-                    continue
-                command = self.clean_string(command)
-                self.logger.debug(
-                    "Scraping command documentation for %s", command)
-                article_text = f"COMMAND:```{command}``` \n DOCUMENTATION:"
-                article_text += self.extract_text_clean(article)
-
-                command_ref_toc.documents.append(
-                    Document(
-                        page_content=article_text,
-                        metadata={
-                            "child_topic": command_ref_toc.child_topic,
-                            "parent_topic": command_ref_toc.parent_topic,
-                            "command": command,
-                        },
-                    )
+        for article in articles:
+            command = article.find("h2").get_text()
+
+            if command_filter and not command_filter in command:
+                continue
+            command = CommandRefScraper.clean_string(command)
+            article_text = f"COMMAND:```{command}``` \n DOCUMENTATION:"
+            article_text += CommandRefScraper.extract_text_clean(article)
+
+            documents.append(
+                Document(
+                    page_content=article_text,
+                    metadata={
+                        "child_topic": child_topic,
+                        "parent_topic": parent_topic,
+                        "command": command,
+                    },
                 )
+            )
+        return documents
+
+    async def crawl(
+        self,
+        crawler: AsyncCrawler,
+        parse_workers: int = 0,
+        loader: Optional[StreamingLoader] = None,
+        max_books_in_flight: int = 8,
+    ) -> None:
+        """
+        Crawls the whole command reference concurrently, filling in topics, topic_tocs,
+        their command_ref_tocs and documents the same way the step by step methods do.
+        With parse_workers, command pages are parsed in a process pool while downloads continue.
+        With a loader, each book is written to the vector store as soon as it is parsed and books
+        the loader already completed are skipped
+        """
+        self.pipeline_stats = PipelineStats()
+        self.base_page_html = await crawler.fetch(self.base_url)
+        if self.base_page_html is None:
+            self.logger.error(f"Failed to download the base page - {self.base_url}")
+            return
+        # Parsing is CPU bound, it runs on a worker thread so downloads keep going
+        await asyncio.to_thread(self.add_all_topic_tocs)
+        book_slots = asyncio.Semaphore(max_books_in_flight)
+
+        async def crawl_topics(parse_stage: Optional[ParseStage]) -> None:
+            outcomes = await asyncio.gather(*(
+                self.crawl_topic_toc(crawler, topic_toc, parse_stage, loader, book_slots)
+                for topic_toc in self.topic_tocs
+            ), return_exceptions=True)
+            for topic_toc, outcome in zip(self.topic_tocs, outcomes):
+                if isinstance(outcome, Exception):
+                    self.logger.error(f"Crawl of topic {topic_toc.topic} failed - {outcome!r}")
+                    if loader is not None:
+                        loader.record_unreachable(topic_toc.topic)
+
+        if parse_workers > 0:
+            async with ParseStage(parse_command_ref_html_timed, workers=parse_workers, stats=self.pipeline_stats) as parse_stage:
+                await crawl_topics(parse_stage)
+        else:
+            await crawl_topics(None)
+        self.logger.info(f"Crawl pipeline stats - {self.pipeline_stats.summary()}")
+
+    def add_all_topic_tocs(self) -> None:
+        """
+        Parses every topic and its table of content out of the base page
+        """
+        self.get_all_topic_names()
+        for topic in self.topics:
+            self.add_topic_toc(self.base_page_html, topic)
+
+    async def crawl_topic_toc(
+        self,
+        crawler: AsyncCrawler,
+        topic_toc: TopicTOC,
+        parse_stage: Optional[ParseStage] = None,
+        loader: Optional[StreamingLoader] = None,
+        book_slots: Optional[asyncio.Semaphore] = None,
+    ) -> None:
+        """
+        Downloads every book toc in a topic, then every command page in those books.
+        A book whose toc can't be downloaded or parsed is skipped, the rest of the topic carries on
+        """
+        urls = [url for url in topic_toc.urls if loader is None or not loader.is_completed(url)]
+        pages = await crawler.fetch_all(urls)
+        for url, html in zip(urls, pages):
+            if html is None:
+                self.logger.error(f"Dead link - {url}")
+                if loader is not None:
+                    loader.record_unreachable(url)
+                continue
+            try:
+                await asyncio.to_thread(self.add_command_ref_toc, topic_toc, url, html)
+            except Exception as exc:
+                self.logger.error(f"Failed to parse book toc {url} - {exc!r}")
+                if loader is not None:
+                    loader.record_unreachable(url)
+        outcomes = await asyncio.gather(*(
+            self.crawl_command_ref_toc(crawler, command_ref_toc, parse_stage, loader, book_slots)
+            for command_ref_toc in topic_toc.command_ref_tocs
+        ), return_exceptions=True)
+        for command_ref_toc, outcome in zip(topic_toc.command_ref_tocs, outcomes):
+            if isinstance(outcome, Exception):
+                self.logger.error(f"Scrape of {command_ref_toc.child_topic} failed - {outcome!r}")
+                if loader is not None:
+                    loader.record_unreachable(command_ref_toc.topic_toc_url)
+
+    async def crawl_command_ref_toc(
+        self,
+        crawler: AsyncCrawler,
+        command_ref_toc: CommandRefTOC,
+        parse_stage: Optional[ParseStage] = None,
+        loader: Optional[StreamingLoader] = None,
+        book_slots: Optional[asyncio.Semaphore] = None,
+    ) -> None:
+        """
+        Downloads every command page in a book and parses them into documents, in page order
+        """
+        if book_slots is None:
+            book_slots = asyncio.Semaphore(1)
+        # The slot is held until the book is handed to the loader, bounding how many books are in memory
+        async with book_slots:
+            await self.scrape_book(crawler, command_ref_toc, parse_stage)
+            if loader is not None:
+                await loader.submit(command_ref_toc)
+
+    async def scrape_book(self, crawler: AsyncCrawler, command_ref_toc: CommandRefTOC, parse_stage: Optional[ParseStage] = None) -> None:
+        """
+        Fetches and parses a single book's command pages into its documents
+        """
+        self.logger.info("starting scrape on %s", command_ref_toc.child_topic)
+
+        async def fetch_and_parse(url: str) -> list[Document]:
+            # With a parse stage the page's slot is taken before the download, so downloads wait on slow parsers
+            async with parse_stage.slots if parse_stage is not None else nullcontext():
+                start = time.perf_counter()
+                html = await crawler.fetch(url)
+                self.pipeline_stats.fetch_seconds += time.perf_counter() - start
+                if html is None:
+                    self.logger.error(f"Failed to scrape sub-url - {url}")
+                    command_ref_toc.failed_urls.append(url)
+                    return []
+                self.pipeline_stats.pages_fetched += 1
+                try:
+                    if parse_stage is None:
+                        start = time.perf_counter()
+                        documents = await asyncio.to_thread(self.parse_command_ref_page, html, command_ref_toc)
+                        self.pipeline_stats.pages_parsed += 1
+                        self.pipeline_stats.parse_seconds += time.perf_counter() - start
+                    else:
+                        documents = await parse_stage.parse(
+                            html, self.command_filter, command_ref_toc.child_topic, command_ref_toc.parent_topic)
+                except Exception as exc:
+                    # One malformed page shouldn't cost the rest of the book
+                    self.logger.error(f"Failed to parse sub-url - {url} - {exc!r}")
+                    command_ref_toc.failed_urls.append(url)
+                    return []
+            self.pipeline_stats.documents += len(documents)
+            return documents
+
+        pages = await asyncio.gather(*(fetch_and_parse(url) for url in command_ref_toc.urls))
+        for documents in pages:
+            command_ref_toc.documents.extend(documents)
 
     @staticmethod
     def clean_string(input_string):
@@ -195,18 +445,19 @@ class CommandRefScraper:
         cleaned_string = cleaned_string.strip()
         return cleaned_string
 
-    def extract_text_clean(self, element: Tag) -> str:
+    @staticmethod
+    def extract_text_clean(element: Tag) -> str:
         """
         Extracts and cleans text from an HTML element and its children.
         """
         if element.name == "table":
-            return self.extract_table_text(element)
+            return CommandRefScraper.extract_table_text(element)
         else:
             text_set = set()
             text_list = []
             for child in element.descendants:
                 if child.name == "table":
-                    table_text = self.extract_table_text(child)
+                    table_text = CommandRefScraper.extract_table_text(child)
                     if table_text not in text_set:
                         text_set.add(table_text)
                         text_list.append(table_text)
@@ -220,7 +471,8 @@ class CommandRefScraper:
                             text_list.append("\n" + stripped_text)
             return " ".join(filter(None, text_list)).replace("\n ", "\n")
 
-    def extract_table_text(self, table: Tag) -> str:
+    @staticmethod
+    def extract_table_text(table: Tag) -> str:
         """
         Extracts and formats text from an HTML table element.
         """
@@ -235,22 +487,33 @@ class CommandRefScraper:
         table_text.append("#END TABLE")
         return "\n".join(table_text)
 
-    def create_and_load_vectorstore(self):
+    def create_and_load_vectorstore(self, incremental: bool = False):
         """
-        Takes a command ref doc, initializes a vectorstore, and saves documents into that vectorstore
+        Takes a command ref doc, and saves documents into the scraper's shared vectorstore
+        With incremental, only new or changed documents are embedded and documents that are no longer
+        in a book that loaded completely are removed
         """
         self.logger.info("Creating vector store")
+        vector_store = self.get_vector_store()
+        summary = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+        loaded_books: dict[tuple[str, str], set[str]] = {}
         for idx, topic_toc in enumerate(self.topic_tocs):
             self.logger.info(f"Iterating over topic toc number - {idx+1}, {topic_toc.topic}")
             for idx, command_ref_toc in enumerate(topic_toc.command_ref_tocs):
                 self.logger.info(f"Iterating over topic toc ref {idx+1}, {command_ref_toc.child_topic}")
                 if len(command_ref_toc.documents) > 0:
                     try:
-                        with VectorStoreInterface(self.vectorstore_name) as vector_store:
+                        if incremental:
+                            for key, count in vector_store.upsert_documents(command_ref_toc.documents).items():
+                                summary[key] += count
+                            if not command_ref_toc.failed_urls:
+                                loaded_books[(command_ref_toc.parent_topic, command_ref_toc.child_topic)] = set(
+                                    vector_store.unique_documents(command_ref_toc.documents))
+                        else:
                             vector_store.add_documents(
                                 command_ref_toc.documents)
-                            self.logger.info(
-                                f"Saved documents to db, current toc = {command_ref_toc.child_topic}--{command_ref_toc.urls}")
+                        self.logger.info(
+                            f"Saved documents to db, current toc = {command_ref_toc.child_topic}--{command_ref_toc.urls}")
                     except ValueError as e:
                         self.logger.error(
                             f"Failed to save documents to db, current toc = {command_ref_toc.child_topic}--{command_ref_toc.urls} document len - {len(command_ref_toc.documents)}"
@@ -260,17 +523,51 @@ class CommandRefScraper:
                     self.logger.warning("No docs for... %s",
                                         command_ref_toc.child_topic)
 
-    def delete_duplicates_in_vectorstore(self):
+        if incremental and self.topic_tocs:
+            summary["removed"] = self.remove_missing(vector_store, loaded_books)
+            print(f"added={summary['added']} updated={summary['updated']} unchanged={summary['unchanged']} removed={summary['removed']}")
+            self.logger.info(f"Incremental load summary {summary}")
+
+    def remove_missing(self, vector_store: VectorStoreInterface, loaded_books: dict[tuple[str, str], set[str]]) -> int:
+        """
+        Deletes stored documents that are no longer in their book, only for books in loaded_books,
+        (parent_topic, child_topic) -> ids of every document the book has now. Callers leave out books
+        with pages that failed to download or parse, or that failed to save, and books with no documents,
+        so a temporary failure can't remove commands that still exist upstream. Returns the number deleted
+        """
+        if self.command_filter:
+            # The loaded ids only hold the filtered commands, every other command in the books would look removed
+            self.logger.info("Command filter set, skipping removal of documents missing upstream")
+            return 0
+        removed = 0
+        for (parent_topic, child_topic), keep_ids in loaded_books.items():
+            removed += vector_store.delete_missing(keep_ids, metadata_filter={
+                "$and": [{"parent_topic": {"$eq": parent_topic}}, {"child_topic": {"$eq": child_topic}}]
+            })
+        self.logger.info(f"Removed {removed} documents missing upstream from {len(loaded_books)} fully loaded books")
+        return removed
+
+    def delete_duplicates_in_vectorstore(self, dry_run: bool = False) -> int:
         """
         Some commands appear in multiple pages, this will remove the extra duplicates
+        The first copy of each command is kept, with dry_run the duplicates are only reported
+        Returns the number of duplicates found
         """
-        cmd_list = []
-        with VectorStoreInterface(self.vectorstore_name) as vector_store:
-            ids = vector_store.collection.get()["ids"]
-            metadatas = vector_store.collection.get()["metadatas"]
-            for id, metadata in zip(ids, metadatas):
-                cmd = metadata["command"]
-                if cmd in cmd_list:
-                    self.logger.info("Removing duplicate command %s", cmd)
-                    vector_store.collection.delete(id)
-                cmd_list.append(cmd)
+        seen_commands = set()
+        duplicate_ids = []
+        vector_store = self.get_vector_store()
+        for doc_id, metadata in vector_store.iter_metadatas():
+            cmd = metadata["command"]
+            if cmd in seen_commands:
+                self.logger.debug("Found duplicate command %s", cmd)
+                duplicate_ids.append(doc_id)
+            else:
+                seen_commands.add(cmd)
+        if dry_run:
+            self.logger.info("Dry run, %s duplicates of %s commands would be removed",
+                             len(duplicate_ids), len(seen_commands))
+        else:
+            vector_store.delete_ids(duplicate_ids)
+            self.logger.info("Removed %s duplicates, %s unique commands remain",
+                             len(duplicate_ids), len(seen_commands))
+        return len(duplicate_ids)
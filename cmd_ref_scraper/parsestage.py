@@ -0,0 +1,112 @@
+"""
+Process pool stage for CPU bound html parsing, so parsing doesn't hold up downloads.
+Downloaders take a slot before fetching a page and give it back once the page is
+parsed, so when the parsers fall behind the downloads wait instead of piling up html.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+
+@dataclass
+class PipelineStats:
+    """
+    Timing for each stage of the crawl pipeline, parse_seconds is time spent inside the workers
+    """
+    pages_fetched: int = 0
+    fetch_seconds: float = 0.0
+    queue_wait_seconds: float = 0.0
+    pages_parsed: int = 0
+    parse_seconds: float = 0.0
+    documents: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        avg_fetch = self.fetch_seconds / self.pages_fetched if self.pages_fetched else 0.0
+        avg_wait = self.queue_wait_seconds / self.pages_parsed if self.pages_parsed else 0.0
+        avg_parse = self.parse_seconds / self.pages_parsed if self.pages_parsed else 0.0
+        return (
+            f"fetched={self.pages_fetched} avg_fetch={avg_fetch:.3f}s "
+            f"parsed={self.pages_parsed} avg_queue_wait={avg_wait:.3f}s avg_parse={avg_parse:.3f}s "
+            f"documents={self.documents}"
+        )
+
+
+class ParseStage:
+    """
+    Runs parse_fn in a process pool. parse_fn must be a module level function returning
+    (result, seconds_spent) so it can be pickled and timed inside the worker.
+    Use as an async context manager, then await parse(...) from any number of tasks.
+    Producers hold one of slots from before they fetch a page until its parse returns, at most
+    queue_size + workers fetched pages are ever waiting on or inside the pool.
+    """
+
+    def __init__(
+        self,
+        parse_fn: Callable[..., tuple[Any, float]],
+        workers: int = 4,
+        queue_size: Optional[int] = None,
+        stats: Optional[PipelineStats] = None,
+    ):
+        self.parse_fn = parse_fn
+        self.workers = workers
+        self.queue_size = queue_size if queue_size is not None else workers * 2
+        self.stats = stats if stats is not None else PipelineStats()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def __aenter__(self) -> ParseStage:
+        """
+        Starts the process pool and one consumer task per worker
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.slots = asyncio.Semaphore(self.queue_size + self.workers)
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, traceback) -> None:
+        """
+        Stops the consumers and shuts the pool down
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            args, future, enqueued_at = await self.queue.get()
+            self.stats.queue_wait_seconds += time.perf_counter() - enqueued_at
+            try:
+                result, parse_seconds = await loop.run_in_executor(self.executor, self.parse_fn, *args)
+                self.stats.pages_parsed += 1
+                self.stats.parse_seconds += parse_seconds
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+            finally:
+                self.queue.task_done()
+
+    async def parse(self, *args) -> Any:
+        """
+        Queues a parse job and waits for its result, blocks while the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((args, future, time.perf_counter()))
+        return await future
@@ -0,0 +1,178 @@
+"""
+Streams parsed command reference books straight into the vector store as they finish,
+instead of holding the whole corpus in memory until the end of the crawl.
+Books whose every page loaded are recorded in a checkpoint file so an interrupted crawl
+can resume, and a rerun retries the rest.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional, TYPE_CHECKING
+
+from vector_store.vectorstoreinterface import VectorStoreInterface
+
+if TYPE_CHECKING:
+    from cmd_ref_scraper.commandrefscraper import CommandRefTOC
+
+
+@dataclass
+class LoaderStats:
+    """
+    Counters for the streaming loader
+    """
+    books_written: int = 0
+    books_failed: int = 0
+    books_incomplete: int = 0
+    books_unreachable: int = 0
+    books_skipped: int = 0
+    documents_written: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        return (
+            f"books written={self.books_written} failed={self.books_failed} incomplete={self.books_incomplete} "
+            f"unreachable={self.books_unreachable} skipped={self.books_skipped} documents={self.documents_written}"
+        )
+
+    @property
+    def all_loaded(self) -> bool:
+        """
+        True if no book failed to save, lost pages or couldn't be reached
+        """
+        return self.books_failed == 0 and self.books_incomplete == 0 and self.books_unreachable == 0
+
+
+class StreamingLoader:
+    """
+    Takes finished CommandRefTOCs through a bounded queue and writes their documents to the vector
+    store on a single writer, the documents are dropped from memory once saved. A full queue makes
+    the crawl wait, so at most queue_size finished books are held in memory at once.
+    With incremental, the ids of every book that loaded completely are kept in loaded_books for
+    CommandRefScraper.remove_missing once the stream finishes.
+    """
+
+    def __init__(self, vector_store: VectorStoreInterface, checkpoint_path: str, incremental: bool = False, queue_size: int = 4):
+        self.vector_store = vector_store
+        self.checkpoint_path = checkpoint_path
+        self.incremental = incremental
+        self.queue_size = queue_size
+        self.completed_books: set[str] = set()
+        self.loaded_books: dict[tuple[str, str], set[str]] = {}
+        self.stats = LoaderStats()
+        self.queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+        self.load_checkpoint()
+
+    def load_checkpoint(self) -> None:
+        """
+        Reads the books finished by a previous run
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, "r", encoding="UTF-8") as checkpoint_file:
+            self.completed_books = set(json.load(checkpoint_file).get("completed_books", []))
+        self.logger.info(f"Resuming from checkpoint, {len(self.completed_books)} books already loaded")
+
+    def save_checkpoint(self) -> None:
+        """
+        Atomically rewrites the checkpoint file
+        """
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as checkpoint_file:
+            json.dump({"completed_books": sorted(self.completed_books)}, checkpoint_file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def clear_checkpoint(self) -> None:
+        """
+        Removes the checkpoint once the whole crawl is loaded, so the next run starts fresh
+        """
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def record_unreachable(self, topic_toc_url: str) -> None:
+        """
+        Counts a book, or a whole topic, that couldn't be downloaded or parsed
+        """
+        self.stats.books_unreachable += 1
+
+    def is_completed(self, topic_toc_url: str) -> bool:
+        """
+        True if the book was loaded by an earlier run, counts it as skipped
+        """
+        if topic_toc_url in self.completed_books:
+            self.stats.books_skipped += 1
+            return True
+        return False
+
+    async def __aenter__(self) -> StreamingLoader:
+        """
+        Starts the writer, the vector store handle is owned by the caller
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._writer = asyncio.create_task(self._write_books())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, traceback) -> None:
+        """
+        Waits for queued books to be written, then stops the writer
+        """
+        if exc_type is None:
+            await self.queue.join()
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+        self.logger.info(f"Streaming load stats - {self.stats.summary()}")
+
+    async def submit(self, command_ref_toc: CommandRefTOC) -> None:
+        """
+        Queues a finished book for writing, waits while the queue is full
+        """
+        await self.queue.put(command_ref_toc)
+
+    async def _write_books(self) -> None:
+        while True:
+            command_ref_toc = await self.queue.get()
+            try:
+                await asyncio.to_thread(self.write_book, command_ref_toc)
+            finally:
+                self.queue.task_done()
+
+    def write_book(self, command_ref_toc: CommandRefTOC) -> None:
+        """
+        Saves a book's documents and checkpoints it, runs on a worker thread.
+        A book with pages that failed to download is saved but not checkpointed, so a resume retries it
+        """
+        documents = command_ref_toc.documents
+        try:
+            if documents:
+                if self.incremental:
+                    self.logger.info(f"{command_ref_toc.child_topic} - {self.vector_store.upsert_documents(documents)}")
+                else:
+                    self.vector_store.add_documents(documents)
+            else:
+                self.logger.warning("No docs for... %s", command_ref_toc.child_topic)
+        except Exception as exc:
+            self.stats.books_failed += 1
+            self.logger.error(f"Failed to save documents to db, current toc = {command_ref_toc.child_topic} - {exc}")
+            return
+        self.stats.books_written += 1
+        self.stats.documents_written += len(documents)
+        if command_ref_toc.failed_urls:
+            self.stats.books_incomplete += 1
+            self.logger.warning(f"{command_ref_toc.child_topic} is missing {len(command_ref_toc.failed_urls)} pages, not checkpointing it")
+        else:
+            self.completed_books.add(command_ref_toc.topic_toc_url)
+            self.save_checkpoint()
+            if self.incremental and documents:
+                self.loaded_books[(command_ref_toc.parent_topic, command_ref_toc.child_topic)] = set(
+                    self.vector_store.unique_documents(documents))
+        # Saved, no need to keep the documents around for the rest of the crawl
+        command_ref_toc.documents = []
@@ -0,0 +1,278 @@
+"""
+Cache for command output collected from network devices.
+Entries expire based on how quickly the command's output changes and the cache
+is bounded by the total size of the stored output.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+
+# Longest matching prefix wins, commands that don't match use the default ttl
+DEFAULT_TTL_RULES: dict[str, int] = {
+    "show interfaces": 30,
+    "show ip interface": 30,
+    "show processes": 15,
+    "show logging": 15,
+    "show ip route": 60,
+    "show ip bgp": 60,
+    "show bgp": 60,
+    "show ip ospf": 60,
+    "show ip eigrp": 60,
+    "show running-config": 300,
+    "show startup-config": 3600,
+    "show version": 3600,
+    "show inventory": 3600,
+    "show license": 3600,
+}
+
+
+@dataclass
+class CacheEntry:
+    """
+    Single cached command output
+    """
+    device: str
+    command: str
+    output: str
+    expires_at: float
+
+    @property
+    def size(self) -> int:
+        return len(self.output.encode("utf-8"))
+
+
+@dataclass
+class CacheStats:
+    """
+    Counters for the command cache
+    """
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return (
+            f"cache hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2f} "
+            f"expirations={self.expirations} evictions={self.evictions}"
+        )
+
+
+class CommandCache:
+    """
+    LRU cache of command output keyed by (device, command).
+    Each command's ttl comes from ttl_rules, and the least recently used entries are evicted
+    once the stored output exceeds max_bytes. If persist_path is set the cache is loaded from
+    that json file, and saved to it at most every save_interval seconds while entries change
+    and on exit, so a crash only loses the last few seconds of output.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 50 * 1024 * 1024,
+        default_ttl: int = 120,
+        ttl_rules: Optional[dict[str, int]] = None,
+        persist_path: Optional[str] = None,
+        save_interval: float = 30.0,
+    ):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttl_rules = {
+            self.normalize_command(prefix): ttl
+            for prefix, ttl in (ttl_rules if ttl_rules is not None else DEFAULT_TTL_RULES).items()
+        }
+        self.persist_path = persist_path
+        self.save_interval = save_interval
+        self.entries: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+        self.total_bytes = 0
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = float("-inf")
+        self._save_timer: Optional[threading.Timer] = None
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+        if self.persist_path:
+            self.load()
+
+    @staticmethod
+    def normalize_command(command: str) -> str:
+        """
+        Lower cases and collapses whitespace so trivially different commands share an entry
+        """
+        return " ".join(command.lower().split())
+
+    def ttl_for(self, command: str) -> int:
+        """
+        Finds the ttl for a command using the longest matching prefix rule
+        """
+        command = self.normalize_command(command)
+        matches = [prefix for prefix in self.ttl_rules if command.startswith(prefix)]
+        if not matches:
+            return self.default_ttl
+        return self.ttl_rules[max(matches, key=len)]
+
+    def _remove(self, key: tuple[str, str]) -> CacheEntry:
+        """
+        Removes an entry and keeps the byte count in sync, caller must hold the lock
+        """
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        return entry
+
+    def get(self, device: str, command: str) -> Optional[str]:
+        """
+        Returns the cached output, or None if it is missing or expired
+        """
+        key = (device, self.normalize_command(command))
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry.output
+
+    def set(self, device: str, command: str, output: str, expires_at: Optional[float] = None) -> None:
+        """
+        Stores command output, evicting least recently used entries if over max_bytes
+        """
+        key = (device, self.normalize_command(command))
+        entry = CacheEntry(
+            device=device,
+            command=key[1],
+            output=output,
+            expires_at=expires_at if expires_at is not None else time.time() + self.ttl_for(command),
+        )
+        if entry.size > self.max_bytes:
+            self.logger.debug(f"Output for '{command}' on {device} is larger than the cache, not caching")
+            return
+        self._store(key, entry)
+        self.save_if_due()
+
+    def _store(self, key: tuple[str, str], entry: CacheEntry) -> None:
+        """
+        Adds an entry and evicts least recently used entries until under max_bytes
+        """
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats.evictions += 1
+            self._dirty = True
+
+    def invalidate(self, device: Optional[str] = None) -> int:
+        """
+        Removes every entry for the device, or the entire cache if no device is given.
+        Returns the number of entries removed
+        """
+        with self._lock:
+            keys = [key for key in self.entries if device is None or key[0] == device]
+            for key in keys:
+                self._remove(key)
+            self._dirty = self._dirty or bool(keys)
+        self.save_if_due()
+        self.logger.info(f"Invalidated {len(keys)} cached outputs for {device or 'all devices'}")
+        return len(keys)
+
+    def load(self) -> None:
+        """
+        Loads unexpired entries from persist_path
+        """
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="UTF-8") as cache_file:
+                stored = json.load(cache_file)
+        except (OSError, json.JSONDecodeError) as exc:
+            self.logger.warning(f"Failed to load command cache from {self.persist_path} - {exc}")
+            return
+        now = time.time()
+        for stored_entry in stored.get("entries", []):
+            entry = CacheEntry(**stored_entry)
+            if entry.expires_at > now and entry.size <= self.max_bytes:
+                self._store((entry.device, entry.command), entry)
+        self._dirty = False
+        self.logger.debug(f"Loaded {len(self.entries)} cached outputs from {self.persist_path}")
+
+    def save(self) -> None:
+        """
+        Writes unexpired entries to persist_path
+        """
+        if not self.persist_path:
+            return
+        with self._save_lock:
+            now = time.time()
+            with self._lock:
+                entries = [asdict(entry) for entry in self.entries.values() if entry.expires_at > now]
+                self._dirty = False
+            self._last_saved = time.monotonic()
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, "w", encoding="UTF-8") as cache_file:
+                json.dump({"entries": entries}, cache_file)
+            os.replace(tmp_path, self.persist_path)
+        self.logger.debug(f"Saved {len(entries)} cached outputs to {self.persist_path}")
+
+    def save_if_due(self) -> None:
+        """
+        Saves if entries changed, right away if save_interval has passed since the last save,
+        otherwise from a timer once it has. A failed save is logged, the next change tries again
+        """
+        if not self.persist_path or not self._dirty:
+            return
+        wait = self.save_interval - (time.monotonic() - self._last_saved)
+        if wait > 0:
+            with self._lock:
+                if self._save_timer is None:
+                    self._save_timer = threading.Timer(wait, self._timed_save)
+                    self._save_timer.daemon = True
+                    self._save_timer.start()
+            return
+        try:
+            self.save()
+        except OSError as exc:
+            self._dirty = True
+            self.logger.warning(f"Failed to save command cache to {self.persist_path} - {exc}")
+
+    def _timed_save(self) -> None:
+        with self._lock:
+            self._save_timer = None
+        self.save_if_due()
+
+    def __enter__(self):
+        """
+        Enter context manager, return self.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Exit context manager, persist the cache if configured.
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+        self.save()
@@ -0,0 +1,299 @@
+"""
+Keeps SSH sessions to network devices open between commands so each command
+doesn't pay for key exchange, auth and prompt detection again.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from netmiko import ConnectHandler
+from netmiko.base_connection import BaseConnection
+from netmiko.exceptions import NetmikoAuthenticationException, NetmikoTimeoutException
+from paramiko.ssh_exception import SSHException
+
+from tracing.tracer import get_tracer
+
+# A dropped or stale session, worth one retry on a fresh session. Failed logins aren't
+CONNECTION_ERRORS = (NetmikoTimeoutException, SSHException, EOFError, OSError)
+
+
+@dataclass
+class PooledConnection:
+    """
+    A live netmiko session along with its bookkeeping. users counts the threads that have
+    checked the entry out, it is only changed under the pool lock and busy entries are never evicted
+    """
+    conn: Optional[BaseConnection]
+    last_used: float
+    users: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+@dataclass
+class PoolStats:
+    """
+    Counters used to see how much the pool is saving
+    """
+    hits: int = 0
+    misses: int = 0
+    reconnects: int = 0
+    evictions: int = 0
+    connects: int = 0
+    connect_seconds: float = 0.0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        avg_connect = self.connect_seconds / self.connects if self.connects else 0.0
+        return (
+            f"pool hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2f} "
+            f"reconnects={self.reconnects} evictions={self.evictions} "
+            f"connects={self.connects} avg_connect={avg_connect:.2f}s"
+        )
+
+
+class ConnectionPool:
+    """
+    Pool of netmiko sessions keyed by device, devices are (device_name, ip_address) tuples.
+    A session is only used by one thread at a time, idle sessions are closed after idle_ttl
+    seconds and no more than max_sessions are kept open.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 20,
+        idle_ttl: int = 300,
+        connect_timeout: int = 20,
+        device_type: str = "cisco_ios",
+    ):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.connect_timeout = connect_timeout
+        self.device_type = device_type
+        self.sessions: OrderedDict[str, PooledConnection] = OrderedDict()
+        self.stats = PoolStats()
+        self._lock = threading.Lock()
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    @staticmethod
+    def device_key(device: tuple) -> str:
+        """
+        Pool key for a device, name and ip so a readdressed device gets a new session
+        """
+        return f"{device[0]}@{device[1]}"
+
+    def connect(self, device: tuple) -> BaseConnection:
+        """
+        Opens a brand new session to the device, timing how long it takes
+        """
+        connect_data = {
+            "device_type": self.device_type,
+            "host": device[1],
+            "username": os.getenv("DEVICE_USERNAME"),
+            "password": os.getenv("DEVICE_PASSWORD"),
+            "timeout": self.connect_timeout,
+        }
+        start = time.perf_counter()
+        conn = ConnectHandler(**connect_data)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats.connects += 1
+            self.stats.connect_seconds += elapsed
+        self.logger.debug(f"Connected to {device[0]} in {elapsed:.2f}s")
+        return conn
+
+    @staticmethod
+    def is_healthy(pooled: PooledConnection) -> bool:
+        """
+        Health check, netmiko sends a null byte and checks the transport is still active
+        """
+        try:
+            return pooled.conn.is_alive()
+        except Exception:
+            return False
+
+    def _close(self, key: str, conn: Optional[BaseConnection]) -> None:
+        """
+        Disconnects a session, errors are ignored since the session is being thrown away.
+        Never called while holding self._lock, a disconnect can block on the network
+        """
+        if conn is None:
+            return
+        try:
+            conn.disconnect()
+        except Exception as exc:
+            self.logger.debug(f"Error closing session {key} - {exc}")
+
+    def evict_idle(self) -> None:
+        """
+        Closes every session that hasn't been used in idle_ttl seconds and isn't checked out
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, pooled in list(self.sessions.items()):
+                if now - pooled.last_used > self.idle_ttl and pooled.users == 0:
+                    expired.append((key, self.sessions.pop(key)))
+                    self.stats.evictions += 1
+        for key, pooled in expired:
+            self.logger.debug(f"Evicting idle session {key}")
+            self._close(key, pooled.conn)
+
+    def _make_room(self) -> tuple[bool, Optional[tuple[str, PooledConnection]]]:
+        """
+        Removes the least recently used session nobody has checked out if the pool is full.
+        Must be called while holding self._lock, returns whether there is room and the removed
+        (key, entry) for the caller to close once the lock is released
+        """
+        if len(self.sessions) < self.max_sessions:
+            return True, None
+        for key, pooled in self.sessions.items():
+            if pooled.users == 0:
+                del self.sessions[key]
+                self.stats.evictions += 1
+                return True, (key, pooled)
+        return False, None
+
+    def _checkout(self, key: str) -> Optional[PooledConnection]:
+        """
+        Marks the device's entry as in use, adding an unconnected entry if there isn't one.
+        None if the pool is full of busy sessions
+        """
+        evicted = None
+        with self._lock:
+            pooled = self.sessions.get(key)
+            if pooled is None:
+                self.stats.misses += 1
+                has_room, evicted = self._make_room()
+                if has_room:
+                    pooled = PooledConnection(conn=None, last_used=time.monotonic())
+                    self.sessions[key] = pooled
+            else:
+                self.stats.hits += 1
+                self.sessions.move_to_end(key)
+            if pooled is not None:
+                pooled.users += 1
+        if evicted is not None:
+            self.logger.debug(f"Pool full, evicting session {evicted[0]}")
+            self._close(evicted[0], evicted[1].conn)
+        return pooled
+
+    def _release(self, pooled: PooledConnection) -> None:
+        with self._lock:
+            pooled.users -= 1
+
+    def _is_pooled(self, key: str, pooled: PooledConnection) -> bool:
+        with self._lock:
+            return self.sessions.get(key) is pooled
+
+    def _discard(self, key: str, pooled: PooledConnection) -> None:
+        """
+        Drops an entry whose session failed or never connected, the caller holds pooled.lock
+        """
+        with self._lock:
+            if self.sessions.get(key) is pooled:
+                del self.sessions[key]
+        conn, pooled.conn = pooled.conn, None
+        self._close(key, conn)
+
+    def _ensure_connected(self, key: str, pooled: PooledConnection, device: tuple) -> None:
+        """
+        Connects an entry that has no session or whose session failed its health check,
+        the caller holds pooled.lock. A failed connect drops the entry
+        """
+        reconnecting = pooled.conn is not None and not self.is_healthy(pooled)
+        if reconnecting:
+            self.logger.debug(f"Session {key} failed health check, reconnecting")
+            conn, pooled.conn = pooled.conn, None
+            self._close(key, conn)
+        if pooled.conn is None:
+            try:
+                pooled.conn = self.connect(device)
+            except Exception:
+                self._discard(key, pooled)
+                raise
+            if reconnecting:
+                with self._lock:
+                    self.stats.reconnects += 1
+
+    @contextmanager
+    def session(self, device: tuple) -> Iterator[BaseConnection]:
+        """
+        Yields a healthy session for the device, reusing a pooled one when possible.
+        If the pool is full of busy sessions a temporary session is used and closed afterwards.
+        """
+        self.evict_idle()
+        key = self.device_key(device)
+        while True:
+            pooled = self._checkout(key)
+            if pooled is None:
+                self.logger.debug(f"Pool full, using a temporary session for {key}")
+                with self.connect(device) as conn:
+                    yield conn
+                return
+            try:
+                with pooled.lock:
+                    if not self._is_pooled(key, pooled):
+                        # Dropped by another thread's failure while this one waited, start again on a new entry
+                        continue
+                    self._ensure_connected(key, pooled, device)
+                    try:
+                        yield pooled.conn
+                    except Exception:
+                        # Session state is unknown after a failure, drop it so the next call reconnects
+                        self._discard(key, pooled)
+                        raise
+                    finally:
+                        pooled.last_used = time.monotonic()
+                    return
+            finally:
+                self._release(pooled)
+
+    def send_command(self, device: tuple, command: str, read_timeout: int = 20) -> str:
+        """
+        Sends a command using a pooled session. If the session drops, the command is retried
+        once on a new session. Other errors, a failed login or a read timeout, aren't retried
+        """
+        try:
+            with self.session(device) as conn:
+                return conn.send_command(command, read_timeout=read_timeout)
+        except CONNECTION_ERRORS as exc:
+            if isinstance(exc, NetmikoAuthenticationException):
+                raise
+            self.logger.warning(f"Session to {device[0]} dropped, retrying on a new session - {exc}")
+            get_tracer().record_retry()
+        with self.session(device) as conn:
+            with self._lock:
+                self.stats.reconnects += 1
+            return conn.send_command(command, read_timeout=read_timeout)
+
+    def close_all(self) -> None:
+        """
+        Disconnects every pooled session
+        """
+        with self._lock:
+            sessions = list(self.sessions.items())
+            self.sessions.clear()
+        for key, pooled in sessions:
+            self._close(key, pooled.conn)
+
+    def __enter__(self):
+        """
+        Enter context manager, return self.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Exit context manager, close every session.
+        """
+        self.close_all()
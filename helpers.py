@@ -1,26 +1,32 @@
 import os
+import hashlib
 import logging
-import random
-import string
 
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 
-def generate_random_id(length=16):
+def generate_document_id(*parts: str) -> str:
     """
-    Generates a 16 character id for chroma docs
-    might be a builtin way to do this I'm not aware of
+    Deterministic id for chroma docs, hash of the parts that identify the document
+    so the same command on the same page always gets the same id
     """
-    characters = string.ascii_letters + string.digits
-    random_id = ''.join(random.choices(characters, k=length))
-    return random_id
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:32]
+
+def content_hash(text: str) -> str:
+    """
+    Hash of a document's content, used to tell if a document changed between scrapes
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 def get_logger():
     """
     Logger factory - Configures logging to include both file and console handlers.
+    Handlers are only attached on the first call, later calls return the same configured logger
     Returns Logger object
     """
     logger = logging.getLogger("ios-xe-rag-builder")
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.DEBUG)  # Set the minimum level of logs to capture
 
     # Create a logs directory if it doesn't exist
@@ -49,4 +55,4 @@ def get_logger():
     logger.addHandler(rfh)
     logger.addHandler(ch)
 
-    return logger
\ No newline at end of file
+    return logger
@@ -0,0 +1,219 @@
+"""
+On disk HTTP cache for the scrapers. Stores response bodies along with their
+ETag/Last-Modified headers, revalidates them with conditional requests and can
+replay a recorded crawl fully offline.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import httpx
+
+# Only these headers are kept, enough to revalidate and decode the body
+STORED_HEADERS = ("etag", "last-modified", "content-type")
+
+
+class HttpCacheMiss(Exception):
+    """
+    Raised in offline mode when a request was never recorded
+    """
+
+
+@dataclass
+class CachedResponse:
+    """
+    Metadata for a cached response, the body is stored next to it
+    """
+    url: str
+    method: str
+    status_code: int
+    headers: dict
+    fetched_at: float
+
+
+@dataclass
+class HttpCacheStats:
+    """
+    Counters for the http cache
+    """
+    hits: int = 0
+    revalidated: int = 0
+    misses: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        return f"http cache hits={self.hits} revalidated={self.revalidated} misses={self.misses}"
+
+
+class HttpCache:
+    """
+    Cache keyed by method, url and request params. GETs are revalidated with If-None-Match /
+    If-Modified-Since and a 304 is served from disk. In offline mode nothing is sent,
+    recorded responses are replayed and anything not recorded raises HttpCacheMiss.
+    """
+
+    def __init__(self, cache_dir: str, offline: bool = False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.stats = HttpCacheStats()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    @staticmethod
+    def make_key(method: str, url: str, params: Optional[dict] = None) -> str:
+        """
+        Cache key for a request
+        """
+        raw = json.dumps([method.upper(), url, params or {}], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        directory = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(directory, f"{key}.json"), os.path.join(directory, f"{key}.body")
+
+    def load(self, key: str) -> Optional[tuple[CachedResponse, bytes]]:
+        """
+        Returns the cached metadata and body for a key if present
+        """
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="UTF-8") as meta_file:
+                entry = CachedResponse(**json.load(meta_file))
+            with open(body_path, "rb") as body_file:
+                body = body_file.read()
+        except (OSError, ValueError, TypeError):
+            return None
+        return entry, body
+
+    def store(self, key: str, response: httpx.Response) -> None:
+        """
+        Writes a successful response to disk, body first so a crash never leaves metadata without a body
+        """
+        meta_path, body_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        entry = CachedResponse(
+            url=str(response.request.url),
+            method=response.request.method,
+            status_code=response.status_code,
+            headers={name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+            fetched_at=time.time(),
+        )
+        with open(body_path, "wb") as body_file:
+            body_file.write(response.content)
+        with open(meta_path, "w", encoding="UTF-8") as meta_file:
+            json.dump(asdict(entry), meta_file)
+
+    @staticmethod
+    def to_response(entry: CachedResponse, body: bytes) -> httpx.Response:
+        """
+        Rebuilds an httpx.Response from a cached entry
+        """
+        return httpx.Response(
+            status_code=entry.status_code,
+            headers=entry.headers,
+            content=body,
+            request=httpx.Request(entry.method, entry.url),
+        )
+
+    @staticmethod
+    def conditional_headers(entry: CachedResponse) -> dict:
+        """
+        Validators to send so the server can answer 304 Not Modified
+        """
+        headers = {}
+        if "etag" in entry.headers:
+            headers["If-None-Match"] = entry.headers["etag"]
+        if "last-modified" in entry.headers:
+            headers["If-Modified-Since"] = entry.headers["last-modified"]
+        return headers
+
+    def before_request(self, method: str, url: str, params: Optional[dict] = None) -> tuple[str, Optional[tuple], Optional[httpx.Response], dict]:
+        """
+        Looks up the request, returns (key, cached, replayed response, extra headers).
+        A replayed response means the request shouldn't be sent at all
+        """
+        key = self.make_key(method, url, params)
+        cached = self.load(key)
+        if self.offline:
+            if cached is None:
+                with self._lock:
+                    self.stats.misses += 1
+                raise HttpCacheMiss(f"{method} {url} was never recorded")
+            with self._lock:
+                self.stats.hits += 1
+            return key, cached, self.to_response(*cached), {}
+        if cached is None or method.upper() != "GET":
+            return key, cached, None, {}
+        return key, cached, None, self.conditional_headers(cached[0])
+
+    def after_response(self, key: str, cached: Optional[tuple], response: httpx.Response) -> httpx.Response:
+        """
+        Serves a 304 from the cache, records successful responses
+        """
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self.stats.revalidated += 1
+            return self.to_response(*cached)
+        with self._lock:
+            self.stats.misses += 1
+        if response.status_code == 200:
+            self.store(key, response)
+        return response
+
+    def request(self, method: str, url: str, params: Optional[dict] = None, headers: Optional[dict] = None, **kwargs) -> httpx.Response:
+        """
+        Sync request through the cache, kwargs are passed on to httpx.request
+        """
+        key, cached, replayed, extra_headers = self.before_request(method, url, params)
+        if replayed is not None:
+            return replayed
+        response = httpx.request(method, url, params=params, headers={**(headers or {}), **extra_headers}, **kwargs)
+        return self.after_response(key, cached, response)
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        """
+        Sync GET through the cache
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        """
+        Sync POST through the cache, POSTs are recorded for replay but never revalidated
+        """
+        return self.request("POST", url, **kwargs)
+
+    async def alookup(self, method: str, url: str) -> tuple[str, Optional[tuple], Optional[httpx.Response], dict]:
+        """
+        before_request with the disk reads on a worker thread
+        """
+        return await asyncio.to_thread(self.before_request, method, url)
+
+    async def asend(self, client: httpx.AsyncClient, url: str, lookup: tuple, headers: Optional[dict] = None) -> httpx.Response:
+        """
+        Sends a GET that alookup didn't replay, with its validators, and records the response.
+        Disk writes run on a worker thread
+        """
+        key, cached, _, extra_headers = lookup
+        response = await client.get(url, headers={**(headers or {}), **extra_headers})
+        return await asyncio.to_thread(self.after_response, key, cached, response)
+
+    async def aget(self, client: httpx.AsyncClient, url: str, headers: Optional[dict] = None) -> httpx.Response:
+        """
+        Async GET through the cache using the caller's client
+        """
+        lookup = await self.alookup("GET", url)
+        if lookup[2] is not None:
+            return lookup[2]
+        return await self.asend(client, url, lookup, headers)
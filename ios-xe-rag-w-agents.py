@@ -1,12 +1,29 @@
+import asyncio
+from contextlib import nullcontext
+
 import click
 
 from dotenv import load_dotenv
 from ciscoforumscraper.cisco_forum_scraper import ForumScraper
 from cmd_ref_scraper.commandrefscraper import CommandRefScraper
+from cmd_ref_scraper.asynccrawler import AsyncCrawler
+from cmd_ref_scraper.streamingloader import StreamingLoader
+from http_cache.httpcache import HttpCache
 from agentic_flow.agenticflow import AgenticFlow
+from agentic_flow.semanticcache import SemanticCache
 from agentic_flow.prompts import *
 from vector_store.vectorstoreinterface import VectorStoreInterface
+from vector_store.reranker import RERANKERS, get_reranker
+from benchmarks.rerank_benchmark import load_labelled_questions, run_rerank_benchmark
+from benchmarks.flow_benchmark import load_flow_scenarios, run_flow_benchmark
+from benchmarks.retrieval_benchmark import STRATEGIES, describe_store, format_results, missing_commands, offline_vector_store, run_retrieval_benchmark
+from benchmarks import dense_index_benchmark
 from agent.agent import Agent
+from agent.responsecache import ResponseCache
+from connection_pool.connectionpool import ConnectionPool
+from command_cache.commandcache import CommandCache, DEFAULT_TTL_RULES
+from token_budget.tokenbudget import TokenBudget
+from tracing.tracer import configure_tracer
 
 
 load_dotenv()
@@ -15,6 +32,23 @@ load_dotenv()
 def main_menu(): ...
 
 
+EMBEDDING_MODEL_HELP = (
+    "Embedding model as backend[:model], backends are openai, sentence-transformers and onnx (local, CPU only) "
+    "and hashing (deterministic, offline). Defaults to the model the store was built with, openai for new stores"
+)
+
+
+def build_http_cache(http_cache_dir: str, offline: bool):
+    """
+    Creates the scrapers' http cache from the cli options
+    """
+    if offline and not http_cache_dir:
+        raise click.UsageError("--offline requires --http-cache-dir")
+    if not http_cache_dir:
+        return None
+    return HttpCache(cache_dir=http_cache_dir, offline=offline)
+
+
 @main_menu.command(name="forum-scrape")
 @click.option(
     "--state-file", 
@@ -33,12 +67,14 @@ def main_menu(): ...
     help="Looks at state file to determine where it last left off, and continues from there",
     is_flag=True,
 )
-def forum_scrape(state_file: str, base_url: str, use_last_offset: bool):
+@click.option("--http-cache-dir", help="Directory to cache downloaded pages in, pages aren't cached if unset")
+@click.option("--offline", help="Replay pages from --http-cache-dir without sending any requests", is_flag=True, default=False)
+def forum_scrape(state_file: str, base_url: str, use_last_offset: bool, http_cache_dir: str, offline: bool):
     """
     Creates a forum scraper object
     begins scraping the forums for q and a
     """
-    scraper = ForumScraper(base_url=base_url)
+    scraper = ForumScraper(base_url=base_url, http_cache=build_http_cache(http_cache_dir, offline))
     if use_last_offset:
         offset = scraper.find_latest_offset(file_path=state_file)
     else:
@@ -54,42 +90,279 @@ def forum_scrape(state_file: str, base_url: str, use_last_offset: bool):
 @click.option("--base-url", help="Base url to start the scraper on", required=True)
 @click.option("--vector-store", help="Name of your vector store path", required=True)
 @click.option("--command-filter", help="Only grab certain commands, ex. 'show' would only give show commands")
-def cmd_ref_scrape(base_url, vector_store, command_filter):
+@click.option(
+    "--incremental",
+    help=(
+        "Only embed new or changed commands and remove commands that no longer exist upstream from books whose pages "
+        "all loaded (not with --command-filter, and with --stream not from books skipped by the checkpoint). "
+        "Duplicates are left for dedup-vector-store"
+    ),
+    is_flag=True,
+    default=False,
+)
+@click.option("--concurrency", help="Max requests in flight per host", show_default=True, default=8, type=int)
+@click.option("--requests-per-second", help="Max requests per second per host, unlimited if unset", type=float)
+@click.option("--http-cache-dir", help="Directory to cache downloaded pages in, pages aren't cached if unset")
+@click.option("--offline", help="Replay pages from --http-cache-dir without sending any requests", is_flag=True, default=False)
+@click.option("--parse-workers", help="Processes used to parse command pages while downloading, 0 parses inline", show_default=True, default=4, type=int)
+@click.option(
+    "--stream",
+    help="Write each book to the vector store as soon as it is scraped, and resume from --checkpoint-file after an interruption",
+    is_flag=True,
+    default=False,
+)
+@click.option("--checkpoint-file", help="Checkpoint of loaded books for --stream, defaults to <vector-store>.checkpoint.json")
+@click.option("--embedding-model", help=EMBEDDING_MODEL_HELP)
+def cmd_ref_scrape(base_url, vector_store, command_filter, incremental, concurrency, requests_per_second, http_cache_dir, offline, parse_workers,
+                   stream, checkpoint_file, embedding_model):
     """
     Scrapes the cisco command ref docs. Only tested with the following page -
     https://www.cisco.com/c/en/us/td/docs/ios-xml/ios/17_xe/command/command-references.html
     """
-    cmd_ref_scraper = CommandRefScraper(base_url=base_url, vectorstore_name=vector_store, command_filter=command_filter)
-    cmd_ref_scraper.get_all_topic_names()
-    for topic in cmd_ref_scraper.topics:
-        cmd_ref_scraper.create_topic_toc(topic_name=topic)
+    http_cache = build_http_cache(http_cache_dir, offline)
+    with CommandRefScraper(
+        base_url=base_url,
+        vectorstore_name=vector_store,
+        command_filter=command_filter,
+        http_cache=http_cache,
+        embedding_model=embedding_model,
+    ) as cmd_ref_scraper:
+
+        async def crawl():
+            async with AsyncCrawler(max_concurrency_per_host=concurrency, requests_per_second=requests_per_second, http_cache=http_cache) as crawler:
+                await cmd_ref_scraper.crawl(crawler, parse_workers=parse_workers)
 
-    for topic_toc in cmd_ref_scraper.topic_tocs:
-        cmd_ref_scraper.create_command_ref_toc(topic_toc=topic_toc)
-        for command_ref_toc in topic_toc.command_ref_tocs:
-            cmd_ref_scraper.scrape_command_ref_page(command_ref_toc=command_ref_toc)
+        async def crawl_and_stream(loader: StreamingLoader):
+            async with AsyncCrawler(max_concurrency_per_host=concurrency, requests_per_second=requests_per_second, http_cache=http_cache) as crawler:
+                async with loader:
+                    await cmd_ref_scraper.crawl(crawler, parse_workers=parse_workers, loader=loader)
 
+        if stream:
+            loader = StreamingLoader(
+                vector_store=cmd_ref_scraper.get_vector_store(),
+                checkpoint_path=checkpoint_file or f"{vector_store.rstrip('/')}.checkpoint.json",
+                incremental=incremental,
+            )
+            asyncio.run(crawl_and_stream(loader))
+            if incremental:
+                print(f"removed={cmd_ref_scraper.remove_missing(loader.vector_store, loader.loaded_books)}")
+            # Every book and page made it into the store, the next run should start from scratch
+            if loader.stats.all_loaded:
+                loader.clear_checkpoint()
+        else:
+            asyncio.run(crawl())
+        if http_cache is not None:
+            cmd_ref_scraper.logger.info(http_cache.stats.summary())
 
-    cmd_ref_scraper.create_and_load_vectorstore()
-    cmd_ref_scraper.delete_duplicates_in_vectorstore()
+        if not stream:
+            cmd_ref_scraper.create_and_load_vectorstore(incremental=incremental)
+        # An incremental load would re-add the duplicates on every run and never settle, dedup-vector-store removes them on demand
+        if not incremental:
+            cmd_ref_scraper.delete_duplicates_in_vectorstore()
+
+@main_menu.command(name="dedup-vector-store")
+@click.option("--vector-store", help="Name of your vector store path", required=True)
+@click.option("--dry-run", help="Only report the duplicates, don't delete them", is_flag=True, default=False)
+def dedup_vector_store(vector_store, dry_run):
+    """
+    Removes commands that were saved more than once in the vector store
+    """
+    with CommandRefScraper(base_url="", vectorstore_name=vector_store, command_filter=None) as cmd_ref_scraper:
+        duplicate_count = cmd_ref_scraper.delete_duplicates_in_vectorstore(dry_run=dry_run)
+    print(f"{'Found' if dry_run else 'Removed'} {duplicate_count} duplicate commands")
+
+@main_menu.command(name="rerank-benchmark")
+@click.option("--vector-store-path", help="Vector store path that contains the commands to retrieve from", required=True)
+@click.option("--questions-file", help="Labelled (question, expected command) pairs", show_default=True, default="benchmarks/labelled_questions.json")
+@click.option("--reranker", "rerankers", help="Reranker to benchmark, can be repeated", multiple=True, default=["keyword"], show_default=True, type=click.Choice(list(RERANKERS)))
+@click.option("--k-document-count", help="Commands retrieved per question", show_default=True, default=10, type=int)
+@click.option("--rerank-threshold", help="Confidence needed to skip the command finder agent", show_default=True, default=0.9, type=float)
+@click.option("--embedding-model", help=EMBEDDING_MODEL_HELP)
+def rerank_benchmark(vector_store_path: str, questions_file: str, rerankers: tuple[str], k_document_count: int, rerank_threshold: float, embedding_model: str):
+    """
+    Benchmarks the rerankers against a labelled question set
+    """
+    labelled_questions = load_labelled_questions(questions_file)
+    retrieval_cache = {}
+    with VectorStoreInterface(vs_name=vector_store_path, embedding_model=embedding_model) as vector_store:
+        for reranker_name in rerankers:
+            result = run_rerank_benchmark(
+                vector_store,
+                get_reranker(reranker_name),
+                labelled_questions,
+                k_document_count=k_document_count,
+                threshold=rerank_threshold,
+                retrieval_cache=retrieval_cache,
+            )
+            print(result.summary())
+
+@main_menu.command(name="retrieval-benchmark")
+@click.option("--vector-store-path", help="Vector store path that contains the commands to retrieve from", required=True)
+@click.option("--questions-file", help="Labelled (question, expected command) pairs", show_default=True, default="benchmarks/labelled_questions.json")
+@click.option("--k", "k_values", help="Commands retrieved per question, can be repeated", multiple=True, default=[1, 5, 10, 20, 30], show_default=True, type=int)
+@click.option("--strategy", "strategies", help="Search strategy to benchmark, can be repeated", multiple=True, default=STRATEGIES, show_default=True, type=click.Choice(STRATEGIES))
+@click.option(
+    "--live-embeddings",
+    help=(
+        "Query with the store's own embeddings, calls the embedding api. By default documents are re-embedded "
+        "with a local hashing function and searched in memory, so only relative comparisons between strategies "
+        "and k are meaningful, not the absolute recall or latency"
+    ),
+    is_flag=True,
+    default=False,
+)
+@click.option("--embedding-model", help=f"Used with --live-embeddings. {EMBEDDING_MODEL_HELP}")
+def retrieval_benchmark(vector_store_path: str, questions_file: str, k_values: tuple[int], strategies: tuple[str], live_embeddings: bool, embedding_model: str):
+    """
+    Benchmarks recall@k, MRR and latency of each search strategy against a labelled question set.
+    Without --live-embeddings only the relative ranking of strategies and k is meaningful
+    """
+    labelled_questions = load_labelled_questions(questions_file)
+    with VectorStoreInterface(vs_name=vector_store_path, embedding_model=embedding_model) as vector_store:
+        retrieval_store = vector_store if live_embeddings else offline_vector_store(vector_store)
+        missing = missing_commands(retrieval_store, labelled_questions)
+        if missing:
+            print(f"Expected commands not in the store, recall can't reach 1.0 - {missing}")
+        results = run_retrieval_benchmark(retrieval_store, labelled_questions, list(k_values), list(strategies))
+        description = describe_store(retrieval_store)
+    print(format_results(results, description))
+
+@main_menu.command(name="dense-index-benchmark")
+@click.option("--vector-store-path", help="Vector store path that contains the commands to retrieve from", required=True)
+@click.option("--questions-file", help="Labelled (question, expected command) pairs", show_default=True, default="benchmarks/labelled_questions.json")
+@click.option("--k", "k_values", help="Commands retrieved per question, can be repeated", multiple=True, default=[1, 5, 10, 30], show_default=True, type=int)
+@click.option("--iterations", help="Times every question is searched on each path", show_default=True, default=3, type=click.IntRange(min=1))
+@click.option("--embedding-model", help=EMBEDDING_MODEL_HELP)
+def dense_index_benchmark_command(vector_store_path: str, questions_file: str, k_values: tuple[int], iterations: int, embedding_model: str):
+    """
+    Benchmarks similarity search through Chroma against the in process dense index, rebuilds the index
+    """
+    labelled_questions = load_labelled_questions(questions_file)
+    with VectorStoreInterface(vs_name=vector_store_path, embedding_model=embedding_model) as vector_store:
+        results, setup = dense_index_benchmark.run_dense_index_benchmark(vector_store, labelled_questions, list(k_values), iterations=iterations)
+    print(dense_index_benchmark.format_results(results, setup))
+
+@main_menu.command(name="flow-benchmark")
+@click.option("--scenarios-file", help="Topology, command documents, recorded device output and scripted questions", show_default=True, default="benchmarks/flow_scenarios.json")
+@click.option("--iterations", help="Times every question is asked, the first (cold) iteration is reported separately from the rest", show_default=True, default=3, type=int)
+@click.option("--llm-latency", help="Seconds each fake LLM call takes", show_default=True, default=0.2, type=float)
+@click.option("--device-delay", help="Seconds each simulated device command takes", show_default=True, default=0.5, type=float)
+@click.option("--connect-delay", help="Seconds each simulated SSH connect takes", show_default=True, default=1.0, type=float)
+@click.option("--retrieval-latency", help="Seconds each fake vector store query takes", show_default=True, default=0.05, type=float)
+@click.option("--max-concurrency", help="Max number of devices to run commands on and answer for at the same time", show_default=True, default=10, type=int)
+@click.option("--concurrent-steps/--sequential-steps", help="Overlap independent flow steps", show_default=True, default=True)
+@click.option("--command-cache/--no-command-cache", help="Cache device output between questions", show_default=True, default=True)
+@click.option("--semantic-cache/--no-semantic-cache", help="Reuse plans of similar earlier questions", show_default=True, default=True)
+@click.option("--search-type", help="How commands are retrieved", show_default=True, default="hybrid", type=click.Choice(["similarity", "hybrid"]))
+def flow_benchmark(scenarios_file: str, iterations: int, llm_latency: float, device_delay: float, connect_delay: float, retrieval_latency: float,
+                   max_concurrency: int, concurrent_steps: bool, command_cache: bool, semantic_cache: bool, search_type: str):
+    """
+    Benchmarks the agent workflow offline with a scripted LLM, an in memory store and simulated devices
+    """
+    result = run_flow_benchmark(
+        load_flow_scenarios(scenarios_file),
+        iterations=iterations,
+        llm_latency=llm_latency,
+        device_delay=device_delay,
+        connect_delay=connect_delay,
+        retrieval_latency=retrieval_latency,
+        max_concurrency=max_concurrency,
+        concurrent_steps=concurrent_steps,
+        command_cache=command_cache,
+        semantic_cache=semantic_cache,
+        search_type=search_type,
+    )
+    print(result.summary())
 
 @main_menu.command(name="agent-workflow")
 @click.option("--topology-file-path", help="Path to your topology file", show_default=True, default="topology_config.json")
 @click.option("--vector-store-path", help="Vector store path that contains the commands you want to use for RAG", required=True)
-def agentic(topology_file_path: str, vector_store_path:str):
+@click.option(
+    "--search-type",
+    help="How commands are retrieved, hybrid fuses keyword (BM25) and embedding search",
+    show_default=True,
+    default="hybrid",
+    type=click.Choice(["similarity", "hybrid"]),
+)
+@click.option("--embedding-model", help=EMBEDDING_MODEL_HELP)
+@click.option(
+    "--dense-index/--no-dense-index",
+    help="Run similarity search over an in process, memory mapped copy of the embeddings instead of Chroma's index, built on first use",
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--reranker",
+    help="Optional local reranker for retrieved commands, a confident pick skips the command finder agent. "
+         "Check the threshold with rerank-benchmark before turning one on",
+    show_default=True,
+    default="none",
+    type=click.Choice(["none", *RERANKERS]),
+)
+@click.option("--rerank-threshold", help="Reranker confidence needed to skip the command finder agent", show_default=True, default=0.9, type=float)
+@click.option(
+    "--semantic-cache/--no-semantic-cache",
+    help="Reuse the command picked for a similar earlier question that names the same devices and protocols, devices are always picked again",
+    show_default=True,
+    default=False,
+)
+@click.option("--semantic-cache-threshold", help="Cosine similarity needed to reuse an earlier question's plan", show_default=True, default=0.92, type=float)
+@click.option("--semantic-cache-ttl", help="Seconds a question's plan can be reused", show_default=True, default=3600, type=int)
+@click.option("--semantic-cache-size", help="Max number of question plans kept", show_default=True, default=256, type=int)
+@click.option(
+    "--concurrent-steps/--sequential-steps",
+    help="Overlap independent steps, device selection runs while the command is selected and device answers run together",
+    show_default=True,
+    default=True,
+)
+@click.option("--stream/--no-stream", help="Print the final answer as it is written instead of all at once", show_default=True, default=True)
+@click.option("--doc-token-budget", help="Max tokens of command documentation put in a prompt", show_default=True, default=3000, type=int)
+@click.option("--output-token-budget", help="Max tokens of device output put in a prompt", show_default=True, default=6000, type=int)
+@click.option("--trace/--no-trace", help="Time every LLM call, retrieval, device command and flow step, and print a summary per question", show_default=True, default=False)
+@click.option("--trace-dir", help="Directory a json lines trace is written to for every question with --trace, not written if unset", show_default=True, default=None)
+@click.option("--max-concurrency", help="Max number of devices to run commands on and answer for at the same time", show_default=True, default=10, type=int)
+@click.option("--device-timeout", help="Connect and read timeout in seconds for each device", show_default=True, default=20, type=int)
+@click.option("--max-sessions", help="Max number of SSH sessions kept open between questions", show_default=True, default=20, type=int)
+@click.option("--session-idle-ttl", help="Seconds an unused SSH session is kept open before it is closed", show_default=True, default=300, type=int)
+@click.option("--cache-file", help="json file to persist cached command output across restarts, saved every 30 seconds while it changes and on exit, not persisted if unset")
+@click.option("--cache-max-mb", help="Max size of cached command output in megabytes", show_default=True, default=50, type=int)
+@click.option("--cache-default-ttl", help="Seconds command output is cached when no ttl rule matches the command", show_default=True, default=120, type=int)
+@click.option("--cache-ttl", help="Per command ttl as 'command prefix=seconds', ex. 'show version=3600', can be repeated", multiple=True)
+@click.option("--llm-cache/--no-llm-cache", help="Reuse answers to identical temperature 0 LLM requests", show_default=True, default=True)
+@click.option("--llm-cache-file", help="SQLite file to persist LLM responses across restarts, not persisted if unset")
+@click.option("--llm-cache-size", help="Max number of LLM responses kept in memory", show_default=True, default=1024, type=int)
+@click.option("--llm-replay", help="Only answer from recorded LLM responses, never call the api", is_flag=True, default=False)
+def agentic(topology_file_path: str, vector_store_path:str, search_type: str, embedding_model: str, dense_index: bool, reranker: str, rerank_threshold: float,
+            semantic_cache: bool, semantic_cache_threshold: float, semantic_cache_ttl: int, semantic_cache_size: int, concurrent_steps: bool, stream: bool, doc_token_budget: int, output_token_budget: int, trace: bool, trace_dir: str, max_concurrency: int, device_timeout: int, max_sessions: int, session_idle_ttl: int,
+            cache_file: str, cache_max_mb: int, cache_default_ttl: int, cache_ttl: tuple[str],
+            llm_cache: bool, llm_cache_file: str, llm_cache_size: int, llm_replay: bool):
+    configure_tracer(trace_dir=trace_dir or None, enabled=trace)
+    if llm_replay and not llm_cache_file:
+        raise click.BadParameter("Replaying needs recorded responses", param_hint="--llm-cache-file")
+    response_cache = ResponseCache(
+        max_entries=llm_cache_size,
+        persist_path=llm_cache_file,
+        replay=llm_replay,
+    ) if llm_cache or llm_replay else None
+
     show_cmd_store = VectorStoreInterface(
-        vs_name=vector_store_path
+        vs_name=vector_store_path,
+        search_type=search_type,
+        embedding_model=embedding_model,
+        dense_index=dense_index,
     )
 
     multipart_q_agent = Agent(
         query_prompt=multipart_q_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         system_prompt="You are an expert at breaking down questions into subqueries if required, and providing an ordered list containing step by step subqueries that must be accomplished to answer the original query"
     )
 
     show_cmd_store_agent = Agent(
         query_prompt=cmd_store_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         retain_history=True,
         system_prompt="You are a Cisco IOS XE expert who can determine what command to run on a router to best deliver the desired result based on a user's query.",
     )   
@@ -97,34 +370,59 @@ def agentic(topology_file_path: str, vector_store_path:str):
     selected_command_validator_agent = Agent(
         query_prompt=selected_command_validator_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         system_prompt="You are a Cisco IOS expert who can evaluate a command's ability to answer a question based on given documentation"
     )
 
     cmd_creator_agent = Agent(
         query_prompt=cmd_creator_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         system_prompt="You are an expert network engineer who can digest command documentation and provide the approriate command string to answer the user's question",
     )
 
     topology_agent = Agent(
         query_prompt=topology_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         system_prompt="You maintain a knowledge base of network devices and their management addresses. You can disect questions and return back the devices that are referenced from your knowledge base"
     )
 
     device_answer_agent = Agent(
         query_prompt=device_answer_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         system_prompt="You are a Cisco IOS XE expert that can take command output along with documentation and a question, and deliver an accurate and detailed answer"
     )
 
     combined_answer_agent = Agent(
         query_prompt=combined_answer_agent_prompt,
         model="gpt-4o",
+        response_cache=response_cache,
         retain_history=False,
         system_prompt="You are an AI assistant that can take multiple users queries and combine multiple correct answers to sub-queries into an overall answer to the provided original query"
     )
 
+    connection_pool = ConnectionPool(
+        max_sessions=max_sessions,
+        idle_ttl=session_idle_ttl,
+        connect_timeout=device_timeout,
+    )
+
+    ttl_rules = dict(DEFAULT_TTL_RULES)
+    for rule in cache_ttl:
+        prefix, _, seconds = rule.rpartition("=")
+        if not prefix or not seconds.isdigit():
+            raise click.BadParameter(f"Expected 'command prefix=seconds', got '{rule}'", param_hint="--cache-ttl")
+        ttl_rules[prefix] = int(seconds)
+
+    command_cache = CommandCache(
+        max_bytes=cache_max_mb * 1024 * 1024,
+        default_ttl=cache_default_ttl,
+        ttl_rules=ttl_rules,
+        persist_path=cache_file,
+    )
+
     my_flow = AgenticFlow(
         show_cmd_store_agent=show_cmd_store_agent,
         selected_command_validator_agent=selected_command_validator_agent,
@@ -135,10 +433,29 @@ def agentic(topology_file_path: str, vector_store_path:str):
         device_answer_agent=device_answer_agent,
         combined_answer_agent=combined_answer_agent,
         show_cmd_store=show_cmd_store,
+        max_concurrency=max_concurrency,
+        device_timeout=device_timeout,
+        connection_pool=connection_pool,
+        command_cache=command_cache,
+        reranker=get_reranker(reranker),
+        rerank_threshold=rerank_threshold,
+        semantic_cache=SemanticCache(
+            embedding_function=show_cmd_store.embedding_function,
+            threshold=semantic_cache_threshold,
+            ttl=semantic_cache_ttl,
+            max_entries=semantic_cache_size,
+        ) if semantic_cache else None,
+        concurrent_steps=concurrent_steps,
+        stream_output=stream,
+        token_budget=TokenBudget(
+            documentation_tokens=doc_token_budget,
+            command_output_tokens=output_token_budget,
+        ),
     )
 
-    while True:
-        my_flow.initiate_flow()
+    with show_cmd_store, connection_pool, command_cache, response_cache or nullcontext(), my_flow:
+        while True:
+            my_flow.initiate_flow()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+from vector_store.commandindex import CommandIndex
+from vector_store.vectorstoreinterface import Document
+
+
+def make_index(*commands: str) -> CommandIndex:
+    return CommandIndex([Document(page_content=command, metadata={"command": command}) for command in commands])
+
+
+def test_prefix_match_extends_a_unique_prefix():
+    index = make_index("show ip route", "show version")
+    assert index.prefix_match("show ip") == "show ip route"
+
+
+def test_prefix_match_rejects_an_ambiguous_prefix():
+    index = make_index("show ip bgp neighbors", "show ip route", "show version")
+    assert index.prefix_match("show ip") is None
+    assert index.lookup("show ip") is None
+
+
+def test_prefix_match_drops_added_arguments():
+    index = make_index("show ip bgp neighbors", "show ip route")
+    assert index.prefix_match("show ip route 10.0.0.0") == "show ip route"
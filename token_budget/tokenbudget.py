@@ -0,0 +1,202 @@
+"""
+Token budgeting for the documentation and device output pasted into agent prompts.
+Oversized documentation is cut down to the sections that matter for picking and
+running a command, oversized device output to the chunks relevant to the question.
+"""
+import re
+import threading
+from dataclasses import dataclass, field
+
+from vector_store.bm25index import tokenize
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKENIZER_ENCODING = "cl100k_base"
+SECTION_HEADINGS = [
+    "Syntax Description",
+    "Command Default",
+    "Command Modes",
+    "Command History",
+    "Usage Guidelines",
+    "Examples",
+    "Related Commands",
+]
+# Sections kept when documentation is over budget, most useful first. Command History and
+# Related Commands are dropped
+SECTION_PRIORITY = ["Syntax Description", "Command Modes", "Examples", "Command Default", "Usage Guidelines"]
+SECTION_PATTERN = re.compile(rf"^[ \t]*({'|'.join(SECTION_HEADINGS)})\b", re.MULTILINE)
+
+_encoding = None
+_encoding_failed = False
+
+
+def get_encoding():
+    """
+    The tiktoken encoding, loaded on first use. None if tiktoken isn't installed or its
+    encoding file can't be loaded, ex. it isn't cached and there's no network
+    """
+    global _encoding, _encoding_failed
+    if tiktoken is not None and _encoding is None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as exc:
+            _encoding_failed = True
+            from helpers import get_logger
+            get_logger().warning(f"Couldn't load the {TOKENIZER_ENCODING} tokenizer, estimating token counts - {exc}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts tokens locally, exactly with tiktoken if it's installed, otherwise ~4 characters per token
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Keeps the start of text that fits in max_tokens
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max(0, max_tokens) * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max(0, max_tokens)])
+
+
+def split_sections(documentation: str) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Splits command documentation into the text before the first heading and (heading, text) sections
+    """
+    matches = list(SECTION_PATTERN.finditer(documentation))
+    if not matches:
+        return documentation, []
+    sections = []
+    for idx, match in enumerate(matches):
+        end = matches[idx + 1].start() if idx + 1 < len(matches) else len(documentation)
+        sections.append((match.group(1), documentation[match.start():end].strip()))
+    return documentation[:matches[0].start()].strip(), sections
+
+
+@dataclass
+class TokenUsage:
+    """
+    Token counters for an agent's calls. Cached calls cost no tokens
+    """
+    calls: int = 0
+    cached_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cached: bool = False) -> None:
+        with self._lock:
+            self.calls += 1
+            if cached:
+                self.cached_calls += 1
+                return
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        return (
+            f"calls={self.calls} cached_calls={self.cached_calls} "
+            f"prompt_tokens={self.prompt_tokens} completion_tokens={self.completion_tokens}"
+        )
+
+
+class TokenBudget:
+    """
+    Keeps documentation under documentation_tokens and device output under command_output_tokens.
+    Text that already fits is returned unchanged
+    """
+
+    def __init__(self, documentation_tokens: int = 3000, command_output_tokens: int = 6000, chunk_tokens: int = 400):
+        self.documentation_tokens = documentation_tokens
+        self.command_output_tokens = command_output_tokens
+        self.chunk_tokens = chunk_tokens
+
+    def compact_documentation(self, documentation: str) -> str:
+        """
+        Keeps the command and its description, then adds whole sections in SECTION_PRIORITY
+        order while they fit. Whatever budget is left goes to the start of the sections that
+        didn't fit, in the same order. Sections stay in their original order
+        """
+        if count_tokens(documentation) <= self.documentation_tokens:
+            return documentation
+        preamble, sections = split_sections(documentation)
+        preamble = truncate_tokens(preamble, self.documentation_tokens)
+        remaining = self.documentation_tokens - count_tokens(preamble)
+        prioritised = [
+            idx
+            for heading in SECTION_PRIORITY
+            for idx, (section_heading, _) in enumerate(sections)
+            if section_heading == heading
+        ]
+        kept = {}
+        for idx in prioritised:
+            cost = count_tokens(sections[idx][1])
+            if cost <= remaining:
+                kept[idx] = sections[idx][1]
+                remaining -= cost
+        for idx in prioritised:
+            if idx in kept or remaining <= 0:
+                continue
+            kept[idx] = truncate_tokens(sections[idx][1], remaining)
+            remaining -= count_tokens(kept[idx])
+        return "\n".join([preamble] + [kept[idx] for idx in sorted(kept)])
+
+    def compact_command_output(self, command_output: str, question: str) -> str:
+        """
+        Splits the output into chunks of whole lines, keeps the first chunk for its headers and
+        then the chunks sharing the most words with the question while they fit. Dropped lines
+        are marked so the answer agent knows the output is partial
+        """
+        if count_tokens(command_output) <= self.command_output_tokens:
+            return command_output
+        chunks: list[list[str]] = [[]]
+        chunk_cost = 0
+        for line in command_output.splitlines():
+            line_cost = count_tokens(line)
+            if chunks[-1] and chunk_cost + line_cost > self.chunk_tokens:
+                chunks.append([])
+                chunk_cost = 0
+            chunks[-1].append(line)
+            chunk_cost += line_cost
+        chunk_texts = ["\n".join(lines) for lines in chunks]
+
+        question_tokens = set(tokenize(question))
+        scores = [len(question_tokens & set(tokenize(text))) for text in chunk_texts]
+        first_chunk = truncate_tokens(chunk_texts[0], self.command_output_tokens)
+        chunk_texts[0] = first_chunk
+        selected = {0}
+        remaining = self.command_output_tokens - count_tokens(first_chunk)
+        for idx in sorted(range(1, len(chunk_texts)), key=lambda chunk_idx: (-scores[chunk_idx], chunk_idx)):
+            cost = count_tokens(chunk_texts[idx])
+            if cost <= remaining:
+                selected.add(idx)
+                remaining -= cost
+
+        parts = []
+        omitted_lines = 0
+        for idx, lines in enumerate(chunks):
+            if idx not in selected:
+                omitted_lines += len(lines)
+                continue
+            if omitted_lines:
+                parts.append(f"... {omitted_lines} lines omitted ...")
+                omitted_lines = 0
+            parts.append(chunk_texts[idx])
+        if omitted_lines:
+            parts.append(f"... {omitted_lines} lines omitted ...")
+        return "\n".join(parts)
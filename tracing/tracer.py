@@ -0,0 +1,213 @@
+"""
+Lightweight tracing for the agent pipeline. Spans around LLM calls, retrieval,
+device commands and flow steps are collected per question, exported as json lines
+and summarised in a table at the end of the question.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Optional
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    """
+    One timed unit of work. kind groups spans in the summary, ex. llm, retrieval, device, step.
+    trace_id is the trace that was active when the span started
+    """
+    name: str
+    kind: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    seconds: float = 0.0
+    status: str = "ok"
+    retries: int = 0
+    attributes: dict = field(default_factory=dict)
+
+
+@dataclass
+class SpanSummary:
+    """
+    Totals for every span sharing a kind and name
+    """
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    errors: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class Tracer:
+    """
+    Collects spans while a trace is active, spans outside a trace are not recorded.
+    A span that finishes after its trace did, ex. in a device thread that outlived the run's deadline,
+    is dropped rather than added to the next trace. The current span is tracked in a context variable so spans nest across threads started
+    with a copied context and across asyncio tasks
+    """
+
+    def __init__(self, trace_dir: Optional[str] = None, enabled: bool = True):
+        self.trace_dir = trace_dir
+        self.enabled = enabled
+        self.trace_id: Optional[str] = None
+        self.trace_name: Optional[str] = None
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, kind: str = "step", **attributes):
+        """
+        Times the block as a span, yields the span (or None outside a trace) so attributes can be added
+        """
+        if not self.enabled or self.trace_id is None:
+            yield None
+            return
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            kind=kind,
+            trace_id=self.trace_id,
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent.span_id if parent else None,
+            start=time.time(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as exc:
+            span.status = f"error: {type(exc).__name__}"
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            _current_span.reset(token)
+            with self._lock:
+                if span.trace_id == self.trace_id:
+                    self.spans.append(span)
+
+    def traced(self, name: str, kind: str = "step"):
+        """
+        Decorator version of span for sync and async functions
+        """
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name, kind):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, kind):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    def annotate(self, **attributes) -> None:
+        """
+        Adds attributes to the current span, if any
+        """
+        span = _current_span.get()
+        if span is not None:
+            span.attributes.update(attributes)
+
+    def record_retry(self) -> None:
+        """
+        Counts a retry against the current span, if any
+        """
+        span = _current_span.get()
+        if span is not None:
+            with self._lock:
+                span.retries += 1
+
+    def start_trace(self, name: str) -> None:
+        """
+        Starts collecting spans for a question, dropping any from the previous trace
+        """
+        with self._lock:
+            self.trace_id = uuid.uuid4().hex[:16]
+            self.trace_name = name
+            self.spans = []
+
+    def finish_trace(self) -> Optional[str]:
+        """
+        Stops collecting, writes the trace as json lines if trace_dir is set and returns the summary table
+        """
+        if self.trace_id is None:
+            return None
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+            trace_id, trace_name = self.trace_id, self.trace_name
+            self.trace_id, self.trace_name, self.spans = None, None, []
+        if self.trace_dir:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            trace_path = os.path.join(self.trace_dir, f"trace-{timestamp}-{trace_id}.jsonl")
+            with open(trace_path, "w", encoding="UTF-8") as trace_file:
+                for span in spans:
+                    trace_file.write(json.dumps({"question": trace_name, **asdict(span)}, default=str) + "\n")
+        return self.summary_table(spans)
+
+    @staticmethod
+    def summarize(spans: list[Span]) -> dict[tuple[str, str], SpanSummary]:
+        summaries: dict[tuple[str, str], SpanSummary] = {}
+        for span in spans:
+            summary = summaries.setdefault((span.kind, span.name), SpanSummary())
+            summary.count += 1
+            summary.seconds += span.seconds
+            summary.max_seconds = max(summary.max_seconds, span.seconds)
+            summary.errors += span.status != "ok"
+            summary.retries += span.retries
+            summary.prompt_tokens += span.attributes.get("prompt_tokens", 0)
+            summary.completion_tokens += span.attributes.get("completion_tokens", 0)
+        return summaries
+
+    @classmethod
+    def summary_table(cls, spans: list[Span]) -> str:
+        """
+        Fixed width table of span totals, slowest first
+        """
+        rows = sorted(cls.summarize(spans).items(), key=lambda item: item[1].seconds, reverse=True)
+        header = f"{'kind':<10} {'span':<32} {'count':>5} {'total s':>8} {'max s':>7} {'tokens in':>9} {'tokens out':>10} {'retries':>7} {'errors':>6}"
+        lines = [header, "-" * len(header)]
+        for (kind, name), summary in rows:
+            lines.append(
+                f"{kind:<10} {name[:32]:<32} {summary.count:>5} {summary.seconds:>8.2f} {summary.max_seconds:>7.2f} "
+                f"{summary.prompt_tokens:>9} {summary.completion_tokens:>10} {summary.retries:>7} {summary.errors:>6}"
+            )
+        return "\n".join(lines)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """
+    Process wide tracer, configured once by the cli with configure_tracer
+    """
+    return _tracer
+
+
+def configure_tracer(trace_dir: Optional[str] = None, enabled: bool = True) -> Tracer:
+    _tracer.trace_dir = trace_dir
+    _tracer.enabled = enabled
+    return _tracer
@@ -0,0 +1,74 @@
+"""
+Okapi BM25 keyword index over the command documents, used alongside the
+embedding search so keyword heavy questions ("bgp neighbors", "ospf database")
+find the right command even when the embeddings miss it.
+"""
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter, defaultdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vector_store.vectorstoreinterface import Document, VectorStoreInterface
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "can", "do", "does", "for", "from", "how", "i", "in", "is", "it", "me",
+    "my", "of", "on", "or", "the", "to", "what", "which", "with", "you",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lower case alphanumeric tokens without stopwords
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    BM25 over each document's command name and documentation.
+    The command name is repeated command_boost times so matches on it outweigh matches in the body.
+    """
+
+    def __init__(self, documents: list[Document], k1: float = 1.5, b: float = 0.75, command_boost: int = 3):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: list[int] = []
+        for doc_idx, doc in enumerate(documents):
+            tokens = tokenize(doc.metadata.get("command", "")) * command_boost + tokenize(doc.page_content)
+            self.doc_lengths.append(len(tokens))
+            for token, frequency in Counter(tokens).items():
+                self.postings[token].append((doc_idx, frequency))
+        self.avg_doc_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+        doc_count = len(documents)
+        self.idf = {
+            token: math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for token, postings in self.postings.items()
+        }
+
+    @classmethod
+    def from_vector_store(cls, vector_store: VectorStoreInterface, **kwargs) -> BM25Index:
+        """
+        Builds the index by paging through every document in the store
+        """
+        return cls(list(vector_store.iter_documents()), **kwargs)
+
+    def search(self, query: str, k: int) -> list[tuple[Document, float]]:
+        """
+        Top k documents by BM25 score, highest first
+        """
+        scores: dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            for doc_idx, frequency in self.postings[token]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_idx] / self.avg_doc_length
+                scores[doc_idx] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[doc_idx], score) for doc_idx, score in ranked]
@@ -0,0 +1,83 @@
+"""
+Exact lookup of command documentation by command string, so finding the docs
+for a command the LLM picked doesn't need an embedding call and a vector query.
+"""
+from __future__ import annotations
+
+import difflib
+from bisect import bisect_left
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vector_store.vectorstoreinterface import Document, VectorStoreInterface
+
+
+class CommandIndex:
+    """
+    In memory map of normalized command -> Document.
+    Lookups try an exact match, then a prefix match, then a close fuzzy match.
+    """
+
+    def __init__(self, documents: list[Document], fuzzy_cutoff: float = 0.85):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.documents: dict[str, Document] = {}
+        for doc in documents:
+            command = doc.metadata.get("command")
+            if command:
+                # First copy wins, same as the dedup pass
+                self.documents.setdefault(self.normalize(command), doc)
+        self.sorted_commands = sorted(self.documents)
+
+        from helpers import get_logger
+        self.logger = get_logger()
+
+    @classmethod
+    def from_vector_store(cls, vector_store: VectorStoreInterface, **kwargs) -> CommandIndex:
+        """
+        Builds the index by paging through every document in the store
+        """
+        return cls(list(vector_store.iter_documents()), **kwargs)
+
+    @staticmethod
+    def normalize(command: str) -> str:
+        """
+        Lower case, collapsed whitespace and no surrounding quotes or backticks
+        """
+        return " ".join(command.strip().strip("`'\"").lower().split())
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def prefix_match(self, command: str) -> Optional[str]:
+        """
+        The longest indexed command the query starts with (the LLM added arguments),
+        or else the only indexed command that starts with the query (the LLM dropped some).
+        A query that several commands start with, ex. "show ip", is ambiguous and has no match
+        """
+        words = command.split()
+        for length in range(len(words) - 1, 1, -1):
+            candidate = " ".join(words[:length])
+            if candidate in self.documents:
+                return candidate
+        position = bisect_left(self.sorted_commands, command)
+        extensions = [
+            candidate for candidate in self.sorted_commands[position:position + 2]
+            if candidate.startswith(f"{command} ")
+        ]
+        return extensions[0] if len(extensions) == 1 else None
+
+    def lookup(self, command: str) -> Optional[Document]:
+        """
+        Finds the document for a command, None if nothing is close enough
+        """
+        normalized = self.normalize(command)
+        if normalized in self.documents:
+            return self.documents[normalized]
+        match = self.prefix_match(normalized)
+        if match is None:
+            close_matches = difflib.get_close_matches(normalized, self.sorted_commands, n=1, cutoff=self.fuzzy_cutoff)
+            match = close_matches[0] if close_matches else None
+        if match is not None:
+            self.logger.debug(f"No exact match for '{command}', using '{match}'")
+            return self.documents[match]
+        return None
@@ -0,0 +1,202 @@
+"""
+In process brute force vector search over the command documents. The corpus is a few
+thousand commands, so one matrix-vector product over every embedding is faster than a
+query through Chroma's HNSW index and SQLite, and exact rather than approximate.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Iterable, Optional, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from vector_store.vectorstoreinterface import Document, VectorStoreInterface
+
+VECTORS_FILENAME = "vectors.npy"
+DOCUMENTS_FILENAME = "documents.json"
+# Metadata fields with a precomputed boolean mask per value, filters on other fields go to Chroma
+MASK_FIELDS = ("parent_topic", "child_topic")
+
+
+class UnsupportedFilter(ValueError):
+    """
+    Raised for a metadata filter the masks can't evaluate
+    """
+
+
+def content_fingerprint(content_hashes: Iterable[Optional[str]]) -> str:
+    """
+    Hash of a collection's sorted content_hash values, changes when any document is added, removed or edited
+    """
+    digest = hashlib.sha256()
+    for value in sorted(value or "" for value in content_hashes):
+        digest.update(value.encode("UTF-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+class DenseIndex:
+    """
+    Normalised float32 embeddings of every document, one row per document, memory mapped from
+    path/vectors.npy with the documents, the embedding model and the content fingerprint in
+    path/documents.json. Scores are cosine similarities, the same ranking Chroma's l2 distance
+    gives normalised embeddings
+    """
+
+    def __init__(self, matrix: np.ndarray, documents: list[Document], embedding_model: str, fingerprint: Optional[str] = None):
+        self.matrix = matrix
+        self.documents = documents
+        self.embedding_model = embedding_model
+        self.fingerprint = fingerprint
+        self.masks: dict[str, dict[str, np.ndarray]] = {}
+        for field in MASK_FIELDS:
+            rows: dict[str, list[int]] = {}
+            for row, doc in enumerate(documents):
+                if field in doc.metadata:
+                    rows.setdefault(doc.metadata[field], []).append(row)
+            self.masks[field] = {}
+            for value, value_rows in rows.items():
+                mask = np.zeros(len(documents), dtype=bool)
+                mask[value_rows] = True
+                self.masks[field][value] = mask
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        """
+        Scales each row to unit length, zero rows are left as they are
+        """
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    @classmethod
+    def build(cls, rows: Iterable[tuple[Document, list[float]]], path: str, embedding_model: str) -> DenseIndex:
+        """
+        Writes the index for (document, embedding) rows to path and loads it back memory mapped.
+        Both files are written to a directory beside path which is renamed into place, so a
+        reader finds the old index, no index or the new one, never a mix
+        """
+        documents, vectors = [], []
+        for doc, vector in rows:
+            documents.append(doc)
+            vectors.append(vector)
+        matrix = cls.normalize(np.asarray(vectors, dtype=np.float32))
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".{os.path.basename(path)}-", dir=parent)
+        try:
+            with open(os.path.join(staging, VECTORS_FILENAME), "wb") as vectors_file:
+                np.save(vectors_file, np.ascontiguousarray(matrix))
+            with open(os.path.join(staging, DOCUMENTS_FILENAME), "w", encoding="UTF-8") as documents_file:
+                json.dump({
+                    "embedding_model": embedding_model,
+                    "fingerprint": content_fingerprint(doc.metadata.get("content_hash") for doc in documents),
+                    "documents": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+                }, documents_file)
+            cls.swap(staging, path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return cls.load(path)
+
+    @staticmethod
+    def swap(staging: str, path: str) -> None:
+        """
+        Renames the staging directory to path, moving any old index aside first and deleting it after.
+        If another process swaps its index in at the same time, theirs is kept
+        """
+        retired = f"{staging}.old"
+        if os.path.exists(path):
+            os.replace(path, retired)
+        try:
+            os.replace(staging, path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+        finally:
+            shutil.rmtree(retired, ignore_errors=True)
+
+    @classmethod
+    def from_vector_store(cls, vector_store: VectorStoreInterface, path: str) -> DenseIndex:
+        """
+        Builds the index from the embeddings already stored in the collection, nothing is re-embedded
+        """
+        return cls.build(vector_store.iter_embeddings(), path, vector_store.embedding_model)
+
+    @classmethod
+    def load(cls, path: str) -> Optional[DenseIndex]:
+        """
+        Opens an index written by build, None if there isn't one at path
+        """
+        from vector_store.vectorstoreinterface import Document
+
+        vectors_path = os.path.join(path, VECTORS_FILENAME)
+        documents_path = os.path.join(path, DOCUMENTS_FILENAME)
+        if not os.path.exists(vectors_path) or not os.path.exists(documents_path):
+            return None
+        with open(documents_path, "r", encoding="UTF-8") as documents_file:
+            saved = json.load(documents_file)
+        matrix = np.load(vectors_path, mmap_mode="r")
+        documents = [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in saved["documents"]]
+        if len(matrix) != len(documents):
+            return None
+        return cls(matrix, documents, saved["embedding_model"], saved.get("fingerprint"))
+
+    @staticmethod
+    def remove(path: str) -> None:
+        """
+        Deletes the index files at path, if any
+        """
+        shutil.rmtree(path, ignore_errors=True)
+
+    def filter_mask(self, metadata_filter: Optional[dict]) -> Optional[np.ndarray]:
+        """
+        Rows matching a filter of $eq or $in conditions on MASK_FIELDS, optionally under one $and.
+        None means every row. Raises UnsupportedFilter for anything else
+        """
+        if not metadata_filter:
+            return None
+        conditions = metadata_filter["$and"] if set(metadata_filter) == {"$and"} else [metadata_filter]
+        mask = np.ones(len(self.documents), dtype=bool)
+        for condition in conditions:
+            for field, value in condition.items():
+                if field not in self.masks:
+                    raise UnsupportedFilter(f"No mask for {field}")
+                if not isinstance(value, dict):
+                    value = {"$eq": value}
+                if set(value) == {"$eq"}:
+                    values = [value["$eq"]]
+                elif set(value) == {"$in"}:
+                    values = value["$in"]
+                else:
+                    raise UnsupportedFilter(f"Unsupported condition {value} on {field}")
+                field_mask = np.zeros(len(self.documents), dtype=bool)
+                for expected in values:
+                    if expected in self.masks[field]:
+                        field_mask |= self.masks[field][expected]
+                mask &= field_mask
+        return mask
+
+    def search(self, query_vector: list[float], k: int, metadata_filter: Optional[dict] = None) -> list[tuple[Document, float]]:
+        """
+        Top k documents by cosine similarity to query_vector, highest first.
+        Raises UnsupportedFilter if the filter can't be evaluated here
+        """
+        mask = self.filter_mask(metadata_filter)
+        query = self.normalize(np.asarray(query_vector, dtype=np.float32))
+        scores = self.matrix @ query
+        rows = np.arange(len(scores)) if mask is None else np.flatnonzero(mask)
+        scores = scores[rows]
+        k = min(k, len(rows))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.documents[rows[idx]], float(scores[idx])) for idx in top]
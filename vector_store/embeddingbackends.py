@@ -0,0 +1,113 @@
+"""
+Embedding backends for the vector store. A model is named backend[:model], ex.
+openai:text-embedding-ada-002 or sentence-transformers:all-MiniLM-L6-v2, and the
+name is recorded on the collection so a store is only ever queried with the model
+that embedded it.
+"""
+import hashlib
+import math
+import os
+from typing import Callable
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+
+from vector_store.bm25index import tokenize
+from vector_store.reranker import stem
+
+DEFAULT_MODELS = {
+    "openai": "text-embedding-ada-002",
+    "sentence-transformers": "all-MiniLM-L6-v2",
+    "onnx": "all-MiniLM-L6-v2",
+    "hashing": "512",
+}
+DEFAULT_EMBEDDING_MODEL = "openai:text-embedding-ada-002"
+# Stores built before the model was recorded on the collection were all embedded with ada-002
+LEGACY_EMBEDDING_MODEL = DEFAULT_EMBEDDING_MODEL
+EMBEDDING_MODEL_METADATA_KEY = "embedding_model"
+
+
+class EmbeddingModelMismatch(ValueError):
+    """
+    Raised when a store is opened with a different model than the one that embedded it
+    """
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Deterministic local embeddings, stemmed words and word pairs hashed into dimensions buckets
+    and normalised. Good enough to rank command documentation offline, no model download
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def embed(self, text: str) -> list[float]:
+        words = [stem(token) for token in tokenize(text)]
+        vector = [0.0] * self.dimensions
+        for feature in words + [f"{first} {second}" for first, second in zip(words, words[1:])]:
+            digest = hashlib.sha1(feature.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[bucket] += 1.0 if digest[4] % 2 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [self.embed(text) for text in input]
+
+
+class SentenceTransformerEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    CPU only local embeddings with sentence-transformers, texts are encoded batch_size at a time
+    into normalised numpy vectors. backend="onnx" runs the model with onnxruntime.
+    sentence-transformers is optional and only imported when this backend is used, see requirements-local.txt.
+    The model only reads its first max_input_tokens tokens of a text, 256 for all-MiniLM-L6-v2
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 64, backend: str = "torch"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as exc:
+            raise ImportError("Local embeddings need sentence-transformers, pip install -r requirements-local.txt") from exc
+        model_kwargs = {"device": "cpu"}
+        if backend != "torch":
+            model_kwargs["backend"] = backend
+        self.model = SentenceTransformer(model_name, **model_kwargs)
+        self.batch_size = batch_size
+        self.max_input_tokens = self.model.max_seq_length
+
+    def __call__(self, input: Documents) -> Embeddings:
+        vectors = self.model.encode(
+            list(input),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+
+EMBEDDING_BACKENDS: dict[str, Callable[[str], EmbeddingFunction]] = {
+    "openai": lambda model: OpenAIEmbeddingFunction(api_key=os.getenv("OPENAI_API_KEY"), model_name=model),
+    "sentence-transformers": lambda model: SentenceTransformerEmbeddingFunction(model),
+    "onnx": lambda model: SentenceTransformerEmbeddingFunction(model, backend="onnx"),
+    "hashing": lambda model: HashingEmbeddingFunction(int(model)),
+}
+
+
+def canonical_embedding_model(name: str) -> str:
+    """
+    backend[:model] with the backend's default model filled in
+    """
+    backend, _, model = name.partition(":")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {list(EMBEDDING_BACKENDS)}")
+    return f"{backend}:{model or DEFAULT_MODELS[backend]}"
+
+
+def get_embedding_function(embedding_model: str) -> EmbeddingFunction:
+    """
+    Builds the embedding function for a canonical backend:model name
+    """
+    backend, _, model = embedding_model.partition(":")
+    return EMBEDDING_BACKENDS[backend](model)
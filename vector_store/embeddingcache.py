@@ -0,0 +1,161 @@
+"""
+On disk embedding cache, wraps a chroma embedding function so unchanged
+documents and repeated queries don't go back to the embedding api.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Optional
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from tracing.tracer import get_tracer
+
+
+@dataclass
+class EmbeddingCacheStats:
+    """
+    Counters for the embedding cache
+    """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def summary(self) -> str:
+        """
+        One line summary for the logs
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"embedding cache hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2f} evictions={self.evictions}"
+
+
+class EmbeddingCache:
+    """
+    SQLite store of embeddings keyed by sha256 of (model, text).
+    Vectors are stored as float32 blobs, least recently used rows are removed past max_entries.
+    """
+
+    def __init__(self, path: str, max_entries: int = 500_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.stats = EmbeddingCacheStats()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """
+        Content address for a piece of text embedded by a given model
+        """
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """
+        Returns the cached vectors for the keys that are present
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Stay under sqlite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self.conn.commit()
+            self.stats.hits += len(found)
+            self.stats.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items: dict[str, list[float]]) -> None:
+        """
+        Stores vectors and evicts the least recently used rows if over max_entries
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()],
+            )
+            count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.stats.evictions += overflow
+            self.conn.commit()
+
+    def close(self) -> None:
+        """
+        Closes the sqlite connection
+        """
+        with self._lock:
+            self.conn.close()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Chroma embedding function that checks the cache before calling the wrapped function,
+    only texts that were never embedded by model_name are sent on.
+    """
+
+    def __init__(self, embedding_function: EmbeddingFunction, model_name: str, cache: EmbeddingCache):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.cache = cache
+
+    def __call__(self, input: Documents) -> Embeddings:
+        with get_tracer().span("embed", kind="embedding", model=self.model_name, texts=len(input)) as span:
+            keys = [self.cache.make_key(self.model_name, text) for text in input]
+            cached = self.cache.get_many(keys)
+            missing: dict[str, str] = {}
+            for key, text in zip(keys, input):
+                if key not in cached and key not in missing:
+                    missing[key] = text
+            if span is not None:
+                span.attributes["embedded"] = len(missing)
+            if missing:
+                new_vectors = self.embedding_function(list(missing.values()))
+                new_items = {key: list(vector) for key, vector in zip(missing.keys(), new_vectors)}
+                self.cache.put_many(new_items)
+                cached.update(new_items)
+            return [cached[key] for key in keys]
+
+
+def cached_embedding_function(
+    embedding_function: EmbeddingFunction,
+    model_name: str,
+    cache_path: Optional[str],
+    max_entries: int = 500_000,
+) -> EmbeddingFunction:
+    """
+    Wraps the embedding function with an on disk cache, or returns it unchanged if no path is given
+    """
+    if not cache_path:
+        return embedding_function
+    return CachedEmbeddingFunction(
+        embedding_function=embedding_function,
+        model_name=model_name,
+        cache=EmbeddingCache(cache_path, max_entries=max_entries),
+    )
@@ -0,0 +1,144 @@
+"""
+Local reranking of retrieved commands. A confident reranker lets the flow pick
+the command directly instead of asking the command finder agent.
+"""
+from __future__ import annotations
+
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional, TYPE_CHECKING
+
+from vector_store.bm25index import tokenize
+
+if TYPE_CHECKING:
+    from vector_store.vectorstoreinterface import Document
+
+
+@dataclass
+class RankedCommand:
+    """
+    A retrieved document with its rerank score and how confident the reranker is that it's the best
+    """
+    document: Document
+    score: float
+    confidence: float
+
+    @property
+    def command(self) -> str:
+        return self.document.metadata["command"]
+
+
+def stem(token: str) -> str:
+    """
+    Very light stemming so 'neighbors' matches 'neighbor' and 'interfaces' matches 'interface'
+    """
+    if len(token) > 3 and token.endswith("es") and token[-3] in "sxz":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+class Reranker(ABC):
+    """
+    Base reranker, subclasses implement score(). Confidence is the softmax probability of each
+    candidate's score, so a candidate that clearly beats the rest gets a confidence near 1
+    """
+
+    name = "base"
+
+    def __init__(self, temperature: float = 10.0):
+        self.temperature = temperature
+
+    @abstractmethod
+    def score(self, query: str, documents: list[Document]) -> list[float]:
+        """
+        Returns one relevance score per document, higher is better
+        """
+
+    def rerank(self, query: str, documents: list[Document]) -> list[RankedCommand]:
+        """
+        Reorders documents best first, ties keep their retrieval order
+        """
+        if not documents:
+            return []
+        scores = self.score(query, documents)
+        top_score = max(scores)
+        weights = [math.exp(self.temperature * (score - top_score)) for score in scores]
+        total = sum(weights)
+        ranked = [
+            RankedCommand(document=doc, score=score, confidence=weight / total)
+            for doc, score, weight in zip(documents, scores, weights)
+        ]
+        return sorted(ranked, key=lambda ranked_command: ranked_command.score, reverse=True)
+
+
+class KeywordReranker(Reranker):
+    """
+    Deterministic reranker, scores how much of the question is covered by the command name
+    and, with a lower weight, by the documentation. Penalises long commands slightly so the
+    plainest command that covers the question wins
+    """
+
+    name = "keyword"
+
+    def __init__(self, temperature: float = 10.0, documentation_weight: float = 0.3, length_penalty: float = 0.02):
+        super().__init__(temperature=temperature)
+        self.documentation_weight = documentation_weight
+        self.length_penalty = length_penalty
+
+    def score(self, query: str, documents: list[Document]) -> list[float]:
+        query_tokens = {stem(token) for token in tokenize(query)}
+        if not query_tokens:
+            return [0.0] * len(documents)
+        scores = []
+        for doc in documents:
+            command_tokens = {stem(token) for token in tokenize(doc.metadata.get("command", ""))}
+            doc_tokens = {stem(token) for token in tokenize(doc.page_content)}
+            command_coverage = len(query_tokens & command_tokens) / len(query_tokens)
+            doc_coverage = len(query_tokens & doc_tokens) / len(query_tokens)
+            extra_command_tokens = len(command_tokens - query_tokens)
+            scores.append(
+                command_coverage
+                + self.documentation_weight * doc_coverage
+                - self.length_penalty * extra_command_tokens
+            )
+        return scores
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores (question, documentation) pairs with a sentence-transformers cross encoder on CPU.
+    sentence-transformers is optional and only imported when this reranker is used
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", temperature: float = 1.0, max_chars: int = 2000):
+        super().__init__(temperature=temperature)
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as exc:
+            raise ImportError("The cross-encoder reranker needs sentence-transformers, pip install sentence-transformers") from exc
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.max_chars = max_chars
+
+    def score(self, query: str, documents: list[Document]) -> list[float]:
+        pairs = [(query, doc.page_content[:self.max_chars]) for doc in documents]
+        return [float(score) for score in self.model.predict(pairs)]
+
+
+RERANKERS = {
+    KeywordReranker.name: KeywordReranker,
+    CrossEncoderReranker.name: CrossEncoderReranker,
+}
+
+
+def get_reranker(name: Optional[str]) -> Optional[Reranker]:
+    """
+    Builds a reranker by name, None or 'none' disables reranking
+    """
+    if not name or name == "none":
+        return None
+    return RERANKERS[name]()
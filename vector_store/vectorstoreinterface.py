@@ -2,18 +2,48 @@
 Thin wrapper around the chromadb library
 """
 import os
+import threading
+import time
 from dataclasses import dataclass
 
 from chromadb import PersistentClient
 from chromadb.config import Settings
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
 from typing import Optional, List, Dict
-from helpers import generate_random_id
+from helpers import generate_document_id, content_hash
+from vector_store.embeddingcache import cached_embedding_function
+from vector_store.embeddingbackends import (
+    DEFAULT_EMBEDDING_MODEL,
+    EMBEDDING_MODEL_METADATA_KEY,
+    LEGACY_EMBEDDING_MODEL,
+    EmbeddingModelMismatch,
+    canonical_embedding_model,
+    get_embedding_function,
+)
+from vector_store.bm25index import BM25Index
+from vector_store.denseindex import DenseIndex, UnsupportedFilter, content_fingerprint
+from token_budget.tokenbudget import count_tokens, truncate_tokens
+from tracing.tracer import get_tracer
 from dotenv import load_dotenv
 from openai import BadRequestError
 
 load_dotenv()
 
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite3"
+DENSE_INDEX_DIRNAME = "dense_index"
+
+# OpenAI embedding limits, 8191 tokens per input and 2048 inputs per request.
+# The request level token budget is kept well under the api's limit
+MAX_INPUT_TOKENS = 8191
+# A rejected document's embedding input is halved until it fits or drops under this
+MIN_INPUT_TOKENS = 512
+MAX_BATCH_TOKENS = 250_000
+MAX_BATCH_SIZE = 2048
+# Reciprocal rank fusion constant, dampens how much the very top ranks dominate
+RRF_K = 60
+
+# Max ids per get/delete call against the collection
+ID_CHUNK_SIZE = 500
+
 @dataclass
 class Document:
     """
@@ -31,35 +61,310 @@ class VectorStoreInterface:
         self,
         vs_name: str,
         search_type: Optional[str] = "similarity",
+        use_embedding_cache: bool = True,
+        embedding_cache_max_entries: int = 500_000,
+        embedding_model: Optional[str] = None,
+        dense_index: bool = False,
     ):
-        print(vs_name)
+        """
+        embedding_model is backend[:model], if unset the model the store was built with is used,
+        or DEFAULT_EMBEDDING_MODEL for a new store. With dense_index, similarity search runs
+        against an in process copy of the embeddings instead of Chroma's index
+        """
+        from helpers import get_logger
+        self.logger = get_logger()
+
         self.client = PersistentClient(path=vs_name)
+        collection_name = vs_name.split("/")[1]
+        existing = next((collection for collection in self.client.list_collections() if collection.name == collection_name), None)
+        self.embedding_model = self.resolve_embedding_model(existing, embedding_model)
+        backend, _, model = self.embedding_model.partition(":")
+        embedding_function = get_embedding_function(self.embedding_model)
+        # Local models read far less than OpenAI's 8191 tokens, all-MiniLM-L6-v2 stops at 256
+        self.max_input_tokens = getattr(embedding_function, "max_input_tokens", MAX_INPUT_TOKENS)
+        self.embedding_function = cached_embedding_function(
+            embedding_function,
+            # OpenAI vectors keep the bare model name so embedding caches from before backends were pluggable stay valid
+            model_name=model if backend == "openai" else self.embedding_model,
+            cache_path=os.path.join(vs_name, EMBEDDING_CACHE_FILENAME) if use_embedding_cache else None,
+            max_entries=embedding_cache_max_entries,
+        )
         self.collection = self.client.get_or_create_collection(
-            name=vs_name.split("/")[1], embedding_function=OpenAIEmbeddingFunction(api_key=os.getenv("OPENAI_API_KEY")))
+            name=collection_name,
+            embedding_function=self.embedding_function,
+            metadata=None if existing is not None else {EMBEDDING_MODEL_METADATA_KEY: self.embedding_model},
+        )
+        if existing is not None and EMBEDDING_MODEL_METADATA_KEY not in (existing.metadata or {}):
+            metadata = {key: value for key, value in (existing.metadata or {}).items() if not key.startswith("hnsw:")}
+            self.collection.modify(metadata={**metadata, EMBEDDING_MODEL_METADATA_KEY: self.embedding_model})
+            self.logger.info(f"Recorded embedding model {self.embedding_model} on {collection_name}")
         self.search_type = search_type
-        
-        from helpers import get_logger
-        self.logger = get_logger()
+        self.lexical_index: Optional[BM25Index] = None
+        self.use_dense_index = dense_index
+        self.dense_index_path = os.path.join(vs_name, DENSE_INDEX_DIRNAME)
+        self.dense_index: Optional[DenseIndex] = None
+        self._dense_index_lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def resolve_embedding_model(existing, requested: Optional[str]) -> str:
+        """
+        The model to open the collection with. Raises EmbeddingModelMismatch if the requested
+        model isn't the one the collection's documents were embedded with
+        """
+        requested = canonical_embedding_model(requested) if requested else None
+        if existing is None:
+            return requested or DEFAULT_EMBEDDING_MODEL
+        recorded = (existing.metadata or {}).get(EMBEDDING_MODEL_METADATA_KEY)
+        if recorded is None:
+            # Nothing recorded, an empty collection can take any model, a populated one was built with the legacy model
+            if existing.count() == 0:
+                return requested or DEFAULT_EMBEDDING_MODEL
+            recorded = LEGACY_EMBEDDING_MODEL
+        if requested and requested != recorded:
+            raise EmbeddingModelMismatch(
+                f"Collection {existing.name} was embedded with {recorded}, it can't be used with {requested}"
+            )
+        return recorded
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        Rough token count for budgeting batches, ~4 characters per token for english text
+        """
+        return len(text) // 4 + 1
+
+    def batch_documents(self, docs: List[Document], max_batch_tokens: int = MAX_BATCH_TOKENS, max_batch_size: int = MAX_BATCH_SIZE) -> List[List[Document]]:
+        """
+        Groups documents into batches that fit in a single embedding request.
+        Documents that look too large to embed get a batch of their own so they can't fail the others
+        """
+        batches = []
+        current_batch = []
+        current_tokens = 0
+        for doc in docs:
+            doc_tokens = self.estimate_tokens(doc.page_content)
+            if doc_tokens > MAX_INPUT_TOKENS:
+                batches.append([doc])
+                continue
+            if current_batch and (current_tokens + doc_tokens > max_batch_tokens or len(current_batch) >= max_batch_size):
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+            current_batch.append(doc)
+            current_tokens += doc_tokens
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    @staticmethod
+    def document_id(doc: Document) -> str:
+        """
+        Deterministic id for a document, command docs are identified by command + child_topic
+        """
+        if "command" in doc.metadata:
+            return generate_document_id(doc.metadata["command"], doc.metadata.get("child_topic", ""))
+        return generate_document_id(doc.page_content)
+
+    @staticmethod
+    def embedding_text(doc: Document, max_input_tokens: int = MAX_INPUT_TOKENS) -> str:
+        """
+        The part of a document that is embedded, its first max_input_tokens tokens.
+        The whole document is still stored and returned by searches
+        """
+        if count_tokens(doc.page_content) <= max_input_tokens:
+            return doc.page_content
+        return truncate_tokens(doc.page_content, max_input_tokens)
 
-    def add_documents(self, docs: List[Document]):
+    def log_truncated(self, docs: List[Document]) -> None:
         """
-        Add documents to the created datastore instance.
+        Warns how many documents are longer than the embedding model reads, their embeddings only
+        cover their start so a search can't match on the rest of the page
         """
+        truncated = sum(count_tokens(doc.page_content) > self.max_input_tokens for doc in docs)
+        if truncated:
+            self.logger.warning(
+                f"{truncated}/{len(docs)} documents are longer than {self.embedding_model}'s "
+                f"{self.max_input_tokens} token input, only their start is embedded"
+            )
+
+    def add_batch(self, batch: List[Document], upsert: bool = False, max_input_tokens: Optional[int] = None) -> int:
+        """
+        Embeds and writes a batch in one request, documents over max_input_tokens (the model's input
+        limit by default) are embedded from their start. If the api rejects the batch it is split in
+        half and retried until the offending documents are isolated, those are retried with half as
+        many tokens embedded. Returns the number of documents saved
+        """
+        max_input_tokens = max_input_tokens or self.max_input_tokens
+        write = self.collection.upsert if upsert else self.collection.add
         try:
-            for doc in docs:
-                self.collection.add(
-                    ids=[generate_random_id()],
-                    documents=[doc.page_content],
-                    metadatas=[doc.metadata],
-                )
-        except BadRequestError:
-            self.logger.warning(f"Document too Large {doc.metadata}")
-        
+            write(
+                ids=[self.document_id(doc) for doc in batch],
+                documents=[doc.page_content for doc in batch],
+                metadatas=[{**doc.metadata, "content_hash": content_hash(doc.page_content)} for doc in batch],
+                embeddings=self.embedding_function([self.embedding_text(doc, max_input_tokens) for doc in batch]),
+            )
+            self.invalidate_dense_index()
+            return len(batch)
+        except BadRequestError as exc:
+            if len(batch) == 1:
+                if max_input_tokens // 2 < MIN_INPUT_TOKENS:
+                    self.logger.warning(f"Document too Large {batch[0].metadata} - {exc}")
+                    return 0
+                self.logger.warning(f"Document too Large {batch[0].metadata}, embedding its first {max_input_tokens // 2} tokens - {exc}")
+                return self.add_batch(batch, upsert, max_input_tokens // 2)
+            middle = len(batch) // 2
+            self.logger.debug(f"Batch of {len(batch)} rejected, splitting and retrying")
+            return self.add_batch(batch[:middle], upsert, max_input_tokens) + self.add_batch(batch[middle:], upsert, max_input_tokens)
+
+    @staticmethod
+    def unique_documents(docs: List[Document]) -> Dict[str, Document]:
+        """
+        Maps document id to document, a command repeated on the same page keeps its last copy
+        """
+        return {VectorStoreInterface.document_id(doc): doc for doc in docs}
+
+    def add_documents(self, docs: List[Document]) -> int:
+        """
+        Add documents to the created datastore instance, in token budgeted batches.
+        Documents are upserted, so a reload replaces the stored copy of a changed page.
+        Returns the number of documents saved
+        """
+        start = time.perf_counter()
+        saved = 0
+        docs = list(self.unique_documents(docs).values())
+        self.log_truncated(docs)
+        for batch in self.batch_documents(docs):
+            saved += self.add_batch(batch, upsert=True)
+        elapsed = time.perf_counter() - start
+        docs_per_sec = saved / elapsed if elapsed else 0.0
+        self.logger.info(f"Saved {saved}/{len(docs)} documents in {elapsed:.2f}s ({docs_per_sec:.1f} docs/sec)")
+        self.log_embedding_cache_stats()
+        return saved
+
+    def get_content_hashes(self, ids: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Returns the stored content hash for each id that already exists in the collection
+        """
+        hashes = {}
+        for start in range(0, len(ids), ID_CHUNK_SIZE):
+            existing = self.collection.get(ids=ids[start:start + ID_CHUNK_SIZE], include=["metadatas"])
+            for doc_id, metadata in zip(existing["ids"], existing["metadatas"]):
+                hashes[doc_id] = (metadata or {}).get("content_hash")
+        return hashes
+
+    def upsert_documents(self, docs: List[Document]) -> Dict[str, int]:
+        """
+        Only embeds and writes documents that are new or whose content changed since the last load.
+        Returns counts of added, updated and unchanged documents
+        """
+        summary = {"added": 0, "updated": 0, "unchanged": 0}
+        unique_docs = self.unique_documents(docs)
+        existing_hashes = self.get_content_hashes(list(unique_docs))
+        changed = []
+        for doc_id, doc in unique_docs.items():
+            if doc_id not in existing_hashes:
+                summary["added"] += 1
+                changed.append(doc)
+            elif existing_hashes[doc_id] != content_hash(doc.page_content):
+                summary["updated"] += 1
+                changed.append(doc)
+            else:
+                summary["unchanged"] += 1
+        self.log_truncated(changed)
+        for batch in self.batch_documents(changed):
+            self.add_batch(batch, upsert=True)
+        self.logger.debug(f"Upsert summary {summary}")
+        return summary
+
+    def iter_metadatas(self, page_size: int = 5000):
+        """
+        Pages through the whole collection yielding (id, metadata) without loading documents or embeddings
+        """
+        offset = 0
+        while True:
+            page = self.collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["metadatas"])
+            offset += len(page["ids"])
+
+    def content_fingerprint(self) -> str:
+        """
+        Fingerprint of every stored document's content_hash, compared with the dense index's
+        """
+        return content_fingerprint((metadata or {}).get("content_hash") for _, metadata in self.iter_metadatas())
+
+    def iter_documents(self, page_size: int = 1000):
+        """
+        Pages through the whole collection yielding Documents
+        """
+        offset = 0
+        while True:
+            page = self.collection.get(include=["metadatas", "documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            for metadata, page_content in zip(page["metadatas"], page["documents"]):
+                yield Document(page_content=page_content, metadata=metadata)
+            offset += len(page["ids"])
+
+    def iter_embeddings(self, page_size: int = 1000):
+        """
+        Pages through the whole collection yielding (Document, embedding)
+        """
+        offset = 0
+        while True:
+            page = self.collection.get(include=["metadatas", "documents", "embeddings"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            for metadata, page_content, embedding in zip(page["metadatas"], page["documents"], page["embeddings"]):
+                yield Document(page_content=page_content, metadata=metadata), embedding
+            offset += len(page["ids"])
+
+    def delete_ids(self, ids: List[str]) -> None:
+        """
+        Deletes ids in chunks
+        """
+        for start in range(0, len(ids), ID_CHUNK_SIZE):
+            self.collection.delete(ids=ids[start:start + ID_CHUNK_SIZE])
+        if ids:
+            self.invalidate_dense_index()
+
+    def delete_missing(self, keep_ids: set, metadata_filter: Optional[dict] = None) -> int:
+        """
+        Deletes every document matching the filter whose id isn't in keep_ids,
+        used to drop documents that vanished upstream. Returns the number deleted
+        """
+        get_kwargs = {"include": []}
+        if metadata_filter:
+            get_kwargs["where"] = metadata_filter
+        stale_ids = [doc_id for doc_id in self.collection.get(**get_kwargs)["ids"] if doc_id not in keep_ids]
+        self.delete_ids(stale_ids)
+        return len(stale_ids)
 
     def invoke(self, query: str, metadata_filter: Optional[dict] = None, k_document_count: int=2) -> List[Document]:
         """
         Query the vector store with optional metadata filtering.
+        With the hybrid search type, unfiltered queries also use the keyword index.
+        """
+        search_type = "hybrid" if self.search_type == "hybrid" and not metadata_filter else "similarity"
+        with get_tracer().span("invoke", kind="retrieval", search_type=search_type, k=k_document_count, filtered=bool(metadata_filter)) as span:
+            if search_type == "hybrid":
+                documents = self.hybrid_invoke(query, k_document_count)
+            else:
+                documents = self.similarity_invoke(query, metadata_filter, k_document_count)
+            if span is not None:
+                span.attributes["results"] = len(documents)
+            return documents
+
+    def similarity_invoke(self, query: str, metadata_filter: Optional[dict] = None, k_document_count: int=2) -> List[Document]:
+        """
+        Embedding similarity search
         """
+        if self.use_dense_index:
+            documents = self.dense_invoke(query, metadata_filter, k_document_count)
+            if documents is not None:
+                return documents
         out_list = []
         query_kwargs = {
             "query_texts": [query],
@@ -77,6 +382,99 @@ class VectorStoreInterface:
             )
         return out_list
 
+    def get_dense_index(self) -> Optional[DenseIndex]:
+        """
+        Loads the dense index on first use, rebuilding it from the collection if it's missing
+        or out of date: another embedding model, or a content fingerprint that no longer matches
+        the collection's, ex. after another process upserted changed pages. None for an empty collection
+        """
+        with self._dense_index_lock:
+            if self.dense_index is None:
+                document_count = self.collection.count()
+                if document_count == 0:
+                    return None
+                index = DenseIndex.load(self.dense_index_path)
+                if (
+                    index is None
+                    or len(index) != document_count
+                    or index.embedding_model != self.embedding_model
+                    or index.fingerprint != self.content_fingerprint()
+                ):
+                    start = time.perf_counter()
+                    index = DenseIndex.from_vector_store(self, self.dense_index_path)
+                    self.logger.info(f"Built dense index over {len(index)} documents in {time.perf_counter() - start:.2f}s")
+                self.dense_index = index
+            return self.dense_index
+
+    def invalidate_dense_index(self) -> None:
+        """
+        Drops the dense index after a write, it is rebuilt on the next search
+        """
+        with self._dense_index_lock:
+            self.dense_index = None
+            DenseIndex.remove(self.dense_index_path)
+
+    def dense_invoke(self, query: str, metadata_filter: Optional[dict] = None, k_document_count: int=2) -> Optional[List[Document]]:
+        """
+        Similarity search against the dense index, None if the filter needs Chroma
+        """
+        index = self.get_dense_index()
+        if index is None:
+            return None
+        try:
+            results = index.search(self.embedding_function([query])[0], k_document_count, metadata_filter)
+        except UnsupportedFilter:
+            return None
+        get_tracer().annotate(index="dense")
+        return [doc for doc, _ in results]
+
+    def get_lexical_index(self) -> BM25Index:
+        """
+        Builds the BM25 index from the collection on first use
+        """
+        if self.lexical_index is None:
+            self.lexical_index = BM25Index.from_vector_store(self)
+            self.logger.info(f"Built keyword index over {len(self.lexical_index.documents)} documents")
+        return self.lexical_index
+
+    def hybrid_invoke(self, query: str, k_document_count: int=2) -> List[Document]:
+        """
+        Fuses the embedding and BM25 rankings with reciprocal rank fusion.
+        Each side contributes twice as many candidates as requested
+        """
+        candidate_count = k_document_count * 2
+        fused_scores: Dict[str, float] = {}
+        fused_docs: Dict[str, Document] = {}
+        vector_docs = self.similarity_invoke(query, k_document_count=candidate_count)
+        keyword_docs = [doc for doc, _ in self.get_lexical_index().search(query, candidate_count)]
+        for ranking in (vector_docs, keyword_docs):
+            for rank, doc in enumerate(ranking):
+                doc_id = self.document_id(doc)
+                fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + 1 / (RRF_K + rank + 1)
+                fused_docs.setdefault(doc_id, doc)
+        ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:k_document_count]
+        return [fused_docs[doc_id] for doc_id in ranked_ids]
+
+    def log_embedding_cache_stats(self) -> None:
+        """
+        Logs the embedding cache hit ratio if the cache is in use
+        """
+        cache = getattr(self.embedding_function, "cache", None)
+        if cache is not None:
+            self.logger.info(cache.stats.summary())
+
+    def close(self) -> None:
+        """
+        Releases the store, closes the embedding cache if the cache is in use.
+        Safe to call more than once
+        """
+        if self.closed:
+            return
+        cache = getattr(self.embedding_function, "cache", None)
+        if cache is not None:
+            cache.close()
+        self.closed = True
+
     def __enter__(self):
         """
         Enter context manager, return self.
@@ -85,6 +483,7 @@ class VectorStoreInterface:
 
     def __exit__(self, exc_type, exc_val, traceback):
         """
-        Exit context manager.
+        Exit context manager, closes the store.
         """
+        self.close()
 